@@ -0,0 +1,205 @@
+# bench_fetchers.py
+
+# Offline throughput benchmark for fetch_asdi and fetch_met_office, run against local stand-ins of S3 and the Data Hub.
+#
+#   python benchmarks/bench_fetchers.py --files 48 --size-kb 2048 --latency-ms 50
+#   python benchmarks/bench_fetchers.py --save-baseline benchmarks/baseline.json
+#   python benchmarks/bench_fetchers.py --baseline benchmarks/baseline.json   # exits 1 on a throughput regression
+
+import argparse
+from datetime import datetime
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, HERE)
+
+# MetFileImporter checks for an API key when it's created, the stand-ins don't check credentials
+os.environ.setdefault("MET_OFFICE_API_KEY", "benchmark")
+os.environ.setdefault("AWS_ACCESS", "benchmark")
+os.environ.setdefault("AWS_SECRET", "benchmark")
+os.environ.setdefault("AWS_REGION", "eu-west-2")
+
+import boto3
+from botocore.config import Config
+
+import fetch_asdi
+from fetch_met_office import MetFileImporter
+from stand_ins import DataHubStandIn, S3StandIn
+
+BUCKET_NAME = "met-office-atmospheric-model-data"
+PREFIX = "uk-deterministic-2km/"
+FILE_NAME_FORMAT = "rainfall_accumulation-PT01H.nc"
+FORECAST_PUBLISH_DATE = datetime(2024, 2, 3, 0)
+
+
+class _Timings:
+    """Collects (seconds, bytes) for each file a fetcher downloads"""
+
+    def __init__(self):
+        self.files = []
+        self._lock = threading.Lock()
+
+    def add(self, elapsed, size):
+        with self._lock:
+            self.files.append((elapsed, size))
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _summarise(name, timings, elapsed, server):
+    latencies = np.array([seconds for seconds, _ in timings.files]) * 1000
+    total_bytes = sum(size for _, size in timings.files)
+    return {
+        "fetcher": name,
+        "files": len(timings.files),
+        "seconds": round(elapsed, 3),
+        "files_per_s": round(len(timings.files) / elapsed, 2) if elapsed else 0.0,
+        "mb_per_s": round(total_bytes / 1024 ** 2 / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1) if len(latencies) else None,
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1) if len(latencies) else None,
+        "requests": server.requests,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+def bench_asdi(n_files, file_size, latency, workers):
+    """download_files for one run against the S3 stand-in"""
+    run = fetch_asdi._naming_convention(FORECAST_PUBLISH_DATE)
+    keys = [f"{PREFIX}{run}/{run[:9]}{hour % 24:02}00Z-PT{hour:04}H00M-{FILE_NAME_FORMAT}" for hour in range(n_files)]
+    # Other parameters share the prefix in the real bucket, so listing has to filter them out
+    keys += [key.replace(FILE_NAME_FORMAT, "temperature_at_screen_level.nc") for key in keys]
+
+    timings = _Timings()
+    with S3StandIn(BUCKET_NAME, keys, file_size, latency) as server:
+        def get_s3_client(aws_access, aws_secret, aws_region, max_pool_connections=10):
+            s3_client = boto3.client("s3", aws_access_key_id=aws_access, aws_secret_access_key=aws_secret, region_name=aws_region,
+                                     endpoint_url=server.url,
+                                     config=Config(max_pool_connections=max_pool_connections, s3={"addressing_style": "path"}))
+            fetch_asdi._instrument_client(s3_client)
+            return s3_client
+
+        download_file = fetch_asdi.download_file
+
+        def timed_download_file(*args, **kwargs):
+            size, elapsed = download_file(*args, **kwargs)
+            if size:
+                timings.add(elapsed, size)
+            return size, elapsed
+
+        fetch_asdi.get_s3_client = get_s3_client
+        fetch_asdi.download_file = timed_download_file
+        try:
+            start = time.perf_counter()
+            fetch_asdi.download_files(FORECAST_PUBLISH_DATE, "benchmark", "benchmark", "eu-west-2", BUCKET_NAME, PREFIX, FILE_NAME_FORMAT, workers=workers)
+            elapsed = time.perf_counter() - start
+        finally:
+            fetch_asdi.download_file = download_file
+        return _summarise("asdi", timings, elapsed, server)
+
+
+def bench_met_office(n_files, file_size, latency, workers):
+    """get_model_runs, get_order_details, get_files_by_run and download_files against the Data Hub stand-in"""
+    timings = _Timings()
+    with DataHubStandIn("dailyrainfallaccumulation", "08", n_files, file_size, latency) as server:
+        client = MetFileImporter()
+        client.BASE_URL = server.url
+        client.perfMode = False
+        client.printUrl = False
+        client.maxWorkers = workers
+
+        download_worker = client.download_worker
+
+        def timed_download_worker(downloadTask, fileDateString):
+            start = time.perf_counter()
+            file_path = download_worker(downloadTask, fileDateString)
+            if file_path is not None:
+                timings.add(time.perf_counter() - start, os.path.getsize(file_path))
+            return file_path
+
+        client.download_worker = timed_download_worker
+
+        start = time.perf_counter()
+        client.get_model_runs()
+        order = client.get_order_details()
+        client.download_files(client.get_files_by_run(order))
+        elapsed = time.perf_counter() - start
+        return _summarise("met_office", timings, elapsed, server)
+
+
+def compare(results, baseline, tolerance):
+    """Prints throughput against the baseline, returns False if any fetcher slowed down by more than tolerance"""
+    ok = True
+    for result in results:
+        previous = baseline.get(result["fetcher"])
+        if not previous:
+            continue
+        change = result["files_per_s"] / previous["files_per_s"] - 1 if previous["files_per_s"] else 0.0
+        regressed = change < -tolerance
+        ok = ok and not regressed
+        print(f'{result["fetcher"]:<12} {previous["files_per_s"]:>8} -> {result["files_per_s"]:<8} files/s '
+              f'({change:+.0%}){"  REGRESSION" if regressed else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ASDI and Met Office fetchers against local stand-ins.")
+    parser.add_argument("--files", type=int, default=48, help="Files per run")
+    parser.add_argument("--size-kb", type=int, default=1024, help="Size of each file in KB")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="Latency injected before every response")
+    parser.add_argument("--workers", type=int, default=fetch_asdi.DEFAULT_WORKERS, help="Concurrent downloads")
+    parser.add_argument("--only", choices=["asdi", "met_office"], help="Run a single fetcher")
+    parser.add_argument("--baseline", help="JSON results from an earlier run to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed fractional drop in files/s before failing")
+    parser.add_argument("--save-baseline", help="Write these results to a JSON file")
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    file_size = args.size_kb * 1024
+    results = []
+
+    # The fetchers write into data/ under the working directory, so run in a scratch folder
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            if args.only in (None, "asdi"):
+                results.append(bench_asdi(args.files, file_size, latency, args.workers))
+            if args.only in (None, "met_office"):
+                results.append(bench_met_office(args.files, file_size, latency, args.workers))
+        finally:
+            os.chdir(cwd)
+
+    print()
+    print(f'{"fetcher":<12}{"files":>7}{"files/s":>10}{"MB/s":>9}{"p50 ms":>9}{"p99 ms":>9}{"requests":>10}{"peak RSS MB":>13}')
+    for r in results:
+        print(f'{r["fetcher"]:<12}{r["files"]:>7}{r["files_per_s"]:>10}{r["mb_per_s"]:>9}{r["p50_ms"]:>9}{r["p99_ms"]:>9}'
+              f'{r["requests"]:>10}{r["peak_rss_mb"]:>13}')
+    print()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({r["fetcher"]: r for r in results}, f, indent=4)
+        print(f"Results saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
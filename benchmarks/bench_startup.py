@@ -0,0 +1,131 @@
+# bench_startup.py
+
+# Cold-start time of each cli.py command: a fresh interpreter running `cli.py <command> --help`, which is the import
+# and argument parsing cost every cron run of that command pays before doing any work.
+#
+#   python benchmarks/bench_startup.py --repeat 7
+#   python benchmarks/bench_startup.py --save-baseline benchmarks/startup.json
+#   python benchmarks/bench_startup.py --baseline benchmarks/startup.json   # exits 1 on a startup regression
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+CLI = os.path.join(SRC, "cli.py")
+sys.path.insert(0, SRC)
+
+from cli import COMMANDS
+
+CREDENTIALS = ("MET_OFFICE_API_KEY", "AWS_ACCESS", "AWS_SECRET", "AWS_REGION")
+
+
+def _clean_env():
+    """Environment without credentials, so a command that checks them on import fails the benchmark"""
+    return {name: value for name, value in os.environ.items() if name not in CREDENTIALS}
+
+
+def _import_times(args, env, cwd):
+    """{top-level module: cumulative import time in us} from python -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", *args], capture_output=True, text=True, env=env, cwd=cwd)
+    totals = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.startswith("  ") or not cumulative.strip().isdigit():
+            continue  # Nested import, already counted in its parent
+        name = name.strip()
+        totals[name] = totals.get(name, 0) + int(cumulative)
+    return totals
+
+
+def _heaviest_imports(totals, interpreter, n=3):
+    """The n slowest imports, leaving out those every interpreter makes on startup"""
+    heaviest = sorted(((name, us) for name, us in totals.items() if name not in interpreter), key=lambda item: item[1], reverse=True)
+    return ", ".join(f"{name} {us / 1000:.0f}" for name, us in heaviest[:n])
+
+
+def bench_command(args, repeat, env, cwd):
+    """Median and min wall time in ms of starting a fresh interpreter with args, and whether it exited 0"""
+    timings = []
+    ok = True
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, *args], capture_output=True, env=env, cwd=cwd)
+        timings.append(time.perf_counter() - start)
+        ok = ok and result.returncode == 0
+    return round(statistics.median(timings) * 1000, 1), round(min(timings) * 1000, 1), ok
+
+
+def compare(results, baseline, tolerance):
+    """Prints startup time against the baseline, returns False if any command got slower by more than tolerance"""
+    ok = True
+    for command, result in results.items():
+        previous = baseline.get(command)
+        if not previous:
+            continue
+        change = result["median_ms"] / previous["median_ms"] - 1 if previous["median_ms"] else 0.0
+        regressed = change > tolerance
+        ok = ok and not regressed
+        print(f'{command:<18} {previous["median_ms"]:>8} -> {result["median_ms"]:<8} ms '
+              f'({change:+.0%}){"  REGRESSION" if regressed else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold-start time of every cli.py command.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters started per command")
+    parser.add_argument("--only", choices=list(COMMANDS), nargs="*", help="Commands to measure (default: all)")
+    parser.add_argument("--baseline", help="JSON results from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed fractional increase in startup time before failing")
+    parser.add_argument("--save-baseline", help="Write these results to a JSON file")
+    args = parser.parse_args()
+
+    env = _clean_env()
+    results = {}
+    # Run from a scratch folder so no .env file is picked up
+    with tempfile.TemporaryDirectory() as scratch:
+        interpreter, _, _ = bench_command(["-c", "pass"], args.repeat, env, scratch)
+        interpreter_imports = _import_times(["-c", "pass"], env, scratch)
+        for command in args.only or COMMANDS:
+            median_ms, min_ms, ok = bench_command([CLI, command, "--help"], args.repeat, env, scratch)
+            results[command] = {
+                "median_ms": median_ms,
+                "min_ms": min_ms,
+                "ok": ok,
+                "heaviest_imports_ms": _heaviest_imports(_import_times([CLI, command, "--help"], env, scratch), interpreter_imports),
+            }
+
+    print()
+    print(f"Interpreter alone: {interpreter} ms")
+    print(f'{"command":<18}{"median ms":>10}{"min ms":>9}  heaviest imports (ms)')
+    for command, r in results.items():
+        print(f'{command:<18}{r["median_ms"]:>10}{r["min_ms"]:>9}  {r["heaviest_imports_ms"]}{"" if r["ok"] else "  FAILED"}')
+    print()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Results saved to {args.save_baseline}")
+
+    failed = [command for command, r in results.items() if not r["ok"]]
+    if failed:
+        print(f"Failed to start without credentials: {', '.join(failed)}")
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# stand_ins.py
+
+# Local HTTP stand-ins for the ASDI S3 bucket and the Met Office Data Hub, used by the benchmarks
+
+import hashlib
+import json
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+class _StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency  # Seconds added before every response, like a round trip to the real service
+        self.requests = 0
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count_request(self):
+        with self._count_lock:
+            self.requests += 1
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so connection reuse shows up in the numbers
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _send(self, status, body, content_type, extra_headers=None, head=False):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _send_bytes(self, body, etag, head=False):
+        """Serves body, honouring a single 'bytes=a-b' Range header the way S3 does"""
+        headers = {"ETag": etag, "Accept-Ranges": "bytes", "Last-Modified": formatdate(0, usegmt=True)}
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[len("bytes="):].partition("-")
+            first = int(first)
+            if first >= len(body):
+                return self._send(416, b"", "application/octet-stream", {"Content-Range": f"bytes */{len(body)}"}, head)
+            last = min(int(last) if last else len(body) - 1, len(body) - 1)
+            headers["Content-Range"] = f"bytes {first}-{last}/{len(body)}"
+            self._send(206, body[first:last + 1], "application/octet-stream", headers, head)
+        else:
+            self._send(200, body, "application/octet-stream", headers, head)
+
+
+def _payload(size):
+    """Deterministic, incompressible-ish bytes of the given size, generated once and shared by every file"""
+    block = hashlib.sha256(str(size).encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+class S3StandIn(_StandInServer):
+    """
+    Minimal S3 (ListObjectsV2, HeadObject, ranged GetObject) serving n_files objects of file_size bytes under each prefix.
+    Point a boto3 client at it with endpoint_url=server.url and path-style addressing. downloads counts the GetObjects.
+    """
+
+    def __init__(self, bucket, keys, file_size, latency=0.0):
+        self.bucket = bucket
+        self.keys = sorted(keys)
+        self.body = _payload(file_size)
+        self.etag = '"' + hashlib.md5(self.body).hexdigest() + '"'
+        self.downloads = 0
+        super().__init__(_S3Handler, latency)
+
+    def count_download(self):
+        with self._count_lock:
+            self.downloads += 1
+
+
+class _S3Handler(_Handler):
+
+    def do_GET(self):
+        self._delay()
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        path = unquote(url.path).lstrip("/")
+        bucket, _, key = path.partition("/")
+        if bucket != self.server.bucket:
+            return self._send(404, b"NoSuchBucket", "text/plain")
+        if not key and query.get("list-type") == "2":
+            return self._list(query)
+        return self._object(key)
+
+    def do_HEAD(self):
+        self._delay()
+        path = unquote(urlparse(self.path).path).lstrip("/")
+        self._object(path.partition("/")[2], head=True)
+
+    def _object(self, key, head=False):
+        if key not in self.server.keys:
+            return self._send(404, b"", "application/xml", head=head)
+        if not head:
+            self.server.count_download()
+        self._send_bytes(self.server.body, self.server.etag, head)
+
+    def _list(self, query):
+        prefix = query.get("prefix", "")
+        max_keys = int(query.get("max-keys", 1000))
+        after = query.get("continuation-token") or query.get("start-after") or ""
+        matching = [key for key in self.server.keys if key.startswith(prefix) and key > after]
+        page = matching[:max_keys]
+        truncated = len(matching) > max_keys
+
+        contents = "".join(
+            f"<Contents><Key>{escape(key)}</Key><LastModified>2024-01-01T00:00:00.000Z</LastModified>"
+            f"<ETag>{escape(self.server.etag)}</ETag><Size>{len(self.server.body)}</Size>"
+            f"<StorageClass>STANDARD</StorageClass></Contents>"
+            for key in page
+        )
+        next_token = f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>" if truncated else ""
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<Name>{self.server.bucket}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>"
+            f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(truncated).lower()}</IsTruncated>"
+            f"{contents}{next_token}</ListBucketResult>"
+        ).encode()
+        self._send(200, body, "application/xml")
+
+
+class DataHubStandIn(_StandInServer):
+    """
+    Minimal Met Office Data Hub atmospheric-models API: /runs/<model>, /orders/<order>/latest and
+    /orders/<order>/latest/<fileId>/data, serving n_files GRIB stand-ins of file_size bytes for the given run
+    under each order in orders (just order to start with).
+    The JSON documents carry an ETag and are answered with a 304 when a request's If-None-Match matches it;
+    not_modified counts those and downloads the data requests.
+    """
+
+    def __init__(self, order, run, n_files, file_size, latency=0.0):
+        self.order = order
+        self.orders = [order]
+        self.run = run
+        self.file_ids = [f"agl_rainfall-accumulation_{hour:02}_+{run}" for hour in range(n_files)]
+        self.body = _payload(file_size)
+        self.etag = '"' + hashlib.md5(self.body).hexdigest() + '"'
+        self.not_modified = 0
+        self.downloads = 0
+        super().__init__(_DataHubHandler, latency)
+
+    def count(self, name):
+        with self._count_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+class _DataHubHandler(_Handler):
+
+    def _send_document(self, document):
+        body = json.dumps(document).encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count("not_modified")
+            return self._send(304, b"", "application/json", {"ETag": etag})
+        self._send(200, body, "application/json", {"ETag": etag})
+
+    def do_GET(self):
+        self._delay()
+        parts = [unquote(part) for part in urlparse(self.path).path.strip("/").split("/")]
+        server = self.server
+
+        if len(parts) == 2 and parts[0] == "runs":
+            return self._send_document({"completeRuns": [{"run": server.run, "runDateTime": "2024-02-03T08:00:00Z"}]})
+
+        if len(parts) == 3 and parts[0] == "orders" and parts[1] in server.orders and parts[2] == "latest":
+            return self._send_document({"orderDetails": {"order": {"orderId": parts[1]},
+                                                         "files": [{"fileId": file_id} for file_id in server.file_ids]}})
+
+        if len(parts) == 5 and parts[0] == "orders" and parts[1] in server.orders and parts[2] == "latest" and parts[4] == "data":
+            if parts[3] in server.file_ids:
+                server.count("downloads")
+                return self._send_bytes(server.body, server.etag)
+
+        self._send(404, b"Not found", "text/plain")
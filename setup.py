@@ -1,18 +1,25 @@
 # Package repo for distribution
-from setuptools import setup, find_packages
+import glob
+import os
+
+from setuptools import setup
 
 setup(
     name="met",
     version="0.1.0",
-    packages=find_packages(),
+    # The scripts in src import each other as top-level modules (from config import require), so they're
+    # installed as top-level modules rather than as a package
+    package_dir={"": "src"},
+    py_modules=[os.path.splitext(os.path.basename(path))[0] for path in glob.glob("src/*.py")],
     install_requires=[
         "requests",
         "python-dotenv"
     ],
     entry_points={
         "console_scripts": [
-            "fetch-met-office=src.fetch_met_office:main",
-            "fetch-asdi=src.fetch_asdi:main"
+            "met=cli:main",
+            "fetch-met-office=fetch_met_office:main",
+            "fetch-asdi=fetch_asdi:main"
         ]
     },
     author="Alexander Hall",
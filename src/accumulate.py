@@ -0,0 +1,159 @@
+# accumulate.py
+
+# Streaming daily and rolling N-hour rainfall totals over a run's hourly ASDI files
+
+import argparse
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+import os
+
+import netCDF4 as nc
+import numpy as np
+
+from asdi_catalog import run_files
+from read_nc import RAINFALL_VARIABLE
+
+DEFAULT_WINDOWS = (3, 6)  # Rolling totals, in hours
+
+# One total: name is e.g. "PT03H" or "P1D", the accumulation covers the hours ending (start, end],
+# hours is how many hourly files went into it (a daily total at the start or end of a run can be short)
+Accumulation = namedtuple("Accumulation", ["name", "start", "end", "hours", "grid"])
+
+
+def _read_grid(path, variable, cache):
+    """One hourly grid as float32 with masked cells as NaN"""
+    if cache is not None:
+        return cache.get(path, variable)
+    with nc.Dataset(path) as dataset:
+        return np.ma.filled(dataset.variables[variable][:].astype("f4"), np.nan)
+
+
+class _Total:
+    """
+    Running total held in place: a float64 sum of the valid values plus a count of NaN hours per cell,
+    so hours can be subtracted again when they leave a rolling window without NaN sticking in the sum.
+    """
+
+    def __init__(self, shape):
+        self.sum = np.zeros(shape, dtype="f8")
+        self.missing = np.zeros(shape, dtype="i4")
+        self.hours = 0
+        self._nan = np.empty(shape, dtype=bool)
+        self._valid = np.empty(shape, dtype=bool)
+
+    def _masks(self, grid):
+        np.isnan(grid, out=self._nan)
+        np.logical_not(self._nan, out=self._valid)
+
+    def add(self, grid):
+        self._masks(grid)
+        np.add(self.sum, grid, out=self.sum, where=self._valid)
+        self.missing += self._nan
+        self.hours += 1
+
+    def subtract(self, grid):
+        self._masks(grid)
+        np.subtract(self.sum, grid, out=self.sum, where=self._valid)
+        self.missing -= self._nan
+        self.hours -= 1
+
+    def reset(self):
+        self.sum.fill(0)
+        self.missing.fill(0)
+        self.hours = 0
+
+    def result(self):
+        """The total as a new float32 grid, NaN wherever any hour was missing"""
+        grid = self.sum.astype("f4")
+        # Adding and subtracting can leave rounding noise just below zero
+        np.maximum(grid, 0, out=grid)
+        grid[self.missing > 0] = np.nan
+        return grid
+
+
+def accumulate(files, windows=DEFAULT_WINDOWS, daily=True, variable=RAINFALL_VARIABLE, cache=None):
+    """
+    Walks hourly accumulation files, a list of (lead_minutes, valid_time, path) in lead-time order as returned by
+    asdi_catalog.run_files, and yields an Accumulation for
+        each N-hour rolling window in windows, every hour once N consecutive hours are in it
+        each day (UTC, hours ending 01:00 to 00:00), once the run moves on to the next day or ends
+    in the order they complete.
+
+    Each hour is read once and added into a running buffer in place. When it leaves a rolling window it is read
+    again and subtracted, so only the file paths are kept, not the grids, and memory stays at a few grids however
+    long the forecast is. Pass a grid_cache.GridCache to make those re-reads a memory-mapped cache hit.
+    """
+    windows = sorted(set(int(hours) for hours in windows))
+    rolling = None
+    members = deque()  # (valid_time, path) of the hours in the longest window
+    day_total = None
+    day = None
+    day_start = None
+
+    last_valid = None
+    for _, valid_time, path in files:
+        grid = _read_grid(path, variable, cache)
+        if rolling is None:
+            rolling = {hours: _Total(grid.shape) for hours in windows}
+            day_total = _Total(grid.shape)
+
+        # A gap in the lead times breaks every rolling window
+        if last_valid is not None and valid_time - last_valid != timedelta(hours=1):
+            for total in rolling.values():
+                total.reset()
+            members.clear()
+        last_valid = valid_time
+
+        # The hour ending at valid_time belongs to the day it started in
+        hour_day = (valid_time - timedelta(hours=1)).date()
+        if daily and hour_day != day:
+            if day is not None and day_total.hours:
+                yield Accumulation("P1D", day_start, day_start + timedelta(days=1), day_total.hours, day_total.result())
+            day_total.reset()
+            day = hour_day
+            day_start = datetime.combine(hour_day, datetime.min.time(), tzinfo=valid_time.tzinfo)
+        if daily:
+            day_total.add(grid)
+
+        members.append((valid_time, path))
+        for hours, total in rolling.items():
+            total.add(grid)
+            if total.hours > hours:
+                # The hour that has just left this window, re-read rather than held in memory
+                total.subtract(_read_grid(members[-hours - 1][1], variable, cache))
+            if total.hours == hours:
+                yield Accumulation(f"PT{hours:02}H", valid_time - timedelta(hours=hours), valid_time, hours, total.result())
+        while windows and len(members) > windows[-1]:
+            members.popleft()
+
+    if daily and day is not None and day_total.hours:
+        yield Accumulation("P1D", day_start, day_start + timedelta(days=1), day_total.hours, day_total.result())
+
+
+def accumulate_run(run_folder, windows=DEFAULT_WINDOWS, daily=True, FILE_NAME_FORMAT="rainfall_accumulation-PT01H.nc",
+                   variable=RAINFALL_VARIABLE, cache=None):
+    """accumulate over the hourly files of a downloaded run folder, e.g. data/asdi/20240202T0000Z"""
+    return accumulate(run_files(run_folder, FILE_NAME_FORMAT), windows, daily, variable, cache)
+
+
+def main(argv=None, prog=None):
+
+    parser = argparse.ArgumentParser(prog=prog, description="Daily and rolling rainfall totals for a downloaded ASDI run.")
+    parser.add_argument("run_folder", help="Downloaded run folder, e.g. data/asdi/20240202T0000Z")
+    parser.add_argument("--windows", type=int, nargs="*", default=list(DEFAULT_WINDOWS), help="Rolling windows in hours")
+    parser.add_argument("--no-daily", action="store_true", help="Skip the daily totals")
+    parser.add_argument("--output", help="Folder to save each total to as <name>-<end>.npy")
+    parser.add_argument("--file-name-format", default="rainfall_accumulation-PT01H.nc", help="Hourly parameter to accumulate")
+    args = parser.parse_args(argv)
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    for result in accumulate_run(args.run_folder, args.windows, not args.no_daily, args.file_name_format):
+        print(f"{result.name} {result.start:%Y-%m-%d %H:%M} to {result.end:%Y-%m-%d %H:%M} ({result.hours}h): "
+              f"max {np.nanmax(result.grid) if np.isfinite(result.grid).any() else float('nan'):.2f}")
+        if args.output:
+            np.save(os.path.join(args.output, f"{result.name}-{result.end:%Y%m%dT%H%MZ}.npy"), result.grid)
+
+
+if __name__ == "__main__":
+    main()
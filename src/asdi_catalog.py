@@ -0,0 +1,262 @@
+# asdi_catalog.py
+
+# Persistent local catalog of the ASDI bucket, so runs don't have to be re-listed from S3
+
+import argparse
+from datetime import datetime
+import os
+import sqlite3
+import sys
+import threading
+
+DEFAULT_CATALOG_PATH = "data/asdi/catalog.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    run_time TEXT,
+    run_hour INTEGER,
+    valid_time TEXT,
+    lead_minutes INTEGER,
+    parameter TEXT,
+    size INTEGER,
+    etag TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_parameter_run ON objects (parameter, run_time);
+CREATE TABLE IF NOT EXISTS listings (
+    prefix TEXT PRIMARY KEY,
+    last_key TEXT
+);
+"""
+
+
+def _parse_time(time_str):
+    """20240203T0100Z -> datetime(2024, 2, 3, 1, 0)"""
+    return datetime.strptime(time_str, "%Y%m%dT%H%MZ")
+
+
+def _run_time_arg(value):
+    """argparse type for --run-start/--run-end, so a malformed time is a usage error rather than a traceback"""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid run time '{value}', expected 'YYYY-MM-DD HH:MM:SS'")
+
+
+def _parse_lead(lead_str):
+    """PT0025H00M -> 1500 (minutes)"""
+    hours, minutes = lead_str[2:-1].split("H")
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_key(key):
+    """
+    Splits an ASDI key into its metadata.
+
+    Example: parse_key("uk-deterministic-2km/20240202T0000Z/20240203T0100Z-PT0025H00M-rainfall_accumulation-PT01H.nc")
+    Returns: {"run_time": datetime(2024, 2, 2, 0, 0), "valid_time": datetime(2024, 2, 3, 1, 0),
+              "lead_minutes": 1500, "parameter": "rainfall_accumulation-PT01H.nc"}
+    Returns None if the key doesn't follow the naming convention.
+    """
+    parts = key.split("/")
+    if len(parts) != 3:
+        return None
+    meta = parse_file_name(parts[2])
+    if meta is None:
+        return None
+    try:
+        meta["run_time"] = _parse_time(parts[1])
+    except ValueError:
+        return None
+    return meta
+
+
+def parse_file_name(file_name):
+    """
+    Splits the file name part of an ASDI key (also the name of the downloaded file) into its metadata.
+
+    Example: parse_file_name("20240203T0100Z-PT0025H00M-rainfall_accumulation-PT01H.nc")
+    Returns: {"valid_time": datetime(2024, 2, 3, 1, 0), "lead_minutes": 1500, "parameter": "rainfall_accumulation-PT01H.nc"}
+    Returns None if the name doesn't follow the naming convention.
+    """
+    name_parts = file_name.split("-")
+    if len(name_parts) < 3:
+        return None
+    try:
+        return {
+            "valid_time": _parse_time(name_parts[0]),
+            "lead_minutes": _parse_lead(name_parts[1]),
+            "parameter": "-".join(name_parts[2:]),  # Same rule as fetch_asdi.checkFileName
+        }
+    except ValueError:
+        return None
+
+
+def run_files(run_folder, FILE_NAME_FORMAT):
+    """
+    Downloaded files in a run folder (e.g. data/asdi/20240202T0000Z) for one parameter, sorted by lead time.
+    Returns a list of (lead_minutes, valid_time, path).
+    """
+    files = []
+    if not os.path.isdir(run_folder):
+        return files
+    for file_name in os.listdir(run_folder):
+        meta = parse_file_name(file_name)
+        if meta is None or meta["parameter"] != FILE_NAME_FORMAT:
+            continue
+        files.append((meta["lead_minutes"], meta["valid_time"], os.path.join(run_folder, file_name)))
+    return sorted(files)
+
+
+class AsdiCatalog:
+    """
+    SQLite catalog of ASDI object keys and their parsed metadata (run time, valid time, lead time, parameter, size).
+    Refreshes are incremental: each prefix remembers the last key it listed and later refreshes list from there with StartAfter.
+    A full refresh re-lists the prefix, for when objects may have been republished under the same keys.
+    """
+
+    def __init__(self, path=DEFAULT_CATALOG_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Backfill lists runs from a background thread, so share one connection behind a lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def refresh(self, s3_client, bucket_name, prefix, full=False):
+        """
+        Lists keys under prefix added since the last refresh and stores them, returns the number of keys stored.
+
+        An incremental refresh never sees an object republished under an existing key, so its Size and ETag
+        would stay stale. full=True lists the whole prefix again instead, updating every key's Size and ETag
+        and dropping keys that are gone, which is what change detection (fetch_asdi --sync) needs.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT last_key FROM listings WHERE prefix = ?", (prefix,)).fetchone()
+        operation_parameters = {'Bucket': bucket_name, 'Prefix': prefix}
+        if row is not None and row["last_key"] and not full:
+            operation_parameters['StartAfter'] = row["last_key"]
+
+        n_new = 0
+        last_key = row["last_key"] if row is not None else None
+        listed = set()
+        for page in s3_client.get_paginator('list_objects_v2').paginate(**operation_parameters):
+            rows = []
+            for content in page.get('Contents', []):
+                last_key = content["Key"]  # Keys are listed in lexicographic order
+                listed.add(content["Key"])
+                meta = parse_key(content["Key"])
+                if meta is None:
+                    continue
+                rows.append((
+                    content["Key"],
+                    meta["run_time"].isoformat(sep=" "),
+                    meta["run_time"].hour,
+                    meta["valid_time"].isoformat(sep=" "),
+                    meta["lead_minutes"],
+                    meta["parameter"],
+                    content["Size"],
+                    content["ETag"],
+                ))
+            # Commit page by page so an interrupted refresh resumes where it stopped
+            with self._lock, self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self._conn.execute("INSERT OR REPLACE INTO listings VALUES (?, ?)", (prefix, last_key))
+            n_new += len(rows)
+
+        if full:
+            with self._lock, self._conn:
+                stored = [r["key"] for r in self._conn.execute("SELECT key FROM objects WHERE key >= ? AND key < ?",
+                                                                (prefix, prefix + "\uffff"))]
+                self._conn.executemany("DELETE FROM objects WHERE key = ?", [(key,) for key in stored if key not in listed])
+        return n_new
+
+    def query(self, parameter=None, run_start=None, run_end=None, run_hours=None, lead_min=None, lead_max=None, prefix=None):
+        """
+        Returns catalogued objects matching every filter given, ordered by run then lead time.
+
+        Example, all PT01H rainfall files for Feb 2024 runs at 00Z:
+            catalog.query(parameter="rainfall_accumulation-PT01H.nc",
+                          run_start=datetime(2024, 2, 1), run_end=datetime(2024, 2, 29, 23), run_hours=[0])
+        Lead times are in minutes.
+        """
+        clauses = []
+        params = []
+        if parameter is not None:
+            clauses.append("parameter = ?")
+            params.append(parameter)
+        if run_start is not None:
+            clauses.append("run_time >= ?")
+            params.append(run_start.isoformat(sep=" "))
+        if run_end is not None:
+            clauses.append("run_time <= ?")
+            params.append(run_end.isoformat(sep=" "))
+        if run_hours is not None:
+            run_hours = list(run_hours)
+            clauses.append(f"run_hour IN ({','.join('?' * len(run_hours))})")
+            params.extend(run_hours)
+        if lead_min is not None:
+            clauses.append("lead_minutes >= ?")
+            params.append(lead_min)
+        if lead_max is not None:
+            clauses.append("lead_minutes <= ?")
+            params.append(lead_max)
+        if prefix is not None:
+            # Keys under a prefix sort between prefix and prefix + the highest character
+            clauses.append("key >= ? AND key < ?")
+            params.extend([prefix, prefix + "\uffff"])
+
+        sql = "SELECT * FROM objects"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY run_time, lead_minutes"
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params)]
+
+
+def main(argv=None, prog=None):
+
+    parser = argparse.ArgumentParser(prog=prog, description="Query (and optionally refresh) the local ASDI catalog.")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="Path to the SQLite catalog")
+    parser.add_argument("--refresh", metavar="PREFIX", help="List new keys under PREFIX from S3 first, e.g. 'uk-deterministic-2km/20240202T0000Z/'")
+    parser.add_argument("--full", action="store_true", help="With --refresh, list every key under PREFIX again to pick up republished objects")
+    parser.add_argument("--parameter", help="File parameter, e.g. 'rainfall_accumulation-PT01H.nc'")
+    parser.add_argument("--run-start", type=_run_time_arg, help="First run time in 'YYYY-MM-DD HH:MM:SS' format")
+    parser.add_argument("--run-end", type=_run_time_arg, help="Last run time in 'YYYY-MM-DD HH:MM:SS' format")
+    parser.add_argument("--run-hours", help="Comma separated run hours, e.g. '00,12'")
+    args = parser.parse_args(argv)
+
+    catalog = AsdiCatalog(args.catalog)
+
+    if args.refresh:
+        from config import require
+        from fetch_asdi import get_s3_client
+        try:
+            AWS_ACCESS, AWS_SECRET, AWS_REGION = require("AWS_ACCESS", "AWS_SECRET", "AWS_REGION")
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        n_new = catalog.refresh(get_s3_client(AWS_ACCESS, AWS_SECRET, AWS_REGION), "met-office-atmospheric-model-data", args.refresh, full=args.full)
+        print(f"{'Listed' if args.full else 'Added'} {n_new} keys under {args.refresh}")
+
+    results = catalog.query(
+        parameter=args.parameter,
+        run_start=args.run_start,
+        run_end=args.run_end,
+        run_hours=[int(hour) for hour in args.run_hours.split(",")] if args.run_hours else None,
+    )
+    for row in results:
+        print(f'    {row["key"]}, {row["size"]/1024} KB')
+    print(f"{len(results)} files")
+
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# asdi_manifest.py
+
+# Local record of the ASDI objects that have already been downloaded
+
+import json
+import os
+import threading
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+class SyncManifest:
+    """
+    Manifest of downloaded ASDI objects for one drop folder (e.g. data/asdi/20240203T0600Z).
+    Each S3 key maps to the size, ETag and local path it was downloaded with, so an incremental
+    sync only transfers objects that are new or have changed since the last run.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILE_NAME)
+        self._lock = threading.Lock()  # download threads record files concurrently
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+
+    def is_current(self, content):
+        """True if the listed object (a list_objects_v2 Contents entry) is already downloaded and unchanged"""
+        entry = self.entries.get(content["Key"])
+        if entry is None:
+            return False
+        if entry["size"] != content["Size"] or entry["etag"] != content["ETag"]:
+            return False
+        # The file may have been deleted or truncated since it was recorded
+        local_path = entry["local_path"]
+        # local_size is set when the file was rewritten after download, e.g. by compact.py
+        return os.path.exists(local_path) and os.path.getsize(local_path) == entry.get("local_size", content["Size"])
+
+    def changed(self, contents):
+        """Filters listed objects down to those that are new or have changed"""
+        return [content for content in contents if not self.is_current(content)]
+
+    def record(self, content, local_path):
+        """Adds a downloaded object and writes the manifest so a crash never loses finished files"""
+        with self._lock:
+            self.entries[content["Key"]] = {
+                "size": content["Size"],
+                "etag": content["ETag"],
+                "local_path": local_path,
+            }
+            self._save()
+
+    def record_local_size(self, local_path, size):
+        """Notes that the downloaded file at local_path has been rewritten to a new size, so it still counts as current"""
+        with self._lock:
+            changed = False
+            for entry in self.entries.values():
+                if entry["local_path"] == local_path:
+                    entry["local_size"] = size
+                    changed = True
+            if changed:
+                self._save()
+
+    def remove(self, key):
+        """Forgets an object, e.g. after its local file has been deleted"""
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        # Write to a temporary file and rename so a crash mid-write leaves the old manifest intact
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,109 @@
+# build_cube.py
+
+# Consolidates a run's hourly ASDI files into a single chunked time-series cube
+
+import argparse
+import os
+
+import netCDF4 as nc
+import numpy as np
+
+from asdi_catalog import run_files
+from read_nc import data_variable, get_grid_index
+
+# Each chunk holds every lead time for a CUBE_CHUNK_XY x CUBE_CHUNK_XY block of cells,
+# so one location's full time series is a single chunk read and decompression
+CUBE_CHUNK_XY = 32
+CUBE_COMPRESSION_LEVEL = 4
+
+
+def cube_path(run_folder, FILE_NAME_FORMAT):
+    """Where the cube for a run and parameter lives, e.g. data/asdi/20240202T0000Z/rainfall_accumulation-PT01H.cube.nc"""
+    return os.path.join(run_folder, FILE_NAME_FORMAT[:-len(".nc")] + ".cube.nc")
+
+
+def build_cube(run_folder, FILE_NAME_FORMAT, variable=None, chunk_xy=CUBE_CHUNK_XY):
+    """
+    Stacks every lead time of a run into one compressed NetCDF4 file with dimensions
+    (lead_time, projection_y_coordinate, projection_x_coordinate). Returns the cube path, or None if the run has no files.
+    Masked cells are stored as NaN. variable defaults to the parameter's gridded field (read_nc.data_variable).
+    """
+    files = run_files(run_folder, FILE_NAME_FORMAT)
+    if not files:
+        print(f"No {FILE_NAME_FORMAT} files in {run_folder} to build a cube from")
+        return None
+
+    # Fill one preallocated array file by file rather than stacking a list of grids, so only one copy is held
+    with nc.Dataset(files[0][2]) as dataset:
+        x = dataset.variables["projection_x_coordinate"][:]
+        y = dataset.variables["projection_y_coordinate"][:]
+        variable = variable or data_variable(dataset)
+        var = dataset.variables[variable]
+        # The cube holds decoded floats, so packing attributes from a compacted file would scale them a second time
+        attrs = {name: var.getncattr(name) for name in var.ncattrs()
+                 if name not in ("_FillValue", "missing_value", "coordinates", "scale_factor", "add_offset")}
+    data = np.empty((len(files), len(y), len(x)), dtype="f4")
+    for i, (_, _, path) in enumerate(files):
+        with nc.Dataset(path) as dataset:
+            data[i] = np.ma.filled(dataset.variables[variable][:].astype("f4"), np.nan)
+
+    # xarray is only needed for writing the cube, and takes longer to import than everything else here
+    import xarray as xr
+    cube = xr.Dataset(
+        {variable: (("lead_time", "projection_y_coordinate", "projection_x_coordinate"), data, attrs)},
+        coords={
+            "lead_time": ("lead_time", np.array([lead for lead, _, _ in files], dtype="i4"), {"units": "minutes"}),
+            "valid_time": ("lead_time", np.array([valid for _, valid, _ in files], dtype="datetime64[ns]")),
+            "projection_y_coordinate": ("projection_y_coordinate", np.ma.getdata(y)),
+            "projection_x_coordinate": ("projection_x_coordinate", np.ma.getdata(x)),
+        },
+        attrs={"source_folder": run_folder, "parameter": FILE_NAME_FORMAT},
+    )
+    chunksizes = (len(files), min(chunk_xy, len(y)), min(chunk_xy, len(x)))
+    encoding = {variable: {"zlib": True, "complevel": CUBE_COMPRESSION_LEVEL, "shuffle": True,
+                           "chunksizes": chunksizes, "_FillValue": np.float32(np.nan)}}
+
+    # Write to a temporary name and rename, so readers never see a half-written cube
+    path = cube_path(run_folder, FILE_NAME_FORMAT)
+    tmp_path = path + ".tmp"
+    cube.to_netcdf(tmp_path, engine="netcdf4", format="NETCDF4", encoding=encoding)
+    os.replace(tmp_path, path)
+    print(f"Cube of {len(files)} lead times written to {path}")
+    return path
+
+
+def extract_points_cube(path, lats, lons, variable=None):
+    """
+    Extract the full time series at each lat/lon from a cube.
+    Returns (values, lead_times), values being a masked array of shape (points x lead times), masked for points
+    outside the grid.
+    """
+    with nc.Dataset(path) as dataset:
+        (y_idx, x_idx), outside = get_grid_index(dataset).locate(lats, lons)
+        var = dataset.variables[variable or data_variable(dataset)]
+        lead_times = dataset.variables["lead_time"][:]
+
+        # Each distinct cell's series sits in one chunk, read it once and scatter it to the points in that cell
+        flat = np.ravel_multi_index((y_idx, x_idx), var.shape[1:])
+        unique_cells, inverse = np.unique(flat, return_inverse=True)
+        series = np.ma.masked_all((len(unique_cells), len(lead_times)), dtype="f4")
+        for i, cell in enumerate(unique_cells):
+            y_cell, x_cell = divmod(int(cell), var.shape[2])
+            series[i] = var[:, y_cell, x_cell]
+    values = np.ma.masked_invalid(series[inverse])
+    values[outside] = np.ma.masked
+    return values, lead_times
+
+
+def main(argv=None, prog=None):
+
+    parser = argparse.ArgumentParser(prog=prog, description="Build a time-series cube from a downloaded ASDI run.")
+    parser.add_argument("run_folder", help="Downloaded run folder, e.g. data/asdi/20240202T0000Z")
+    parser.add_argument("--file-name-format", default="rainfall_accumulation-PT01H.nc", help="Parameter file name to stack")
+    args = parser.parse_args(argv)
+
+    build_cube(args.run_folder, args.file_name_format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# bulk_read.py
+
+# Decodes many downloaded ASDI files in parallel across a process pool
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+
+from asdi_catalog import parse_file_name, run_files
+from grid_cache import GridCache
+from read_nc import RAINFALL_VARIABLE, get_grid_index, get_grid_index_for_coords
+from regions import REGION_STATS, RegionIndex
+
+ASDI_FOLDER = "data/asdi"
+
+# Set in each worker by _init_worker, so the points and regions are sent once per process rather than once per file
+_worker = {}
+
+
+def resolve_files(files_or_runs, FILE_NAME_FORMAT="rainfall_accumulation-PT01H.nc", asdi_folder=ASDI_FOLDER):
+    """
+    Expands a mix of file paths, run folders and run names (e.g. "20240202T0000Z") into a flat list of files.
+    A run expands to its FILE_NAME_FORMAT files in lead-time order.
+    """
+    paths = []
+    for item in files_or_runs:
+        if os.path.isfile(item):
+            paths.append(item)
+            continue
+        run_folder = item if os.path.isdir(item) else os.path.join(asdi_folder, item)
+        paths.extend(path for _, _, path in run_files(run_folder, FILE_NAME_FORMAT))
+    return paths
+
+
+def _init_worker(lats, lons, regions, variable, cache_folder):
+    _worker["cache"] = GridCache(cache_folder) if cache_folder else None
+    _worker["lats"] = lats
+    _worker["lons"] = lons
+    _worker["regions"] = regions
+    _worker["variable"] = variable
+    _worker["grid"] = None  # (GridIndex, point cells, points outside the grid, RegionIndex) for the last grid seen
+
+
+def _grid_lookups(index):
+    """Point cells, points outside the grid and region index on this grid, only recomputed when a file is on a different grid"""
+    if _worker["grid"] is None or _worker["grid"][0] is not index:
+        cells, outside = index.locate(_worker["lats"], _worker["lons"]) if len(_worker["lats"]) else (None, None)
+        region_index = RegionIndex.from_regions(index, _worker["regions"])
+        _worker["grid"] = (index, cells, outside, region_index)
+    return _worker["grid"][1:]
+
+
+def _extract_file(path):
+    """
+    Runs in a worker: decodes one file and returns only the extracted values,
+    (point values, region stats), so whole grids never cross the process boundary.
+    """
+    variable = _worker["variable"]
+    cache = _worker["cache"]
+    if cache is not None:
+        index = get_grid_index_for_coords(*cache.coords(path))
+        grid = np.ma.masked_invalid(cache.get(path, variable))
+    else:
+        with nc.Dataset(path) as dataset:
+            index = get_grid_index(dataset)
+            grid = np.ma.asarray(dataset.variables[variable][:])
+
+    point_cells, outside, region_index = _grid_lookups(index)
+
+    point_values = None
+    if point_cells is not None:
+        point_values = np.ma.filled(grid[point_cells].astype("f4"), np.nan)
+        point_values[outside] = np.nan
+
+    return point_values, region_index.stats(grid)
+
+
+def bulk_extract(files_or_runs, lats=(), lons=(), regions=None, variable=RAINFALL_VARIABLE,
+                 FILE_NAME_FORMAT="rainfall_accumulation-PT01H.nc", workers=None, cache_folder=None):
+    """
+    Extracts points and region statistics from many files, fanning the decoding out over `workers` processes
+    (defaults to every core).
+
+    regions maps a name to a lat/lon bounding box (lat_min, lon_min, lat_max, lon_max) or a GeoJSON
+    Polygon/MultiPolygon geometry, see regions.RegionIndex.
+    With cache_folder set, workers read decoded grids through a grid_cache.GridCache in that folder.
+    Returns a dict with
+        "files":   the resolved file paths, in order
+        "points":  array of shape (points x files), NaN where masked
+        "regions": {name: array of shape (files x len(REGION_STATS))} holding mean, max and sum
+    """
+    paths = resolve_files(files_or_runs, FILE_NAME_FORMAT)
+    lats = np.asarray(lats, dtype="f8")
+    lons = np.asarray(lons, dtype="f8")
+    regions = dict(regions or {})
+
+    points = np.full((len(lats), len(paths)), np.nan, dtype="f4")
+    stats = np.full((len(paths), len(regions), len(REGION_STATS)), np.nan, dtype="f4")
+
+    if paths:
+        workers = workers or os.cpu_count() or 1
+        # A few files per task keeps the IPC overhead low while still balancing the load across workers
+        chunksize = max(1, len(paths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(lats, lons, regions, variable, cache_folder)) as executor:
+            for i, (point_values, region_stats) in enumerate(executor.map(_extract_file, paths, chunksize=chunksize)):
+                if point_values is not None:
+                    points[:, i] = point_values
+                stats[i] = region_stats
+
+    return {
+        "files": paths,
+        "points": points,
+        "regions": {name: stats[:, i] for i, name in enumerate(regions)},
+    }
+
+
+def _files_frame(paths, repeats):
+    """
+    Run date and time, valid time, lead time and parameter of each downloaded file, parsed from its name,
+    with the files repeated in order `repeats` times (once per point or region)
+    """
+    metas = [parse_file_name(os.path.basename(path)) or {} for path in paths]
+    valid_time = pd.to_datetime([meta.get("valid_time") for meta in metas])
+    lead_minutes = np.array([meta.get("lead_minutes", -1) for meta in metas], dtype="i4")
+    run_time = valid_time - pd.to_timedelta(lead_minutes, unit="min")
+    files = pd.DataFrame({
+        "run_date": run_time.strftime("%Y-%m-%d"),
+        "run_time": run_time,
+        "valid_time": valid_time,
+        "lead_minutes": lead_minutes,
+        "parameter": pd.Categorical([meta.get("parameter") for meta in metas]),
+    })
+    return files.iloc[np.tile(np.arange(len(paths)), repeats)].reset_index(drop=True)
+
+
+def points_frame(result, lats, lons, names=None):
+    """
+    Long table of a bulk_extract result, one row per location and file, with columns run_date, run_time,
+    valid_time, lead_minutes, parameter, location, lat, lon and value (float32, NaN where masked).
+    Locations are named by names, or by their position in lats/lons. Save it with utils.save_to_parquet.
+    """
+    n_points, n_files = result["points"].shape
+    names = [str(i) for i in range(n_points)] if names is None else [str(name) for name in names]
+    frame = _files_frame(result["files"], n_points)
+    frame["location"] = pd.Categorical.from_codes(np.repeat(np.arange(n_points), n_files), names)
+    frame["lat"] = np.repeat(np.asarray(lats, dtype="f8"), n_files)
+    frame["lon"] = np.repeat(np.asarray(lons, dtype="f8"), n_files)
+    frame["value"] = np.ma.filled(result["points"], np.nan).astype("f4").ravel()
+    return frame
+
+
+def regions_frame(result):
+    """
+    Long table of a bulk_extract result, one row per region and file, with the file columns of points_frame,
+    region, and a float32 column for each of REGION_STATS.
+    """
+    names = list(result["regions"])
+    n_files = len(result["files"])
+    frame = _files_frame(result["files"], len(names))
+    frame["region"] = pd.Categorical.from_codes(np.repeat(np.arange(len(names)), n_files), names)
+    stats = np.concatenate([result["regions"][name] for name in names]) if names else np.empty((0, len(REGION_STATS)))
+    for i, stat in enumerate(REGION_STATS):
+        frame[stat] = stats[:, i].astype("f4")
+    return frame
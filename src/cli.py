@@ -0,0 +1,53 @@
+# cli.py
+
+# One entry point for every command, e.g.
+#
+#   python cli.py fetch-asdi --date '2024-02-02 00:00:00' --sync
+#   python cli.py accumulate data/asdi/20240202T0000Z
+#
+# Only the module behind the chosen command is imported, so a command starts with just the libraries it uses
+# and credentials are only checked by the commands that need them.
+
+import importlib
+import os
+import sys
+
+# command: (module with a main(argv, prog) function, description)
+COMMANDS = {
+    "fetch-asdi": ("fetch_asdi", "Download ASDI forecast runs from S3, or backfill a range of them"),
+    "fetch-met-office": ("fetch_met_office", "Download the latest Met Office Data Hub forecast, or watch for new runs"),
+    "catalog": ("asdi_catalog", "Query (and optionally refresh) the local ASDI catalog"),
+    "cube": ("build_cube", "Stack a downloaded run into a time-series cube"),
+    "compact": ("compact", "Crop and quantize a downloaded run to save disk space"),
+    "accumulate": ("accumulate", "Daily and rolling rainfall totals for a downloaded run"),
+    "regions": ("regions", "Rainfall statistics for GeoJSON regions from a downloaded file"),
+    "serve": ("rain_service", "Serve batched rainfall point queries over HTTP"),
+    "retention": ("retention", "Evict old runs and files to keep the downloads within a size or age budget"),
+}
+
+
+def usage(prog="cli.py"):
+    width = max(len(command) for command in COMMANDS)
+    lines = [f"usage: {prog} <command> [options]", "", "commands:"]
+    lines += [f"  {command:<{width}}  {description}" for command, (_, description) in COMMANDS.items()]
+    lines += ["", f"Run '{prog} <command> --help' for the options of a command."]
+    return "\n".join(lines)
+
+
+def main(argv=None, prog=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    prog = prog or os.path.basename(sys.argv[0])  # cli.py, or met when run through the setup.py entry point
+    if not argv or argv[0] in ("-h", "--help"):
+        print(usage(prog))
+        return
+    command, rest = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(f"Unknown command '{command}'\n\n{usage(prog)}")
+        sys.exit(2)
+
+    module = importlib.import_module(COMMANDS[command][0])
+    module.main(rest, prog=f"{prog} {command}")
+
+
+if __name__ == "__main__":
+    main()
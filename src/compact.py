@@ -0,0 +1,188 @@
+# compact.py
+
+# Archival re-encoding of downloaded ASDI files: crop to a bounding box, quantize to scaled int16, rechunk
+
+import argparse
+from collections import namedtuple
+import os
+
+import netCDF4 as nc
+import numpy as np
+
+from asdi_catalog import run_files
+from read_nc import data_variable, get_grid_index
+
+X_DIM = "projection_x_coordinate"
+Y_DIM = "projection_y_coordinate"
+PACKED_FILL = np.int16(-32768)  # Packed values use -32767..32767, leaving this for masked cells
+PACKED_RANGE = 65534
+
+# bbox: lat/lon (lat_min, lon_min, lat_max, lon_max) to crop to, None to keep the full extent
+# precision: the largest error quantizing may add, in the variable's units (mm for rainfall)
+# variable: the field to quantize, None for the parameter's gridded field (read_nc.data_variable)
+Compaction = namedtuple("Compaction", ["bbox", "precision", "variable", "chunk_xy", "complevel"],
+                        defaults=[None, 0.01, None, 64, 6])
+
+
+def is_compacted(path):
+    with nc.Dataset(path) as dataset:
+        return "compaction_precision" in dataset.ncattrs()
+
+
+def _crop_slices(dataset, bbox):
+    """(y slice, x slice) of the smallest block of cells holding every cell centre inside bbox"""
+    if bbox is None:
+        return slice(None), slice(None)
+    mask = get_grid_index(dataset).bbox_mask(*bbox)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows) or not len(cols):
+        raise ValueError(f"Bounding box {bbox} doesn't overlap the grid")
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def _pack(values, precision):
+    """
+    Quantizes a masked float array to int16 with a step of 2 * precision, so rounding is never off by more than
+    precision. Returns (packed, scale_factor, add_offset), or raises ValueError if the values span more than
+    int16 can hold at that precision.
+    """
+    valid = values.compressed()
+    low = float(valid.min()) if valid.size else 0.0
+    high = float(valid.max()) if valid.size else 0.0
+
+    # Unpacking happens in float32, leave room in the step for its rounding at these magnitudes
+    margin = 4 * float(np.finfo("f4").eps) * (max(abs(low), abs(high)) + (high - low))
+    scale = np.float32(2 * (precision - margin))
+    half = PACKED_RANGE // 2
+    if scale <= 0 or (high - low) / scale > PACKED_RANGE - 2:
+        raise ValueError(f"Values from {low} to {high} don't fit in int16 at a precision of {precision}")
+
+    # Pack from zero when the values fit in half the range (rainfall usually does), keeping the offset small
+    if (high - low) / scale <= half - 1:
+        offset = np.float32(low)
+    else:
+        offset = np.float32(low + half * float(scale))
+    packed = np.round((np.ma.getdata(values).astype("f8") - float(offset)) / float(scale))
+    packed = np.clip(packed, -half, half)
+    packed = np.where(np.ma.getmaskarray(values), PACKED_FILL, packed).astype("i2")
+    return packed, scale, offset
+
+
+def compact_file(path, settings=Compaction()):
+    """
+    Rewrites a downloaded file in place: cropped to settings.bbox, settings.variable packed to int16 using CF
+    scale_factor/add_offset/_FillValue, and everything stored with chunks of settings.chunk_xy cells and
+    zlib compression. netCDF4 (and read_nc._decode for remote reads) unpack the variable transparently, and the
+    cropped projection coordinates keep point lookups working.
+    Returns the new file size, the file is left untouched if it's already compacted or can't be packed.
+    """
+    tmp_path = path + ".compact.tmp"
+    with nc.Dataset(path) as source:
+        if "compaction_precision" in source.ncattrs():
+            return os.path.getsize(path)
+        y_slice, x_slice = _crop_slices(source, settings.bbox)
+        try:
+            _write_compacted(source, tmp_path, y_slice, x_slice, settings)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def _write_compacted(source, tmp_path, y_slice, x_slice, settings):
+    packed_variable = settings.variable or data_variable(source)
+    with nc.Dataset(tmp_path, "w", format="NETCDF4") as target:
+        target.setncatts({name: source.getncattr(name) for name in source.ncattrs()})
+        for name, dimension in source.dimensions.items():
+            size = len(range(*{Y_DIM: y_slice, X_DIM: x_slice}.get(name, slice(None)).indices(len(dimension))))
+            target.createDimension(name, None if dimension.isunlimited() else size)
+
+        for name, variable in source.variables.items():
+            index = tuple({Y_DIM: y_slice, X_DIM: x_slice}.get(dim, slice(None)) for dim in variable.dimensions)
+            chunksizes = None
+            if X_DIM in variable.dimensions and Y_DIM in variable.dimensions:
+                chunksizes = [min(settings.chunk_xy, len(target.dimensions[dim])) if dim in (X_DIM, Y_DIM) else 1
+                              for dim in variable.dimensions]
+
+            if name == packed_variable:
+                attrs = {attr: variable.getncattr(attr) for attr in variable.ncattrs()
+                         if attr not in ("_FillValue", "scale_factor", "add_offset", "missing_value")}
+                packed, scale, offset = _pack(np.ma.asarray(variable[index]), settings.precision)
+                out = target.createVariable(name, "i2", variable.dimensions, zlib=True, complevel=settings.complevel,
+                                            shuffle=True, chunksizes=chunksizes, fill_value=PACKED_FILL)
+                out.set_auto_maskandscale(False)
+                out.setncatts(attrs)
+                out.setncatts({"scale_factor": scale, "add_offset": offset})
+                out[...] = packed
+            else:
+                # Everything else is copied as stored, packing and all
+                variable.set_auto_maskandscale(False)
+                attrs = {attr: variable.getncattr(attr) for attr in variable.ncattrs() if attr != "_FillValue"}
+                fill = variable.getncattr("_FillValue") if "_FillValue" in variable.ncattrs() else None
+                compress = bool(variable.dimensions) and variable.dtype != str
+                out = target.createVariable(name, variable.dtype, variable.dimensions, zlib=compress,
+                                            complevel=settings.complevel, shuffle=compress, chunksizes=chunksizes, fill_value=fill)
+                out.set_auto_maskandscale(False)
+                out.setncatts(attrs)
+                out[...] = variable[index]
+
+        target.setncatts({
+            "compaction_precision": settings.precision,
+            "compaction_bbox": "" if settings.bbox is None else ",".join(str(v) for v in settings.bbox),
+        })
+
+
+def compact_run(run_folder, FILE_NAME_FORMAT, settings=Compaction(), manifest=None):
+    """
+    Compacts every not yet compacted FILE_NAME_FORMAT file in a run folder.
+    The new sizes are recorded in manifest (an asdi_manifest.SyncManifest) so a sync doesn't download them again.
+    Returns (files compacted, bytes before, bytes after).
+    """
+    n_files, before, after = 0, 0, 0
+    for _, _, path in run_files(run_folder, FILE_NAME_FORMAT):
+        if is_compacted(path):
+            continue
+        size = os.path.getsize(path)
+        try:
+            new_size = compact_file(path, settings)
+        except ValueError as e:
+            print(f"Leaving {path} uncompacted: {e}")
+            continue
+        if manifest is not None:
+            manifest.record_local_size(path, new_size)
+        n_files += 1
+        before += size
+        after += new_size
+    if n_files:
+        print(f"Compacted {n_files} files in {run_folder}: {before/(1024*1024):.1f} MB -> {after/(1024*1024):.1f} MB "
+              f"({before / max(after, 1):.1f}x)")
+    return n_files, before, after
+
+
+def parse_bbox(text):
+    """'lat_min,lon_min,lat_max,lon_max' -> tuple of floats"""
+    bbox = tuple(float(v) for v in text.split(","))
+    if len(bbox) != 4:
+        raise ValueError("Bounding box needs lat_min,lon_min,lat_max,lon_max")
+    return bbox
+
+
+def main(argv=None, prog=None):
+
+    parser = argparse.ArgumentParser(prog=prog, description="Crop and quantize a downloaded ASDI run to save disk space.")
+    parser.add_argument("run_folder", help="Downloaded run folder, e.g. data/asdi/20240202T0000Z")
+    parser.add_argument("--bbox", type=parse_bbox, help="Crop to 'lat_min,lon_min,lat_max,lon_max'")
+    parser.add_argument("--precision", type=float, default=Compaction().precision, help="Largest quantizing error allowed")
+    parser.add_argument("--file-name-format", default="rainfall_accumulation-PT01H.nc", help="Parameter files to compact")
+    args = parser.parse_args(argv)
+
+    from asdi_manifest import SyncManifest
+    compact_run(args.run_folder, args.file_name_format, Compaction(args.bbox, args.precision), SyncManifest(args.run_folder))
+
+
+if __name__ == "__main__":
+    main()
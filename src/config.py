@@ -5,22 +5,15 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
-MET_OFFICE_API_KEY = os.getenv("MET_OFFICE_API_KEY")
 
-if not MET_OFFICE_API_KEY:
-    raise ValueError("Missing MET_OFFICE_API_KEY. Please set it in the .env file.")
-
-AWS_ACCESS = os.getenv("AWS_ACCESS")
-
-if not MET_OFFICE_API_KEY:
-    raise ValueError("Missing AWS_ACCESS. Please set it in the .env file.")
-
-AWS_SECRET = os.getenv("AWS_SECRET")
-
-if not MET_OFFICE_API_KEY:
-    raise ValueError("Missing AWS_SECRET. Please set it in the .env file.")
-
-AWS_REGION = os.getenv("AWS_REGION")
-
-if not MET_OFFICE_API_KEY:
-    raise ValueError("Missing AWS_REGION. Please set it in the .env file.")
\ No newline at end of file
+def require(*names):
+    """
+    Values of the named settings (e.g. "MET_OFFICE_API_KEY"), from the environment or the .env file.
+    Raises ValueError naming every one that isn't set. Called by each command when it needs the credentials,
+    rather than on import, so commands that don't use them run without them.
+    """
+    missing = [name for name in names if not os.getenv(name)]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}. Please set {'it' if len(missing) == 1 else 'them'} in the .env file.")
+    values = [os.getenv(name) for name in names]
+    return values[0] if len(values) == 1 else values
@@ -2,13 +2,30 @@
 
 # Script to fetch ASDI data
 
-import boto3
 import argparse
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import fnmatch
 import os
+import queue
 import sys
-import numpy as np
-from config import AWS_ACCESS, AWS_SECRET, AWS_REGION
+import threading
+import time
+from asdi_catalog import AsdiCatalog, DEFAULT_CATALOG_PATH
+from asdi_manifest import SyncManifest
+from config import require
+from telemetry import telemetry
+
+# Transfer settings used by download_files. The rainfall files are a few MB each so most
+# transfers are a single GET, larger parameters get split into parallel ranged GETs.
+DEFAULT_WORKERS = 8
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+
+# Number of runs that backfill lists ahead of the run currently downloading
+BACKFILL_PREFETCH = 2
 
 
 def _naming_convention(dt):
@@ -17,46 +34,132 @@ def _naming_convention(dt):
     return f"{dt.year:04}{dt.month:02}{dt.day:02}T{dt.hour:02}00Z"
 
 
-def paginator(aws_access, aws_secret, aws_region, bucket_name, prefix, forecast_publish_date, FILE_NAME_FORMAT, output="print"):
-    
-    """ 
-    Create paginator to read multiple bucket pages (which are limited to 1000)
-    More details on Pagination here: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/paginators.html
+def get_s3_client(aws_access, aws_secret, aws_region, max_pool_connections=10):
     """
-    
-    assert output == "print" or output == "np_arr", "output variable must be set to 'print' or 'np_arr'"
+    Create an S3 client that can be shared between download threads.
+    boto3 clients are thread safe, so one client (and its connection pool) is reused for every file.
+    """
+    # boto3 takes longer to import than the rest of the command, so it's left until a client is needed
+    import boto3
+    from botocore.config import Config
 
     s3_client = boto3.client(
         's3',
         aws_access_key_id = aws_access,
         aws_secret_access_key=aws_secret,
-        region_name=aws_region
+        region_name=aws_region,
+        config=Config(max_pool_connections=max_pool_connections)
     )
+    _instrument_client(s3_client)
+    return s3_client
+
+
+def _instrument_client(s3_client):
+    """
+    Hooks botocore events to record each S3 request in telemetry: time to first byte (request sent to
+    response headers parsed, the body is still streaming), and retries botocore made.
+    """
+    def before_send(request, **kwargs):
+        request.context["telemetry_start"] = time.perf_counter()
+
+    def after_call(parsed, context, model, **kwargs):
+        start = context.get("telemetry_start")
+        if start is not None:
+            telemetry.observe(f"asdi.{model.name}.ttfb", time.perf_counter() - start)
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            telemetry.count("asdi.retries", retries)
+
+    s3_client.meta.events.register("before-send.s3", before_send)
+    s3_client.meta.events.register("after-call.s3", after_call)
+
+
+def get_transfer_config(workers=DEFAULT_WORKERS):
+    """s3transfer settings for download_file, tuned for many small-to-medium NetCDF files"""
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        max_concurrency=MULTIPART_CONCURRENCY if workers > 1 else 10,
+        use_threads=True
+    )
+
+
+def paginator(aws_access, aws_secret, aws_region, bucket_name, prefix, forecast_publish_date, FILE_NAME_FORMAT, output="print", s3_client=None, catalog=None, relist=False):
+    
+    """ 
+    Create paginator to read multiple bucket pages (which are limited to 1000)
+    More details on Pagination here: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/paginators.html
+    FILE_NAME_FORMAT can be one parameter file name or a list of them (with shell-style wildcards), the run
+    prefix is listed once either way and each "contents" entry records the parameter it matched.
+    If an asdi_catalog.AsdiCatalog is given, only keys added since its last refresh are listed and the
+    matching files are read back from the catalog. relist makes that a full refresh of the run prefix, so the
+    Size and ETag of republished objects are current (needed by --sync's change detection).
+    """
+    
+    assert output in ("print", "np_arr", "contents"), "output variable must be set to 'print', 'np_arr' or 'contents'"
+
+    if s3_client is None:
+        s3_client = get_s3_client(aws_access, aws_secret, aws_region)
 
     date_str = _naming_convention(forecast_publish_date) # "20230203T0600Z"
 
-    paginator = s3_client.get_paginator('list_objects_v2')
-    operation_parameters = {'Bucket': bucket_name,
-                            'Prefix': prefix + date_str + "/"}
-    page_iterator = paginator.paginate(**operation_parameters)
+    start = time.perf_counter()
+    if catalog is not None:
+        run_prefix = prefix + date_str + "/"
+        with telemetry.timer("asdi.catalog.refresh"):
+            catalog.refresh(s3_client, bucket_name, run_prefix, full=relist)
+        # Patterns are matched below, the catalog can only filter on a single exact name
+        exact = FILE_NAME_FORMAT if isinstance(FILE_NAME_FORMAT, str) and not any(c in FILE_NAME_FORMAT for c in "*?[") else None
+        rows = catalog.query(parameter=exact, prefix=run_prefix)
+        page_iterator = [{'Contents': [{"Key": row["key"], "Size": row["size"], "ETag": row["etag"]} for row in rows]}]
+    else:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        operation_parameters = {'Bucket': bucket_name,
+                                'Prefix': prefix + date_str + "/"}
+        page_iterator = paginator.paginate(**operation_parameters)
     _arr = []
     for page_no, page in enumerate(page_iterator):
-        for content in page['Contents']:
+        telemetry.count("asdi.list.pages")
+        for content in page.get('Contents', []): # Runs that were never published have no contents
+                telemetry.count("asdi.list.keys")
                 correct_file_bool = checkFileName(content, FILE_NAME_FORMAT) # Returns true if correct file
                 if correct_file_bool:
+                    telemetry.count("asdi.list.matched")
                     if output == "print":
                         print(f'    {content["Key"]}, {content["Size"]/1024} KB')
                     elif output == "np_arr":
                         _arr.append(content["Key"])
+                    elif output == "contents":
+                        _arr.append({"Key": content["Key"], "Size": content["Size"], "ETag": content["ETag"],
+                                     "Parameter": key_parameter(content["Key"])})
+    telemetry.observe("asdi.list", time.perf_counter() - start)
     if output =="np_arr":
+        import numpy as np
         return np.array(_arr)
+    if output == "contents":
+        return _arr
         
                          
 
 
+def parameter_patterns(FILE_NAME_FORMAT):
+    """FILE_NAME_FORMAT as a tuple of patterns, whether it's one file name or several"""
+    if isinstance(FILE_NAME_FORMAT, str):
+        return (FILE_NAME_FORMAT,)
+    return tuple(FILE_NAME_FORMAT)
+
+
+def key_parameter(key):
+    """The parameter file name of a key, e.g. rainfall_accumulation-PT01H.nc"""
+    return "-".join(key.split("/")[2].split("-")[2:])
+
+
 def checkFileName(content, FILE_NAME_FORMAT):
-    """ Checks that the file in content is the same as FILE_NAME_FORMAT, returns bool"""
-    return "-".join(content["Key"].split("/")[2].split("-")[2:]) == FILE_NAME_FORMAT
+    """ Checks that the file in content matches FILE_NAME_FORMAT (one or more file names or patterns), returns bool"""
+    parameter = key_parameter(content["Key"])
+    return any(fnmatch.fnmatchcase(parameter, pattern) for pattern in parameter_patterns(FILE_NAME_FORMAT))
 
 
 def get_hours_and_minutes(start_time, end_time):
@@ -101,53 +204,307 @@ def date_file_key_str(forecast_publish_date, date2):
 
 
 
-def download_file(aws_access, aws_secret, aws_region, bucket_name, FILE_KEY, FILE_NAME_FORMAT, DROP_FOLDER):
+def download_file(aws_access, aws_secret, aws_region, bucket_name, FILE_KEY, FILE_NAME_FORMAT, DROP_FOLDER, s3_client=None, transfer_config=None):
     
-    """Download ASDI file to data/asdi."""
+    """
+    Download ASDI file to data/asdi.
+    Pass in a shared s3_client to reuse its connection pool, otherwise a new client is created.
+    Returns the number of bytes downloaded (0 on failure) and the time taken in seconds.
+    """
 
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id = aws_access,
-        aws_secret_access_key=aws_secret,
-        region_name=aws_region
-    )
+    if s3_client is None:
+        s3_client = get_s3_client(aws_access, aws_secret, aws_region)
 
     DROP_FILE = os.path.join(DROP_FOLDER,FILE_KEY.split("/")[2])
 
-
     # Download the file
+    start = time.perf_counter()
     try:
-        s3_client.download_file(bucket_name, FILE_KEY, DROP_FILE)
-        print(f"File downloaded successfully to {DROP_FILE}")
+        s3_client.download_file(bucket_name, FILE_KEY, DROP_FILE, Config=transfer_config)
     except Exception as e:
         print(f"Error downloading file: {e}")
+        telemetry.count("asdi.download.errors")
+        return 0, time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+
+    size = os.path.getsize(DROP_FILE)
+    telemetry.observe("asdi.download", elapsed)
+    telemetry.count("asdi.bytes", size)
+    telemetry.count("asdi.files_written")
+    print(f"File downloaded successfully to {DROP_FILE} ({size/1024:.1f} KB in {elapsed:.2f}s, {_mb_per_s(size, elapsed):.2f} MB/s)")
+
+    return size, elapsed
+
+
+def _mb_per_s(size, elapsed):
+    """Throughput in MB/s, guarding against a zero elapsed time"""
+    return size / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
 
     
-def download_files(forecast_publish_date, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, FILE_NAME_FORMAT):
+def _download_keys(executor, s3_client, transfer_config, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, contents, FILE_NAME_FORMAT, drop_folder, manifest, on_parameter_done=None):
+    """
+    Download listed objects into drop_folder using the executor's threads, recording each one in the manifest.
+    Objects are queued one parameter after another, and on_parameter_done(parameter, n_ok) is called as soon as
+    the last file of a parameter finishes, so its post-download stages overlap the other parameters' downloads.
+    Returns the number of files and bytes downloaded.
+    """
+    by_parameter = {}
+    for content in contents:
+        by_parameter.setdefault(content.get("Parameter", FILE_NAME_FORMAT), []).append(content)
+
+    futures = {}
+    for parameter, parameter_contents in by_parameter.items():
+        for content in parameter_contents:
+            future = executor.submit(download_file, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, content["Key"], parameter, drop_folder, s3_client, transfer_config)
+            futures[future] = (parameter, content)
+
+    remaining = Counter({parameter: len(parameter_contents) for parameter, parameter_contents in by_parameter.items()})
+    ok = Counter()
+    total_bytes = 0
+    for future in as_completed(futures):
+        size, _ = future.result()
+        parameter, content = futures[future]
+        if size:
+            manifest.record(content, os.path.join(drop_folder, content["Key"].split("/")[2]))
+            total_bytes += size
+            ok[parameter] += 1
+        remaining[parameter] -= 1
+        if remaining[parameter] == 0 and on_parameter_done is not None:
+            on_parameter_done(parameter, ok[parameter])
+    return sum(ok.values()), total_bytes
+
+
+def _sync_filter(manifest, contents, sync, forecast_date_str):
+    """In sync mode drop the objects the manifest says are already downloaded and unchanged"""
+    if not sync:
+        return contents
+    changed = manifest.changed(contents)
+    if len(changed) < len(contents):
+        print(f"Run {forecast_date_str}: skipping {len(contents) - len(changed)} files already downloaded")
+    return changed
+
+
+def _listed_parameters(contents):
+    """The parameters of listed objects, in first-listed order"""
+    return list(dict.fromkeys(content["Parameter"] for content in contents))
+
+
+def _post_download(drop_folder, FILE_NAME_FORMAT, n_ok, cube, compact=None, manifest=None):
+    """Stages that run once a run's files for one parameter (FILE_NAME_FORMAT) are downloaded"""
+    if compact is not None:
+        from compact import compact_run # Only import the compaction code when it's wanted
+        compact_run(drop_folder, FILE_NAME_FORMAT, compact, manifest)
+    if cube:
+        from build_cube import build_cube, cube_path # Only import xarray when cubes are wanted
+        if n_ok > 0 or not os.path.exists(cube_path(drop_folder, FILE_NAME_FORMAT)):
+            build_cube(drop_folder, FILE_NAME_FORMAT)
+
+
+def _shared_transfer(AWS_ACCESS, AWS_SECRET, AWS_REGION, workers):
+    """One client for every download, with enough pooled connections for each worker's multipart threads"""
+    transfer_config = get_transfer_config(workers)
+    s3_client = get_s3_client(AWS_ACCESS, AWS_SECRET, AWS_REGION, max_pool_connections=workers * transfer_config.max_request_concurrency)
+    return s3_client, transfer_config
+
+
+def download_files(forecast_publish_date, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, FILE_NAME_FORMAT, workers=DEFAULT_WORKERS, sync=False, catalog=None, cube=False, compact=None):
+
+    """
+    Downloads all forecast files from a specific date, with specified file name (e.g. rainfall_accumulation-PT01H.nc)
+    FILE_NAME_FORMAT can also be a list of file names or patterns (e.g. ["rainfall_accumulation-PT01H.nc", "temperature_*"]):
+    the run is listed once and every matching file goes through the same download pipeline into the run folder.
+    Files are downloaded concurrently by `workers` threads sharing one S3 client, set workers=1 to download one at a time.
+    With sync=True only files that are new or changed since the last download (per the run's manifest) are transferred.
+    Pass an asdi_catalog.AsdiCatalog to list the run from the local catalog instead of re-listing it from S3.
+    With cube=True the run's lead times are then stacked into a time-series cube (see build_cube.py).
+    Pass a compact.Compaction to crop and quantize the downloaded files for archiving (see compact.py).
+    """
 
-    """Downloads all forecast files from a specific date, with specified file name (e.g. rainfall_accumulation-PT01H.nc)"""
+    workers = max(1, int(workers))
+    s3_client, transfer_config = _shared_transfer(AWS_ACCESS, AWS_SECRET, AWS_REGION, workers)
 
     # Get list of file names from this date, with correct file name
-    np_arr = paginator(AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, forecast_publish_date, FILE_NAME_FORMAT,output="np_arr")
+    contents = paginator(AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, forecast_publish_date, FILE_NAME_FORMAT,output="contents", s3_client=s3_client, catalog=catalog, relist=sync)
 
-    # Create folder in data/ to house output
+    # Create folder in data/ to house output, existing files are overwritten unless sync is set
     forecast_date_str = _naming_convention(forecast_publish_date)
-    os.makedirs(f"data/asdi/{forecast_date_str}",exist_ok=True) # Errors if the file already exists in data/asdi
+    drop_folder = f"data/asdi/{forecast_date_str}"
+    os.makedirs(drop_folder,exist_ok=True)
+    manifest = SyncManifest(drop_folder)
+    parameters = _listed_parameters(contents)
+    contents = _sync_filter(manifest, contents, sync, forecast_date_str)
 
-    # Loop through files in np_arr and dowload into new directory
-    for FILE_KEY in np_arr:
-        download_file(AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, FILE_KEY, FILE_NAME_FORMAT, f"data/asdi/{forecast_date_str}")
+    # Each parameter's post-download stages run as soon as its last file lands
+    def parameter_done(parameter, n_ok):
+        parameters.remove(parameter)
+        _post_download(drop_folder, parameter, n_ok, cube, compact, manifest)
 
+    # Loop through files in contents and dowload into new directory
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        n_ok, total_bytes = _download_keys(executor, s3_client, transfer_config, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, contents, FILE_NAME_FORMAT, drop_folder, manifest, parameter_done)
+    elapsed = time.perf_counter() - start
 
+    print(f"Downloaded {n_ok}/{len(contents)} files, {total_bytes/(1024*1024):.1f} MB in {elapsed:.2f}s "
+          f"({_mb_per_s(total_bytes, elapsed):.2f} MB/s, {workers} workers)")
 
-if __name__ == "__main__":
+    # Parameters with nothing new to download
+    for parameter in parameters:
+        _post_download(drop_folder, parameter, 0, cube, compact, manifest)
+
+
+def forecast_runs(start_date, end_date, runs):
+    """
+    Yields the forecast publish datetimes from start_date to end_date (inclusive) for each run hour in runs.
+    Generated lazily so a long range never has to be held in memory.
+    """
+    day = datetime(start_date.year, start_date.month, start_date.day)
+    while day <= end_date:
+        for hour in sorted(runs):
+            dt = day + timedelta(hours=hour)
+            if start_date <= dt <= end_date:
+                yield dt
+        day += timedelta(days=1)
+
+
+def backfill(start_date, end_date, runs, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, FILE_NAME_FORMAT, workers=DEFAULT_WORKERS, prefetch=BACKFILL_PREFETCH, sync=False, catalog=None, cube=False, compact=None):
+
+    """
+    Downloads every forecast run between start_date and end_date in a single process.
+
+    A listing thread pages through upcoming runs while the current run downloads. At most `prefetch`
+    listed runs wait in the queue and every request goes through one S3 client with a fixed
+    connection pool, so memory and open connections stay bounded however long the range is.
+    With sync=True a re-run only transfers files that are missing or changed, so resuming after a crash is cheap.
+    """
+
+    workers = max(1, int(workers))
+    s3_client, transfer_config = _shared_transfer(AWS_ACCESS, AWS_SECRET, AWS_REGION, workers)
+
+    listed = queue.Queue(maxsize=max(1, prefetch))
+
+    def list_runs():
+        try:
+            for forecast_publish_date in forecast_runs(start_date, end_date, runs):
+                try:
+                    contents = paginator(AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, forecast_publish_date, FILE_NAME_FORMAT, output="contents", s3_client=s3_client, catalog=catalog, relist=sync)
+                except Exception as e:
+                    print(f"Error listing run {_naming_convention(forecast_publish_date)}: {e}")
+                    continue
+                listed.put((forecast_publish_date, contents))
+        finally:
+            listed.put(None) # Tell the download loop there are no more runs
+
+    lister = threading.Thread(target=list_runs, name="asdi-lister", daemon=True)
+    lister.start()
+
+    start = time.perf_counter()
+    n_runs = 0
+    n_files = 0
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            item = listed.get()
+            if item is None:
+                break
+            forecast_publish_date, contents = item
+            forecast_date_str = _naming_convention(forecast_publish_date)
+            if len(contents) == 0:
+                print(f"No files found for run {forecast_date_str}")
+                continue
+
+            drop_folder = f"data/asdi/{forecast_date_str}"
+            os.makedirs(drop_folder, exist_ok=True)
+            manifest = SyncManifest(drop_folder)
+            parameters = _listed_parameters(contents)
+            contents = _sync_filter(manifest, contents, sync, forecast_date_str)
+
+            def parameter_done(parameter, n_ok):
+                parameters.remove(parameter)
+                _post_download(drop_folder, parameter, n_ok, cube, compact, manifest)
+
+            run_start = time.perf_counter()
+            n_ok, run_bytes = _download_keys(executor, s3_client, transfer_config, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, contents, FILE_NAME_FORMAT, drop_folder, manifest, parameter_done)
+            run_elapsed = time.perf_counter() - run_start
+            if contents:
+                print(f"Run {forecast_date_str}: {n_ok}/{len(contents)} files, {run_bytes/(1024*1024):.1f} MB in {run_elapsed:.2f}s "
+                      f"({_mb_per_s(run_bytes, run_elapsed):.2f} MB/s)")
+            for parameter in parameters:
+                _post_download(drop_folder, parameter, 0, cube, compact, manifest)
+            if not contents:
+                continue
+
+            n_runs += 1
+            n_files += n_ok
+            total_bytes += run_bytes
+    lister.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"Backfill downloaded {n_files} files from {n_runs} runs, {total_bytes/(1024*1024):.1f} MB in {elapsed:.2f}s "
+          f"({_mb_per_s(total_bytes, elapsed):.2f} MB/s, {workers} workers)")
+
+
+
+def main(argv=None, prog=None):
     
     # Set up argument parsing
-    parser = argparse.ArgumentParser(description="Download files based on forecast publish date.")
-    parser.add_argument("--date", required=True, help="The forecast publish date in 'YYYY-MM-DD HH:MM:SS' format")
+    parser = argparse.ArgumentParser(prog=prog, description="Download files based on forecast publish date.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--date", help="The forecast publish date in 'YYYY-MM-DD HH:MM:SS' format")
+    group.add_argument("--start", help="Backfill: first forecast publish day in 'YYYY-MM-DD' format")
+    parser.add_argument("--end", help="Backfill: last forecast publish day in 'YYYY-MM-DD' format (defaults to --start)")
+    parser.add_argument("--runs", default="00", help="Backfill: comma separated run hours to fetch each day, e.g. '00,06,12,18'")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of files to download concurrently")
+    parser.add_argument("--sync", action="store_true", help="Only download files that are new or changed since the last download")
+    parser.add_argument("--cube", action="store_true", help="Stack each downloaded run into a chunked time-series cube")
+    parser.add_argument("--metrics", help="Write telemetry at the end of the run, Prometheus text if the path ends in .prom, otherwise JSON")
+    parser.add_argument("--catalog", action="store_true", help=f"List runs through the local catalog at {DEFAULT_CATALOG_PATH}")
+    parser.add_argument("--parameters", default="rainfall_accumulation-PT01H.nc",
+                        help="Comma separated parameter file names or patterns to fetch in one pass, e.g. 'rainfall_accumulation-PT01H.nc,temperature_*'")
+    parser.add_argument("--compact", action="store_true", help="Crop and quantize downloaded files to int16 to save disk space")
+    parser.add_argument("--compact-bbox", help="With --compact, crop to 'lat_min,lon_min,lat_max,lon_max' (default: keep the full extent)")
+    parser.add_argument("--compact-precision", type=float, default=0.01, help="With --compact, the largest quantizing error allowed")
 
     # Parse the arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    # Only checked now, so --help and argument errors don't need credentials
+    try:
+        AWS_ACCESS, AWS_SECRET, AWS_REGION = require("AWS_ACCESS", "AWS_SECRET", "AWS_REGION")
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    BUCKET_NAME = "met-office-atmospheric-model-data"
+    PREFIX = "uk-deterministic-2km/"
+    FILE_NAME_FORMAT = args.parameters.split(",") if "," in args.parameters else args.parameters
+    CATALOG = AsdiCatalog() if args.catalog else None
+    COMPACT = None
+    if args.compact:
+        from compact import Compaction, parse_bbox
+        try:
+            COMPACT = Compaction(parse_bbox(args.compact_bbox) if args.compact_bbox else None, args.compact_precision)
+        except ValueError:
+            print("Incorrect --compact-bbox. Please use 'lat_min,lon_min,lat_max,lon_max'")
+            sys.exit(1)
+
+    if args.start:
+        # Parse the backfill range
+        try:
+            START_DATE = datetime.strptime(args.start, "%Y-%m-%d")
+            END_DATE = datetime.strptime(args.end or args.start, "%Y-%m-%d") + timedelta(hours=23)
+            RUNS = [int(run) for run in args.runs.split(",")]
+        except ValueError:
+            print("Incorrect backfill range. Please use 'YYYY-MM-DD' for --start/--end and e.g. '00,12' for --runs")
+            sys.exit(1)
+        if any(run < 0 or run > 23 for run in RUNS):
+            print("Run hours must be between 00 and 23")
+            sys.exit(1)
+
+        backfill(START_DATE, END_DATE, RUNS, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, FILE_NAME_FORMAT, workers=args.workers, sync=args.sync, catalog=CATALOG, cube=args.cube, compact=COMPACT)
+        if args.metrics:
+            telemetry.export(args.metrics)
+        return
 
     # Parse the date argument
     try:
@@ -155,11 +512,13 @@ if __name__ == "__main__":
     except ValueError:
         print("Incorrect date format. Please use 'YYYY-MM-DD HH:MM:SS'")
         sys.exit(1)
-
-    BUCKET_NAME = "met-office-atmospheric-model-data"
-    PREFIX = "uk-deterministic-2km/"
-    FILE_NAME_FORMAT = "rainfall_accumulation-PT01H.nc"
     
     # FORECAST_PUBLISH_DATE = datetime(2024,2,3,6)
 
-    download_files(FORECAST_PUBLISH_DATE, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, FILE_NAME_FORMAT)
\ No newline at end of file
+    download_files(FORECAST_PUBLISH_DATE, AWS_ACCESS, AWS_SECRET, AWS_REGION, BUCKET_NAME, PREFIX, FILE_NAME_FORMAT, workers=args.workers, sync=args.sync, catalog=CATALOG, cube=args.cube, compact=COMPACT)
+    if args.metrics:
+        telemetry.export(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,45 @@
 # Tweaked from https://github.com/MetOffice/weather_datahub_utilities/blob/main/atmospheric_order_download/cda_download.py
 # Script to fetch met office data
 
-from datetime import datetime
-import inspect
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+import json
 import requests
+from requests.adapters import HTTPAdapter
 import sys
+import threading
 import time
-import traceback
 import os
-from config import MET_OFFICE_API_KEY
+from config import require
+from rate_limit import RETRY_STATUS_CODES, RateLimiter, backoff_time, request_with_retry, retry_after_seconds
+from telemetry import telemetry
+
+DECODED_SUFFIX = ".decoded"  # Left in place of a .grib2 file deleted once decoded (ingest set, keepGrib off)
+
+
+def _content_range(response):
+    """(first byte, total size) from a 206 response's Content-Range, total is None if the server doesn't know it"""
+    unit, _, spec = response.headers.get("Content-Range", "").partition(" ")
+    byte_range, _, total = spec.partition("/")
+    first, _, _ = byte_range.partition("-")
+    if unit != "bytes" or not first.isdigit():
+        return None, None
+    return int(first), int(total) if total.isdigit() else None
+
 
 class MetFileImporter:
     def __init__(self):
 
         # Initialize variables
         self.MODEL_LIST = ["mo-uk-latlon"]
+        self.ORDER_LIST = []  # Orders to fetch together, empty for just self.order
+        self.RUN_LIST = []  # Runs to fetch together, e.g. ["00", "06", "12", "18"], empty for just self.run
         self.BASE_URL = "https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0"
-        self.fillgaps = False
+        self.fillgaps = False  # Skip files that are already downloaded, rather than downloading them again
         self.verbose = False
         self.debugMode = False
-        self.perfMode = True
+        self.perfMode = True  # Print a summary of the stage timings from telemetry once the downloads finish
         self.printUrl = True
         self.retryCount = 3
         self.verifySSL = True
@@ -28,57 +48,139 @@ class MetFileImporter:
         self.useEnhancedApi = True
         self.run = "08"  # Time when model is released (8am UTC)
         self.numFilesPerOrder = 0
+        self.maxWorkers = 8  # Maximum number of files downloaded (requests in flight) at once
+        self.requestsPerSecond = 5.0  # Data Hub request rate shared by all workers, halved on every 429
+        self.backoffBase = 1.0  # Seconds, doubled (with jitter) on each retry
+        self.backoffCap = 60.0
+        self.chunkSize = 1024 * 1024  # Bytes read from the socket and written to disk at a time
+        self.ingest = None  # grib_stream.GribIngest to decode each file into while it downloads
+        self.keepGrib = True  # With ingest set, False keeps only the decoded fields and a .decoded marker, not the .grib2 files
+        self.pollInterval = 15 * 60  # Seconds between watch polls away from the expected publish time
+        self.pollIntervalNearRun = 60  # Seconds between watch polls while the run is due
+        self.runWindow = (timedelta(minutes=15), timedelta(hours=3))  # When the run is due, before/after its hour
 
         # File drop location
         self.baseFolder = "data/met_forecasts"
         os.makedirs(self.baseFolder, exist_ok=True)
 
-        # Request header including API (from .env file)
+        # Request header including API (from .env file), raises ValueError if it isn't set
+        MET_OFFICE_API_KEY = require("MET_OFFICE_API_KEY")
         self.requestHeaders = {'apikey': MET_OFFICE_API_KEY}
         print(f"MET OFFICE API KEY IN FETCH DATA: {MET_OFFICE_API_KEY}")
 
-
-    def get_order_details(self):
-
-        if self.perfMode:
-            print("PM ", inspect.stack()[0][3], " started")
-            pmstart = datetime.now()
-
+        # Shared HTTP session and rate limiter, created on first use so the settings can be changed after init
+        self._session = None
+        self._limiter = None
+
+        # (ETag, Last-Modified, JSON) of the last response for each metadata URL, for conditional requests
+        self._validators = {}
+        # Full completeRuns list from the last get_model_runs call, per model
+        self.completeRuns = {}
+
+    @property
+    def session(self):
+        """requests.Session with a connection pool big enough for every download worker"""
+        if self._session is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self.maxWorkers))
+            self._session = requests.Session()
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+            self._session.verify = self.verifySSL
+        return self._session
+
+    @property
+    def limiter(self):
+        """Token bucket every request goes through, so concurrent workers share one Data Hub quota"""
+        if self._limiter is None:
+            self._limiter = RateLimiter(self.requestsPerSecond, burst=max(1, self.maxWorkers))
+        return self._limiter
+
+    def api_get(self, url, headers, name="metoffice.request", retries=None, **kwargs):
+        """
+        GET through the shared session and rate limiter, retrying connection errors, 429s (honouring Retry-After)
+        and 5xx responses up to retries (retryCount by default) times with jittered exponential backoff.
+        """
+        return request_with_retry(self.session, url, self.limiter, retries=self.retryCount if retries is None else retries,
+                                  backoff_base=self.backoffBase, backoff_cap=self.backoffCap,
+                                  name=name, headers=headers, **kwargs)
+
+    def get_json(self, url, headers, name="metoffice.request"):
+        """
+        api_get for a JSON document, sending the ETag/Last-Modified of the previous response for url as
+        If-None-Match/If-Modified-Since. On a 304 the previous document is reused rather than downloaded again.
+        Returns (response, document), document is None unless the status is 200 or 304.
+        """
+        headers = dict(headers)
+        etag, lastModified, cached = self._validators.get(url, (None, None, None))
+        if etag:
+            headers["If-None-Match"] = etag
+        if lastModified:
+            headers["If-Modified-Since"] = lastModified
+
+        response = self.api_get(url, headers=headers, name=name)
+        if response.status_code == 304 and cached is not None:
+            telemetry.count(name + ".not_modified")
+            return response, cached
+        if response.status_code != 200:
+            return response, None
+
+        document = response.json()
+        if response.headers.get("ETag") or response.headers.get("Last-Modified"):
+            self._validators[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"), document)
+        return response, document
+
+    def _failure(self, exc):
+        """How a request failed, for error messages: its status, and whether it was retried first"""
+        response = getattr(exc, "response", None)
+        if response is not None and response.status_code in RETRY_STATUS_CODES:
+            return f"with status {response.status_code} after {self.retryCount} retries"
+        if response is not None:
+            return f"with status {response.status_code}"
+        if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+            return f"after {self.retryCount} retries"
+        return "(" + type(exc).__name__ + ")"
+
+    def orders(self):
+        return self.ORDER_LIST or [self.order]
+
+    def runs(self):
+        return self.RUN_LIST or [self.run]
+
+    def get_order_details(self, order=None):
+
+        pmstart = time.perf_counter()
+
+        order = order or self.order
+        runs = self.runs()
         details = None
 
         actualHeaders = {"Accept": "application/json"}
         actualHeaders.update(self.requestHeaders)
 
-        url = self.BASE_URL + "/orders/" + self.order + "/latest"
+        url = self.BASE_URL + "/orders/" + order + "/latest"
         if self.useEnhancedApi:
             url = url + "?detail=MINIMAL"
-            url = url + "&runfilter=" + self.run
+            # With several runs the whole order is listed and get_files_by_run picks them out
+            if len(runs) == 1:
+                url = url + "&runfilter=" + runs[0]
 
         try:
-            req = requests.get(url, headers=actualHeaders, verify=self.verifySSL)
+            req, details = self.get_json(url, headers=actualHeaders, name="metoffice.get_order_details")
             req.raise_for_status()
         except Exception as exc:
-            print("EXCEPTION: get_order_details failed first time")
-            print(traceback.format_exc())
+            print("EXCEPTION: get_order_details failed " + self._failure(exc))
             print(exc)
-            time.sleep(5)
-            try:
-                req = requests.get(url, headers=actualHeaders, verify=self.verifySSL)
-                req.raise_for_status()
-            except Exception as exctwo:
-                print("EXCEPTION: get_order_details failed second time")
-                print(exctwo)
-                sys.exit(8)
+            sys.exit(8)
 
         if self.printUrl == True:
             print("get_order_details: ", url)
             if url != req.url:
                 print("redirected to: ", req.url)
 
-        if req.status_code != 200:
+        if details is None:
             print(
                 "ERROR: Unable to load details for order : ",
-                self.order,
+                order,
                 " status code: ",
                 req.status_code,
             )
@@ -86,262 +188,77 @@ class MetFileImporter:
             print("Text: ", req.text)
             print("URL:", url)
             sys.exit(6)
-        else:
-            details = req.json()
 
-        if self.perfMode:
-            pmend = datetime.now()
-            delta = round((pmend - pmstart).total_seconds() * 1000)
-            print(
-                "PM ",
-                inspect.stack()[0][3],
-                " executed in ",
-                str(delta),
-                "ms",
-                "API URL:",
-                url,
-            )
+        telemetry.observe("metoffice.get_order_details", time.perf_counter() - pmstart)
 
         return details
 
-    def get_model_runs(self):
-
-        modelRuns = {}
-
-        if self.perfMode:
-            print("PM ", inspect.stack()[0][3], " started")
-            pmstart = datetime.now()
+    def get_all_order_details(self):
+        """get_order_details for every order in ORDER_LIST, fetched concurrently, as {order: details}"""
+        orders = self.orders()
+        with ThreadPoolExecutor(max_workers=max(1, min(len(orders), self.maxWorkers))) as executor:
+            return dict(zip(orders, executor.map(self.get_order_details, orders)))
 
-        runHeaders = {"Accept": "application/json"}
-        runHeaders.update(self.requestHeaders)
+    def get_model_runs(self):
+        """Latest complete run of each model in MODEL_LIST, fetched concurrently, as {model: "run:runDateTime"}"""
 
-        for model in self.MODEL_LIST:
-            requrl = self.BASE_URL + "/runs/" + model + "?sort=RUNDATETIME"
-
-            for loop in range(self.retryCount):
-                if self.perfMode:
-                    print("PM ", inspect.stack()[0][3], " model=", model, " started ")
-                    pmstart2 = datetime.now()
-
-                try:
-                    reqr = requests.get(requrl, headers=runHeaders, verify=self.verifySSL)
-                    reqr.raise_for_status()
-                except Exception as exc:
-                    print("EXCEPTION: get_model_runs failed first time")
-                    print(traceback.format_exc())
-                    print(exc)
-                    time.sleep(5)
-                    try:
-                        reqr = requests.get(requrl, headers=runHeaders, verify=self.verifySSL)
-                        reqr.raise_for_status()
-                    except Exception as exctwo:
-                        print("EXCEPTION: get_model_runs failed second time")
-                        print(exctwo)
-                        #                   raise SystemError(exctwo)
-                        sys.exit(9)
-
-                if self.perfMode:
-                    pmend2 = datetime.now()
-                    delta2 = round((pmend2 - pmstart2).total_seconds() * 1000)
-                    print(
-                        "PM ",
-                        inspect.stack()[0][3],
-                        " model=",
-                        model,
-                        " executed in ",
-                        str(delta2),
-                        "ms",
-                        "API URL:",
-                        requrl,
-                    )
-
-                if self.printUrl == True:
-                    print("get_model_runs: ", requrl)
-                    if requrl != reqr.url:
-                        print("redirected to: ", reqr.url)
-
-                if reqr.status_code != 200:
-                    print(
-                        "ERROR:  Unable to get latest run for model: "
-                        + model
-                        + " status code: ",
-                        reqr.status_code,
-                    )
-                    if loop != (self.retryCount - 1):
-                        time.sleep(10)
-                        continue
-                    else:
-                        print("ERROR:  Ran out of retries to get latest run for model: ")
-                        break
+        pmstart = time.perf_counter()
 
-                rundetails = reqr.json()
-                rawlatest = rundetails["completeRuns"]
-                modelRuns[model] = rawlatest[0]["run"] + ":" + rawlatest[0]["runDateTime"]
-                break
-            # endFor=True
+        with ThreadPoolExecutor(max_workers=max(1, min(len(self.MODEL_LIST), self.maxWorkers))) as executor:
+            modelRuns = dict(zip(self.MODEL_LIST, executor.map(self.get_model_run, self.MODEL_LIST)))
 
-        if self.perfMode:
-            pmend = datetime.now()
-            delta = round((pmend - pmstart).total_seconds() * 1000)
-            print("PM ", inspect.stack()[0][3], " executed in ", str(delta), "ms")
+        telemetry.observe("metoffice.get_model_runs", time.perf_counter() - pmstart)
 
         return modelRuns
 
-    def get_files_by_run(self, order):
+    def get_model_run(self, model):
 
-        # Break down the files in to those needed for each run
-        filesByRun = {}
-        filesByRun[self.run] = []
-        fc = 0
-        for f in order["orderDetails"]["files"]:
-            fileId = f["fileId"]
-            if "_+" + self.run in fileId:
-                filesByRun[self.run].append(fileId)
-                fc += 1
-                if self.numFilesPerOrder > 0 and fc >= self.numFilesPerOrder:
-                    break
-
-        return filesByRun
+        runHeaders = {"Accept": "application/json"}
+        runHeaders.update(self.requestHeaders)
 
-    @staticmethod
-    def backoff_time_calculator(self, count, limit):
-        # fails limit values 5 and 30 used for get_order_file and get_my_orders respectively
-        if limit == 5:
-            match count:
-                case 1:
-                    return 5
-                case 2:
-                    return 10
-                case 3:
-                    return 15
-                case 4:
-                    return 30
-        elif limit == 30:
-            if count <= 5:
-                return 1
-            elif 5 < count <= 20:
-                return count / 2
-            elif 20 < count <= 30:
-                return 30
-
-    def get_order_file(
-            self,
-            fileId,
-            guidFileNames,
-            folder,
-            start,
-            backdatedDate,
-    ):
-        # If file id is too long or random file names required generate a uuid for the file name
-
-        urlMod = ""
-        global debugMode
-        global perfMode
-        global workerThreadsWaiting
-
-        if len(fileId) > 100 or guidFileNames:
-            local_filename = folder + "/" + str(uuid.uuid4()) + ".grib2"
-        else:
-            local_filename = folder + "/" + fileId + ".grib2"
-
-        ttfb = 0
-
-        if backdatedDate != "":
-            if debugMode == True:
-                print("DEBUG: We are in backdated Date mode for the date: " + backdatedDate)
-            fileId = fileId.replace("+", backdatedDate)
-            if debugMode == True:
-                print("DEBUG: New fileID is: " + fileId)
-
-        url = requests.utils.quote(self.BASE_URL + "/orders/" + self.order + "/latest/" + fileId + "/data", safe=': /')
-
-        if self.debugMode == True:
-            urlMod = input(
-                "Order: "
-                + self.order
-                + " File:"
-                + fileId
-                + "\n"
-                + "Enter y to mimic a receive failure on file - 'go' to run to end> "
-            )
-            # If you put go all further runs will automatically go through
-            if urlMod == "go":
-                self.debugMode = False
-            if self.debugMode == True and urlMod == "y":
-                url = (
-                        self.BASE_URL
-                        + "/orders/"
-                        + self.order
-                        + "/latest/"
-                        + fileId
-                        + urlMod
-                        + "/data"
-                )
-
-        actualHeaders = {"Accept": "application/x-grib"}
-        actualHeaders.update(self.requestHeaders)
+        requrl = self.BASE_URL + "/runs/" + model + "?sort=RUNDATETIME"
 
-        if perfMode:
-            pmstart3 = datetime.now()
+        pmstart2 = time.perf_counter()
 
-        failLimit = 30
-        failCount = 0
-        MyThread = threading.current_thread()
-        MyThreadName = MyThread.name
+        try:
+            reqr, rundetails = self.get_json(requrl, headers=runHeaders, name="metoffice.get_model_runs")
+            reqr.raise_for_status()
+            if rundetails is None:
+                raise requests.HTTPError(f"unexpected status {reqr.status_code}", response=reqr)
+        except Exception as exc:
+            print("EXCEPTION: get_model_runs failed " + self._failure(exc))
+            print(exc)
+            #                   raise SystemError(exctwo)
+            sys.exit(9)
 
-        if self.verbose:
-            print("get_order_file: ", MyThreadName, " Terminate value ", terminate)
+        telemetry.observe("metoffice.get_model_runs.request", time.perf_counter() - pmstart2)
 
-        while True:
+        if self.printUrl == True:
+            print("get_model_runs: ", requrl)
+            if requrl != reqr.url:
+                print("redirected to: ", reqr.url)
 
-            with requests.get(url, headers=actualHeaders, allow_redirects=True, stream=True, verify=self.verifySSL) as r:
-
-                if r.url.find("--") != -1:
-                    if self.verbose:
-                        print("-- found in redirect: ", r.url)
-
-                if self.printUrl == True:
-                    print("get_order_file: ", url)
-                    if url != r.url:
-                        print("redirected to: ", r.url)
-
-                if self.perfMode:
-                    pmend3 = datetime.now()
-                    delta3 = round((pmend3 - pmstart3).total_seconds() * 1000)
-                    if delta3 > int(self.perfTime) * 1000:
-                        print("PM ", url, " executed in ", str(delta3) + "ms")
-
-                if r.status_code != 200:
-                    failCount += 1
-                    print("ERROR: File download failed " + str(failCount) + " time(s).")
-                    print("Headers: ", r.headers)
-                    print("Text: ", r.text)
-                    print("URL:", url)
-                    print("Redirected URL:", r.url)
-
-                if r.status_code == 200:
-                    if self.verbose:
-                        print("get_order_file: Status code 200 - writing file with content length ", len(r.content))
-
-                    # Record time to first byte
-                    ttfb = start + r.elapsed.total_seconds()
-
-                    if os.path.exists(local_filename) == True:
-                        if self.fillGaps == True:
-                            if self.verbose:
-                                print("File: ", local_filename, " has already been downloaded")
-                            break
-                        else:
-                            os.remove(local_filename)
+        rawlatest = rundetails["completeRuns"]
+        self.completeRuns[model] = rawlatest
+        return rawlatest[0]["run"] + ":" + rawlatest[0]["runDateTime"]
 
-                    with open(local_filename, "wb") as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                        f.close()
+    def get_files_by_run(self, order, runs=None):
 
-                    break
+        # Break down the files in to those needed for each run (self.runs() by default) in one pass,
+        # reading the run from the "_+HH" suffix of each file id
+        runs = runs or self.runs()
+        filesByRun = {run: [] for run in runs}
+        for f in order["orderDetails"]["files"]:
+            fileId = f["fileId"]
+            _, found, suffix = fileId.rpartition("_+")
+            files = filesByRun.get(suffix[:2]) if found else None
+            if files is None:
+                continue
+            if self.numFilesPerOrder > 0 and len(files) >= self.numFilesPerOrder:
+                continue
+            files.append(fileId)
 
-        return [ttfb, local_filename]
+        return filesByRun
 
     def download_worker(self, downloadTask, fileDateString):
         try:
@@ -355,73 +272,322 @@ class MetFileImporter:
                 "+", "%2B") # encoding error with + signs
             file_path = os.path.join(folder, f"{fileId}_{fileDateString}.grib2")  # Customize file naming as needed
 
-            # Make the API call and save the file
-            response = requests.get(download_url, headers=headers, stream=True)
-            response.raise_for_status()  # Check for HTTP errors
-
-            with open(file_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            # Only complete files (or markers for decoded ones) are ever put in place, so an existing one can be skipped
+            if self.fillgaps and (os.path.exists(file_path) or os.path.exists(file_path + DECODED_SUFFIX)):
+                telemetry.count("metoffice.files_skipped")
+                if self.verbose:
+                    print(f"File {fileId} already downloaded to {file_path}")
+                if not os.path.exists(file_path):
+                    return file_path + DECODED_SUFFIX  # Decoded when it was downloaded, the results went then
+                if self.ingest is not None:
+                    self.ingest.feed_file(file_path, file_path, self.chunkSize)
+                    self.ingest.close(file_path)
+                return file_path
+
+            start = time.perf_counter()
+            self.fetch_to_file(download_url, headers, file_path)
+            telemetry.observe("metoffice.download", time.perf_counter() - start)
+            telemetry.count("metoffice.files_written")
 
             if self.verbose:
                 print(f"Downloaded file {fileId} to {file_path}")
+            return self.stored_path(file_path)
         except Exception as e:
+            telemetry.count("metoffice.download.errors")
             print(f"Error downloading file {fileId}: {e}")
+            return None
+
+
+    def fetch_to_file(self, url, headers, file_path, name="metoffice.download"):
+        """
+        Streams url into file_path + ".part" and renames it to file_path once its size matches the Content-Length,
+        so a file at file_path is always complete. If the connection drops the transfer resumes from the end of the
+        part file with a Range request rather than starting again from byte zero. Dropped connections, 429s and 5xx
+        responses share one budget of retryCount retries, so the request itself isn't also retried by api_get.
+        With self.ingest set, each chunk is also fed to it so GRIB messages are decoded while the file downloads.
+        Returns the size of the file.
+        """
+        partPath = file_path + ".part"
+        attempt = 0
+        while True:
+            retryAfter = None
+            offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+            requestHeaders = dict(headers)
+            if offset:
+                requestHeaders["Range"] = f"bytes={offset}-"
+
+            try:
+                start = time.perf_counter()
+                with self.api_get(url, headers=requestHeaders, name=name, retries=0, stream=True) as response:
+                    # With stream=True the call returns once the headers arrive
+                    telemetry.observe("metoffice.ttfb", time.perf_counter() - start)
+
+                    if response.status_code in RETRY_STATUS_CODES:
+                        retryAfter = retry_after_seconds(response)
+                        if response.status_code == 429:
+                            self.limiter.throttled(retryAfter)
+                        raise IOError(f"status {response.status_code}")
+
+                    if response.status_code == 416:
+                        # Either the part file was complete but never renamed, or the file on the server has changed
+                        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                        if total.isdigit() and int(total) == offset:
+                            if self.ingest is not None:
+                                self.ingest.feed_file(file_path, partPath, self.chunkSize)
+                            self._finish_file(partPath, file_path)
+                            return offset
+                        os.remove(partPath)
+                        raise IOError("requested range not satisfiable, restarting download")
+                    response.raise_for_status()
+
+                    if response.status_code == 206:
+                        first, expected = _content_range(response)
+                        if first != offset:
+                            os.remove(partPath)
+                            raise IOError(f"server resumed from byte {first} rather than {offset}, restarting download")
+                        mode = "ab"
+                        telemetry.count(name + ".resumed")
+                    else:
+                        # A 200 is the whole file, whether or not a range was asked for
+                        expected = response.headers.get("Content-Length")
+                        expected = int(expected) if expected and expected.isdigit() else None
+                        mode = "wb"
+
+                    # Decoding starts again from the first byte, so a resumed file is fed what's already on disk first
+                    if self.ingest is not None:
+                        if mode == "ab":
+                            self.ingest.feed_file(file_path, partPath, self.chunkSize)
+                        else:
+                            self.ingest.start(file_path)
 
+                    # requests decodes compressed bodies, which then won't match the Content-Length
+                    if response.headers.get("Content-Encoding", "identity") != "identity":
+                        expected = None
 
-    def download_files(self, filesByRun):
+                    received = 0
+                    writeTime = 0.0
+                    try:
+                        with open(partPath, mode) as f:
+                            for chunk in response.iter_content(chunk_size=self.chunkSize):
+                                writeStart = time.perf_counter()
+                                f.write(chunk)
+                                writeTime += time.perf_counter() - writeStart
+                                received += len(chunk)
+                                if self.ingest is not None:
+                                    self.ingest.feed(file_path, chunk)
+                    finally:
+                        telemetry.observe("metoffice.disk_write", writeTime)
+                        telemetry.count("metoffice.bytes", received)
+
+                size = os.path.getsize(partPath)
+                if expected is not None and size != expected:
+                    raise IOError(f"download truncated at {size} of {expected} bytes")
+                self._finish_file(partPath, file_path)
+                return size
+
+            except requests.HTTPError:
+                raise  # A 4xx, retrying won't help
+            except (requests.RequestException, IOError) as exc:
+                if attempt >= self.retryCount:
+                    raise
+                attempt += 1
+                wait = retryAfter if retryAfter is not None else backoff_time(attempt, self.backoffBase, self.backoffCap)
+                print(f"ERROR: {name} interrupted ({exc}), resuming ({attempt} of {self.retryCount}) in {wait:.1f}s")
+                telemetry.count(name + ".retries")
+                time.sleep(wait)
+
+    def stored_path(self, file_path):
+        """Where a downloaded file ends up: file_path, or with ingest set and keepGrib off, the marker left in its place"""
+        return file_path + DECODED_SUFFIX if self.ingest is not None and not self.keepGrib else file_path
+
+    def _finish_file(self, partPath, file_path):
+        """
+        Renames a complete part file into place. With ingest set and keepGrib off it is removed once decoded
+        instead, and an empty file_path + DECODED_SUFFIX marker put in its place so fillgaps still skips it.
+        """
+        if self.ingest is not None:
+            self.ingest.close(file_path)
+        storedPath = self.stored_path(file_path)
+        if storedPath != file_path:
+            open(storedPath, "wb").close()
+            os.remove(partPath)
+            return
+        os.replace(partPath, file_path)
+
+    def download_files(self, filesByRun, on_file=None, order=None):
+        return self.download_orders({order or self.order: filesByRun}, on_file=on_file)
+
+    def download_orders(self, filesByOrder, on_file=None):
 
         # Create folder to save files
         if self.verbose:
             print("Starting downloads")
 
-        if self.perfMode:
-            print("PM Download starting")
-            pmstart = datetime.now()
+        pmstart = time.perf_counter()
 
         # Get dt to append to file name in the download_worker function
         fileDateString = datetime.now().strftime("%Y%m%d")
 
-        # Process each file sequentially
-        for fileId in filesByRun[self.run]:
-            downloadTask = {
-                "baseUrl": self.BASE_URL,
-                "requestHeaders": self.requestHeaders,
-                "orderName": self.order,
-                "fileId": fileId,
-                "guidFileNames": False,
-                "folder": self.baseFolder,
-                "responseLog": [],
-                "downloadErrorLog": [],
-                "backdatedDate": '',
-            }
-
-            # Call the worker directly to process the download
-            self.download_worker(downloadTask, fileDateString)
+        # Every file of every order and run goes on one queue, with an order's files in their own folder when there are several
+        downloadTasks = []
+        for order, filesByRun in filesByOrder.items():
+            folder = self.baseFolder if len(self.orders()) == 1 else os.path.join(self.baseFolder, order)
+            os.makedirs(folder, exist_ok=True)
+            for fileIds in filesByRun.values():
+                for fileId in fileIds:
+                    downloadTasks.append({
+                        "baseUrl": self.BASE_URL,
+                        "requestHeaders": self.requestHeaders,
+                        "orderName": order,
+                        "fileId": fileId,
+                        "folder": folder,
+                    })
+
+        # Process the files concurrently, at most maxWorkers requests are in flight at once
+        downloaded = []
+        with ThreadPoolExecutor(max_workers=max(1, self.maxWorkers)) as executor:
+            futures = [executor.submit(self.download_worker, task, fileDateString) for task in downloadTasks]
+            for future in as_completed(futures):
+                file_path = future.result()
+                if file_path is not None:
+                    downloaded.append(file_path)
+                    if on_file is not None:
+                        # Each file is complete once renamed into place, so can be used straight away. With keepGrib
+                        # off this is the .decoded marker, the decoded fields are in self.ingest by then
+                        on_file(file_path)
+
+        telemetry.observe("metoffice.download_files", time.perf_counter() - pmstart)
 
         if self.perfMode:
-            pmend = datetime.now()
-            delta = round((pmend - pmstart).total_seconds() * 1000)
-            print("PM Download executed in ", str(delta), "ms")
+            print(f"PM Downloaded {len(downloaded)} of {len(downloadTasks)} files")
+            print(telemetry.summary())
 
         if self.verbose:
             print("Downloads complete")
 
+        return downloaded
+
+    def fetch_all(self, on_file=None):
+        """
+        One pass over every model in MODEL_LIST and order in ORDER_LIST: the run lists and order details are
+        requested concurrently, then the files for every run in RUN_LIST go through one shared download queue.
+        Returns the paths downloaded.
+        """
+        orders = self.orders()
+        with ThreadPoolExecutor(max_workers=max(1, self.maxWorkers)) as executor:
+            modelRuns = executor.map(self.get_model_run, self.MODEL_LIST)
+            details = executor.map(self.get_order_details, orders)
+            modelRuns = dict(zip(self.MODEL_LIST, modelRuns))
+            filesByOrder = {order: self.get_files_by_run(orderDetails) for order, orderDetails in zip(orders, details)}
 
+        if self.verbose:
+            for model, modelRun in modelRuns.items():
+                print(f"Latest complete {model} run: {modelRun}")
+
+        return self.download_orders(filesByOrder, on_file=on_file)
+
+    def latest_run_time(self, model):
+        """runDateTime of the newest complete run of model in self.runs(), from the last get_model_runs call"""
+        runs = self.runs()
+        for run in self.completeRuns.get(model, []):
+            if run["run"] in runs:
+                return datetime.fromisoformat(run["runDateTime"].replace("Z", "+00:00"))
+        return None
+
+    def next_poll_delay(self, now, lastRunTime):
+        """
+        Seconds until the next watch poll: pollIntervalNearRun while one of self.runs() is due but not yet
+        downloaded, otherwise pollInterval, cut short so polling speeds up as soon as the next run is due.
+        """
+        before, after = self.runWindow
+        delay = self.pollInterval
+        for run in self.runs():
+            expected = now.replace(hour=int(run), minute=0, second=0, microsecond=0)
+            if now > expected + after or (lastRunTime is not None and lastRunTime >= expected):
+                expected += timedelta(days=1)
+            windowStart = expected - before
+            if now >= windowStart:
+                return self.pollIntervalNearRun
+            delay = min(delay, (windowStart - now).total_seconds())
+        return delay
+
+    def watch(self, on_file=None, stop=None):
+        """
+        Runs until stopped (Ctrl-C, or stop, a threading.Event, being set), downloading each new run in self.runs() as
+        soon as it appears in completeRuns. Polls use conditional requests, so an unchanged run list costs a 304.
+
+        The last run downloaded for each model is kept in watch_state.json in baseFolder, so a restart doesn't
+        download it again. fillgaps is switched on, so a run that only partly downloaded is completed on the
+        next poll. on_file is called with the path of each file as it lands.
+        """
+        stop = stop or threading.Event()
+        self.fillgaps = True
+        statePath = os.path.join(self.baseFolder, "watch_state.json")
+        try:
+            with open(statePath, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+
+        while not stop.is_set():
+            lastRunTime = None
+            # The metadata calls sys.exit when the API is unreachable, the watcher should keep going until it's back
+            try:
+                self.get_model_runs()
+                for model in self.MODEL_LIST:
+                    runTime = self.latest_run_time(model)
+                    if runTime is None or state.get(model) == runTime.isoformat():
+                        lastRunTime = runTime
+                        continue
 
-if __name__ == "__main__":
+                    print(f"New {model} run {runTime.isoformat()}, downloading")
+                    telemetry.count("metoffice.watch.new_runs")
+                    filesByOrder = {order: self.get_files_by_run(details) for order, details in self.get_all_order_details().items()}
+                    downloaded = self.download_orders(filesByOrder, on_file=on_file)
+                    expected = sum(len(fileIds) for filesByRun in filesByOrder.values() for fileIds in filesByRun.values())
+                    if expected and len(downloaded) == expected:
+                        state[model] = runTime.isoformat()
+                        lastRunTime = runTime
+                        with open(statePath + ".tmp", "w") as f:
+                            json.dump(state, f, indent=4)
+                        os.replace(statePath + ".tmp", statePath)
+            except (Exception, SystemExit) as exc:
+                telemetry.count("metoffice.watch.errors")
+                print(f"ERROR: watch poll failed: {exc!r}")
+
+            delay = self.next_poll_delay(datetime.now(timezone.utc), lastRunTime)
+            if self.verbose:
+                print(f"Next poll in {delay:.0f}s")
+            stop.wait(delay)
+
+
+
+def main(argv=None, prog=None):
+
+    parser = argparse.ArgumentParser(prog=prog, description="Download the latest MET Office forecast files.")
+    parser.add_argument("--metrics", help="Write telemetry at the end of the run, Prometheus text if the path ends in .prom, otherwise JSON")
+    parser.add_argument("--watch", action="store_true", help="Keep running and download each new run as soon as it is published")
+    args = parser.parse_args(argv)
     
     # Start class
-    client = MetFileImporter()
+    try:
+        client = MetFileImporter()
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
-    # Get the model runs available
-    runs_dict = client.get_model_runs()
+    if args.watch:
+        try:
+            client.watch()
+        except KeyboardInterrupt:
+            pass
+    else:
+        # Get the model runs and order details, then download the files for every configured run
+        client.fetch_all()
 
-    # Get the order details
-    order = client.get_order_details()
+    if args.metrics:
+        telemetry.export(args.metrics)
 
-    # Get the files for this run
-    files = client.get_files_by_run(order)
 
-    # Check whether the run is already in the folder
-    client.download_files(files)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
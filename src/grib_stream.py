@@ -0,0 +1,272 @@
+# grib_stream.py
+
+# Decodes Met Office GRIB2 downloads message by message while they stream in, into the grids, point series and
+# region statistics used for the ASDI NetCDF files
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+import struct
+import threading
+
+import numpy as np
+
+from read_nc import get_grid_index_for_coords
+from telemetry import telemetry
+
+GRIB_HEADER_SIZE = 16  # "GRIB", 2 reserved bytes, discipline, edition, then the 8 byte message length
+
+# (discipline, parameterCategory, parameterNumber) of the GRIB2 precipitation fields kept by default:
+# precipitation rate, total, large scale and convective precipitation, total water, total and rain precipitation rate
+PRECIPITATION_PARAMETERS = {(0, 1, 7), (0, 1, 8), (0, 1, 9), (0, 1, 10), (0, 1, 49), (0, 1, 52), (0, 1, 65)}
+
+# One decoded message: name is eccodes' shortName, parameter the (discipline, category, number) above, level
+# eccodes' level and step_range its stepRange ("3" for an instant, "0-3" for an accumulation over hours 0 to 3),
+# lats and lons the 1-D coordinates of a regular lat/lon grid and grid (lats x lons) float32 with NaN where missing
+GribField = namedtuple("GribField", ["name", "parameter", "level", "step_range", "run_time", "valid_time", "lead_minutes",
+                                     "lats", "lons", "grid"])
+
+
+class GribSplitter:
+    """
+    Splits a GRIB2 byte stream into whole messages as the bytes arrive, using the length in each message's
+    indicator section, so each message can be decoded while the rest of the file is still downloading.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        """Adds the next bytes of the stream, returns the messages completed by them"""
+        self._buffer += chunk
+        messages = []
+        while True:
+            start = self._buffer.find(b"GRIB")
+            if start < 0:
+                # Keep the last few bytes in case "GRIB" is split across chunks
+                del self._buffer[:max(0, len(self._buffer) - 3)]
+                return messages
+            if start:
+                del self._buffer[:start]
+            if len(self._buffer) < GRIB_HEADER_SIZE:
+                return messages
+            if self._buffer[7] != 2:
+                raise ValueError(f"GRIB edition {self._buffer[7]} message, only GRIB2 is supported")
+            length = struct.unpack(">Q", self._buffer[8:16])[0]
+            if len(self._buffer) < length:
+                return messages
+            messages.append(bytes(self._buffer[:length]))
+            del self._buffer[:length]
+
+    def finish(self):
+        """Raises ValueError if the stream ended part way through a message"""
+        if self._buffer.find(b"GRIB") >= 0:
+            raise ValueError(f"GRIB stream ended {len(self._buffer)} bytes into a message")
+
+
+def _eccodes():
+    try:
+        import eccodes
+    except ImportError as e:
+        raise ImportError("Decoding GRIB2 needs eccodes (pinned in requirements.txt), install it with 'pip install eccodes'") from e
+    return eccodes
+
+
+def _grib_time(date, time):
+    """eccodes date (20240202) and time (800 for 08:00) keys -> datetime"""
+    return datetime.strptime(f"{int(date):08}{int(time):04}", "%Y%m%d%H%M")
+
+
+def _longitudes(first, last, count, negative=False):
+    """
+    Longitude axis from GRIB's first and last grid points, in -180..180. GRIB2 stores longitudes as 0..360, so a
+    grid crossing the prime meridian (the UK grid runs from about 346 to 4) is unwrapped before spacing the points
+    out, then normalised.
+    """
+    if not negative and last < first:
+        last += 360
+    elif negative and last > first:
+        first += 360
+    return (np.linspace(first, last, count) + 180) % 360 - 180
+
+
+def message_parameter(message):
+    """(discipline, parameterCategory, parameterNumber) of a GRIB2 message, read without decoding its values"""
+    eccodes = _eccodes()
+    handle = eccodes.codes_new_from_message(message)
+    try:
+        return tuple(int(eccodes.codes_get(handle, key)) for key in ("discipline", "parameterCategory", "parameterNumber"))
+    finally:
+        eccodes.codes_release(handle)
+
+
+def file_messages(path, chunk_size=1024 * 1024):
+    """Every message in a GRIB2 file on disk, in order, raises ValueError if the file ends part way through one"""
+    splitter = GribSplitter()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield from splitter.feed(chunk)
+    splitter.finish()
+
+
+def decode_message(message, values=True):
+    """
+    Decodes one GRIB2 message into a GribField. Only regular lat/lon grids are supported, which is what the
+    UK deterministic 2km (Latitude-Longitude projection) orders deliver; raises ValueError for anything else.
+    Without values only the header is read and grid is None.
+    """
+    eccodes = _eccodes()
+    handle = eccodes.codes_new_from_message(message)
+    try:
+        get = lambda key: eccodes.codes_get(handle, key)
+        grid_type = get("gridType")
+        if grid_type != "regular_ll":
+            raise ValueError(f"Unsupported GRIB grid type {grid_type}, expected regular_ll")
+
+        n_lons, n_lats = int(get("Ni")), int(get("Nj"))
+        lats = np.linspace(get("latitudeOfFirstGridPointInDegrees"), get("latitudeOfLastGridPointInDegrees"), n_lats)
+        lons = _longitudes(get("longitudeOfFirstGridPointInDegrees"), get("longitudeOfLastGridPointInDegrees"), n_lons,
+                           bool(get("iScansNegatively")))
+
+        grid = None
+        if values:
+            data = eccodes.codes_get_values(handle).astype("f4")
+            if get("bitmapPresent"):
+                data[data == np.float32(get("missingValue"))] = np.nan
+            if get("jPointsAreConsecutive"):
+                grid = np.ascontiguousarray(data.reshape(n_lons, n_lats).T)
+            else:
+                grid = data.reshape(n_lats, n_lons)
+
+        run_time = _grib_time(get("dataDate"), get("dataTime"))
+        valid_time = _grib_time(get("validityDate"), get("validityTime"))
+        return GribField(
+            name=get("shortName"),
+            parameter=(int(get("discipline")), int(get("parameterCategory")), int(get("parameterNumber"))),
+            level=int(get("level")),
+            step_range=str(get("stepRange")),
+            run_time=run_time,
+            valid_time=valid_time,
+            lead_minutes=int((valid_time - run_time) / timedelta(minutes=1)),
+            lats=lats,
+            lons=lons,
+            grid=grid,
+        )
+    finally:
+        eccodes.codes_release(handle)
+
+
+class GribIngest:
+    """
+    Receives a Met Office download as it streams (feed per chunk, then close once the file is complete), decodes
+    each rainfall message as soon as its last byte arrives and keeps the results in the structures used for ASDI:
+
+        fields        {key: GribField}, when keep_grids is set
+        points        {key: values at lats/lons, float32 NaN where missing}
+        region_stats  {key: (regions x len(REGION_STATS)) array from regions.RegionIndex.stats}
+
+    keyed by (file, name, level, step_range, valid_time), so fields at different levels or accumulated over
+    different periods to the same valid time are kept apart.
+
+    regions maps a name to a lat/lon bounding box or GeoJSON geometry as in bulk_read.bulk_extract, and the region
+    index is built once per grid. parameters is a set of (discipline, category, number) to keep, None for every
+    field. One GribIngest can be shared by all download workers, each file has its own splitter. A file decoded
+    again (e.g. after a resumed download) replaces its earlier results.
+
+    Results are kept until drain() hands them on. max_results bounds how many fields are held, dropping the
+    oldest, so a long-running watch that never drains doesn't keep every grid it has ever decoded.
+    """
+
+    def __init__(self, lats=(), lons=(), regions=None, parameters=PRECIPITATION_PARAMETERS, keep_grids=True,
+                 max_results=None):
+        self.lats = np.asarray(lats, dtype="f8")
+        self.lons = np.asarray(lons, dtype="f8")
+        self.regions = dict(regions or {})
+        self.parameters = parameters
+        self.keep_grids = keep_grids
+        self.max_results = max_results
+
+        self.fields = {}
+        self.points = {}
+        self.region_stats = {}
+        self._keys = {}  # Every key held, oldest first
+        self._splitters = {}
+        self._region_indexes = {}  # (lats, lons) extent and size -> RegionIndex
+        self._lock = threading.Lock()
+
+    def start(self, file):
+        """Starts (or restarts, after a failed download) decoding a file, discarding anything already fed for it"""
+        with self._lock:
+            self._splitters[file] = GribSplitter()
+
+    def feed(self, file, chunk):
+        with self._lock:
+            splitter = self._splitters.setdefault(file, GribSplitter())
+        for message in splitter.feed(chunk):
+            telemetry.count("grib.messages")
+            if self.parameters is not None and message_parameter(message) not in self.parameters:
+                continue
+            with telemetry.timer("grib.decode"):
+                field = decode_message(message)
+            self._add(file, field)
+
+    def feed_file(self, file, path, chunk_size=1024 * 1024):
+        """Decodes a file (or the part of one) already on disk from the start"""
+        self.start(file)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                self.feed(file, chunk)
+
+    def close(self, file):
+        """Called once a file has downloaded completely, raises ValueError if it ended part way through a message"""
+        with self._lock:
+            splitter = self._splitters.pop(file, None)
+        if splitter is not None:
+            splitter.finish()
+
+    def drain(self, file=None):
+        """
+        Removes and returns (fields, points, region_stats) for one file, or for every file when file is None,
+        e.g. from fetch_met_office's on_file callback once each file lands.
+        """
+        with self._lock:
+            keys = [key for key in self._keys if file is None or key[0] == file]
+            for key in keys:
+                del self._keys[key]
+            return tuple({key: results.pop(key) for key in keys if key in results}
+                         for results in (self.fields, self.points, self.region_stats))
+
+    def _add(self, file, field):
+        index = get_grid_index_for_coords(field.lons, field.lats, latlon=True)
+        key = (file, field.name, field.level, field.step_range, field.valid_time)
+        point_values = None
+        if len(self.lats):
+            cells, outside = index.locate(self.lats, self.lons)
+            point_values = field.grid[cells]
+            point_values[outside] = np.nan
+
+        region_stats = None
+        if self.regions:
+            grid_key = (field.lats[0], field.lats[-1], len(field.lats), field.lons[0], field.lons[-1], len(field.lons))
+            with self._lock:
+                region_index = self._region_indexes.get(grid_key)
+                if region_index is None:
+                    from regions import RegionIndex
+                    region_index = self._region_indexes[grid_key] = RegionIndex.from_regions(index, self.regions)
+            region_stats = region_index.stats(field.grid)
+
+        with self._lock:
+            if self.keep_grids:
+                self.fields[key] = field
+            if point_values is not None:
+                self.points[key] = point_values
+            if region_stats is not None:
+                self.region_stats[key] = region_stats
+            self._keys.pop(key, None)
+            self._keys[key] = None
+            while self.max_results is not None and len(self._keys) > self.max_results:
+                oldest = next(iter(self._keys))
+                del self._keys[oldest]
+                for results in (self.fields, self.points, self.region_stats):
+                    results.pop(oldest, None)
+                telemetry.count("grib.fields_dropped")
+        telemetry.count("grib.fields")
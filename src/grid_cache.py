@@ -0,0 +1,110 @@
+# grid_cache.py
+
+# On-disk cache of decoded NetCDF grids, memory-mapped on read
+
+import glob
+import hashlib
+import os
+
+import netCDF4 as nc
+import numpy as np
+
+DEFAULT_CACHE_FOLDER = "data/cache/grids"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GB
+
+
+class GridCache:
+    """
+    Decoded arrays from .nc files saved as .npy files and memory-mapped when read, so a repeated query is a
+    page-cache read rather than another HDF5 decompression.
+
+    Entries are keyed by the source file's path, modification time and size, so an edited or re-downloaded
+    file is decoded again. File modification times on the .npy files record last use and the least recently
+    used entries are evicted once the cache goes over max_bytes. Masked values are stored as NaN.
+    """
+
+    def __init__(self, folder=DEFAULT_CACHE_FOLDER, max_bytes=DEFAULT_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def _path_digest(path):
+        return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+
+    def _entry_path(self, path, name):
+        stat = os.stat(path)
+        version = hashlib.sha1(f"{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()[:8]
+        return os.path.join(self.folder, f"{self._path_digest(path)}-{version}-{name}.npy")
+
+    def get(self, path, variable):
+        """The decoded variable from path as a read-only memory-mapped array"""
+        return self._get(path, variable, lambda dataset: np.ma.filled(dataset.variables[variable][:].astype("f4"), np.nan))
+
+    def coords(self, path):
+        """(x, y) projection coordinates of path"""
+        x = self._get(path, "projection_x_coordinate", lambda dataset: np.ma.getdata(dataset.variables["projection_x_coordinate"][:]))
+        y = self._get(path, "projection_y_coordinate", lambda dataset: np.ma.getdata(dataset.variables["projection_y_coordinate"][:]))
+        return x, y
+
+    def _get(self, path, name, decode):
+        entry_path = self._entry_path(path, name)
+        try:
+            array = np.load(entry_path, mmap_mode="r")
+            os.utime(entry_path)  # Mark as recently used
+            return array
+        except (FileNotFoundError, ValueError):
+            pass  # Not cached yet, or a corrupt entry that gets overwritten below
+
+        with nc.Dataset(path) as dataset:
+            array = np.ascontiguousarray(decode(dataset))
+
+        # Drop entries for older versions of this file, then write via a temporary file so readers never see half an array
+        for stale in glob.glob(os.path.join(self.folder, f"{self._path_digest(path)}-*-{name}.npy")):
+            if stale != entry_path:
+                self._remove(stale)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, entry_path)
+
+        self.evict(keep=entry_path)
+        return np.load(entry_path, mmap_mode="r")
+
+    def invalidate(self, path):
+        """Removes every cached array decoded from path, e.g. once the source file has been deleted"""
+        for entry_path in glob.glob(os.path.join(self.folder, f"{self._path_digest(path)}-*.npy")):
+            self._remove(entry_path)
+
+    def size(self):
+        """Total bytes held by the cache"""
+        return sum(os.path.getsize(entry_path) for entry_path in glob.glob(os.path.join(self.folder, "*.npy")))
+
+    def evict(self, keep=None):
+        """Deletes least recently used entries (other than keep) until the cache fits within max_bytes, returns the bytes freed"""
+        entries = []
+        for entry_path in glob.glob(os.path.join(self.folder, "*.npy")):
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue  # Removed by another process
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, entry_path in sorted(entries):
+            if total - freed <= self.max_bytes:
+                break
+            if entry_path == keep:
+                continue
+            self._remove(entry_path)
+            freed += size
+        return freed
+
+    @staticmethod
+    def _remove(entry_path):
+        # Open memory maps keep working on POSIX after the file is unlinked
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,482 @@
+# rain_service.py
+
+# Long-running HTTP service answering batched rainfall point queries against the downloaded ASDI runs, and
+# optionally the Met Office GRIB2 downloads
+#
+#   python rain_service.py --port 8080
+#   curl -d '{"lats": [51.5, 53.4], "lons": [-0.1, -2.2], "times": ["2024-02-03T06:00:00"]}' localhost:8080/query
+
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import netCDF4 as nc
+import numpy as np
+
+from asdi_catalog import run_files
+from read_nc import RAINFALL_VARIABLE, get_grid_index_for_coords
+from telemetry import telemetry
+
+ASDI_FOLDER = "data/asdi"
+MET_OFFICE_FOLDER = "data/met_forecasts"
+DEFAULT_CACHE_BYTES = 1024 ** 3  # 1 GB of decoded grids held in memory
+RESCAN_INTERVAL = 30  # Seconds between checks of the data folder for new runs and files
+USE_INTERVAL = 60  # Seconds between marking the same file as used, for retention's least recently used order
+MAX_POINTS = 100_000  # Per request
+
+
+def _parse_run(name):
+    try:
+        return datetime.strptime(name, "%Y%m%dT%H%MZ")
+    except ValueError:
+        return None
+
+
+class RunStore:
+    """
+    The downloaded runs of one parameter and an in-memory LRU cache of their decoded grids, shared by every
+    request thread.
+
+    Run folders are rescanned at most every rescan_interval seconds, and a folder's file list only when its
+    modification time changes, so runs downloaded while the service is up (e.g. by fetch_asdi.py --sync on
+    a schedule) are picked up without a restart. Grids are keyed by path, modification time and size, so a
+    re-downloaded or compacted file is decoded again. Pass a grid_cache.GridCache as disk_cache to read grids
+    through its memory-mapped files instead of decoding them on every cache miss.
+
+    Files a query reads are marked as used by setting their access time, modification time untouched, so a
+    retention.RetentionManager evicting by size drops the runs queried least recently, even when their grids are
+    served from memory.
+    """
+
+    LATLON = False  # Grid coordinates are LAEA x/y rather than lon/lat
+    PERIOD = 3600  # Seconds of rain accumulated in each file
+
+    def __init__(self, asdi_folder=ASDI_FOLDER, FILE_NAME_FORMAT="rainfall_accumulation-PT01H.nc", variable=RAINFALL_VARIABLE,
+                 cache_bytes=DEFAULT_CACHE_BYTES, rescan_interval=RESCAN_INTERVAL, disk_cache=None):
+        self.folder = asdi_folder
+        self.FILE_NAME_FORMAT = FILE_NAME_FORMAT
+        self.variable = variable
+        self.cache_bytes = cache_bytes
+        self.rescan_interval = rescan_interval
+        self.disk_cache = disk_cache
+
+        self._runs = {}  # run name -> (folder mtime_ns, [(lead_minutes, valid_time, path)])
+        self._scanned = 0.0
+        self._scan_lock = threading.Lock()
+
+        self._grids = OrderedDict()  # (path, mtime_ns, size) -> (GridIndex, grid), most recently used last
+        self._grid_bytes = 0
+        self._grid_lock = threading.Lock()
+
+        self._used = {}  # path -> when it was last marked as used (monotonic)
+
+    def runs(self):
+        """{run name: files} for every run with at least one file, rescanning the folder if it's due"""
+        with self._scan_lock:
+            if time.monotonic() - self._scanned >= self.rescan_interval:
+                self._rescan()
+            return {run: files for run, (_, files) in self._runs.items() if files}
+
+    def _rescan(self):
+        runs = {}
+        if os.path.isdir(self.folder):
+            for entry in os.scandir(self.folder):
+                if not entry.is_dir() or _parse_run(entry.name) is None:
+                    continue
+                mtime = entry.stat().st_mtime_ns
+                previous = self._runs.get(entry.name)
+                files = previous[1] if previous and previous[0] == mtime else run_files(entry.path, self.FILE_NAME_FORMAT)
+                runs[entry.name] = (mtime, files)
+        if set(runs) - set(self._runs):
+            print(f"Runs available: {', '.join(sorted(runs))}")
+        self._runs = runs
+        self._scanned = time.monotonic()
+
+    def _key(self, path):
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+    def _read(self, path):
+        """(x, y, float32 grid with NaN for masked cells) of a file"""
+        if self.disk_cache is not None:
+            x, y = self.disk_cache.coords(path)
+            return x, y, self.disk_cache.get(path, self.variable)
+        with nc.Dataset(path) as dataset:
+            x = dataset.variables["projection_x_coordinate"][:]
+            y = dataset.variables["projection_y_coordinate"][:]
+            return x, y, np.ma.filled(dataset.variables[self.variable][:].astype("f4"), np.nan)
+
+    def grid(self, path):
+        """(GridIndex, float32 grid with NaN for masked cells) of a file, from memory when it's been read recently"""
+        key = self._key(path)
+        with self._grid_lock:
+            cached = self._grids.pop(key, None)
+            if cached is not None:
+                self._grids[key] = cached
+                telemetry.count("service.grid_cache.hits")
+                return cached
+
+        telemetry.count("service.grid_cache.misses")
+        with telemetry.timer("service.grid_load"):
+            x, y, grid = self._read(path)
+
+        with self._grid_lock:
+            index = get_grid_index_for_coords(x, y, latlon=self.LATLON)
+            if key not in self._grids:
+                self._grids[key] = (index, grid)
+                # Memory-mapped grids live in the page cache rather than the process, but are counted all the same
+                self._grid_bytes += grid.nbytes
+                while self._grid_bytes > self.cache_bytes and len(self._grids) > 1:
+                    _, (_, evicted) = self._grids.popitem(last=False)
+                    self._grid_bytes -= evicted.nbytes
+            return self._grids[key]
+
+    def forget(self, paths):
+        """
+        Drops the cached grids of deleted files (a retention.RetentionManager listener) and rescans on the next
+        request, so a run evicted from disk stops being served straight away rather than after rescan_interval.
+        """
+        paths = set(paths)
+        for path in paths:
+            self._used.pop(path, None)
+        with self._grid_lock:
+            for key in [key for key in self._grids if key[0] in paths]:
+                self._grid_bytes -= self._grids.pop(key)[1].nbytes
+        if self.disk_cache is not None:
+            for path in paths:
+                self.disk_cache.invalidate(path)
+        with self._scan_lock:
+            self._scanned = 0.0
+
+    def query(self, lats, lons, times=None, run=None):
+        """
+        Rainfall at each lat/lon for a run (the latest by default). With times (datetimes), one value per time from
+        the file whose accumulation period (valid_time - PERIOD, valid_time] holds it, otherwise one per lead
+        time. Returns {"run", "valid_times", "values"}, values being (points x times) with NaN where there's no data,
+        including at points outside the grid.
+        """
+        runs = self.runs()
+        if not runs:
+            raise LookupError(f"No runs downloaded in {self.folder}")
+        if run is None:
+            run = max(runs)
+        if run not in runs:
+            raise LookupError(f"Run {run} not found")
+        files = runs[run]
+
+        valid_times = [valid for _, valid, _ in files]
+        if times is None:
+            selected = list(range(len(files)))
+        else:
+            # Accumulations are labelled by the end of their period, so take the first file ending at or after t
+            positions = np.searchsorted(np.array(valid_times, dtype="datetime64[s]"), np.array(times, dtype="datetime64[s]"), side="left")
+            selected = [int(pos) if pos < len(files) and (valid_times[pos] - t).total_seconds() < self._period(files[pos][2])
+                        else None for pos, t in zip(positions, times)]
+
+        lats = np.asarray(lats, dtype="f8")
+        lons = np.asarray(lons, dtype="f8")
+        values = np.full((len(lats), len(selected)), np.nan, dtype="f4")
+        index = None
+        cells = None
+        outside = None
+        for j, i in enumerate(selected):
+            if i is None:
+                continue
+            file_index, grid = self.grid(files[i][2])
+            if file_index is not index:
+                # Points are only projected again when the grid changes
+                index = file_index
+                cells, outside = index.locate(lats, lons)
+            values[:, j] = grid[cells]
+            values[outside, j] = np.nan
+        self._mark_used(self._path(files[i][2]) for i in selected if i is not None)
+
+        return {
+            "run": run,
+            "valid_times": [None if i is None else valid_times[i].isoformat() for i in selected],
+            "values": values,
+        }
+
+    def _period(self, path):
+        return self.PERIOD
+
+    def _path(self, path):
+        return path
+
+    def _mark_used(self, paths):
+        now = time.monotonic()
+        for path in set(paths):
+            # Racy between threads, but marking a file twice is harmless
+            if now - self._used.get(path, -USE_INTERVAL) < USE_INTERVAL:
+                continue
+            self._used[path] = now
+            try:
+                os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+            except OSError:
+                pass  # Evicted or replaced since, the next rescan drops it
+
+
+def _step_seconds(step_range):
+    """Seconds accumulated over a GRIB stepRange in hours ("0-3" is three hours), an hour for an instantaneous field"""
+    start, _, end = step_range.partition("-")
+    return (float(end) - float(start)) * 3600 if end else 3600
+
+
+class GribRunStore(RunStore):
+    """
+    RunStore over the Met Office GRIB2 downloads (fetch_met_office.py) rather than the ASDI run folders. Each
+    .grib2 file's rainfall message headers are read once per modification, and the messages are grouped into
+    runs by their reference time, named like the ASDI run folders. Where messages share a run and valid time (a
+    run downloaded again, or another level) the most recently written file, then its first such message, is
+    served. A message's accumulation period comes from its step range. Needs eccodes.
+    """
+
+    LATLON = True
+
+    def __init__(self, met_folder=MET_OFFICE_FOLDER, parameters=None, cache_bytes=DEFAULT_CACHE_BYTES,
+                 rescan_interval=RESCAN_INTERVAL):
+        from grib_stream import PRECIPITATION_PARAMETERS
+        super().__init__(met_folder, cache_bytes=cache_bytes, rescan_interval=rescan_interval)
+        self.parameters = parameters if parameters is not None else PRECIPITATION_PARAMETERS
+        self._files = {}  # path -> ((mtime_ns, size), [(message number, GribField without its grid)])
+        self._periods = {}  # (path, message number) -> seconds accumulated
+
+    def _scan_file(self, path):
+        from grib_stream import decode_message, file_messages
+        headers = []
+        try:
+            for number, message in enumerate(file_messages(path)):
+                field = decode_message(message, values=False)
+                if field.parameter in self.parameters:
+                    headers.append((number, field))
+        except (OSError, ValueError) as e:
+            # Kept as scanned with no fields, so a bad file isn't read again until it changes
+            print(f"Skipping {path}: {e}")
+        return headers
+
+    def _rescan(self):
+        scanned = {}
+        if os.path.isdir(self.folder):
+            for dirpath, _, file_names in os.walk(self.folder):
+                for file_name in file_names:
+                    if not file_name.endswith(".grib2"):
+                        continue  # Part files, .decoded markers, watch_state.json
+                    path = os.path.join(dirpath, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    version = (stat.st_mtime_ns, stat.st_size)
+                    previous = self._files.get(path)
+                    scanned[path] = previous if previous and previous[0] == version else (version, self._scan_file(path))
+
+        runs, periods = {}, {}
+        for path, (_, headers) in sorted(scanned.items(), key=lambda item: item[1][0], reverse=True):
+            for number, field in headers:
+                files = runs.setdefault(f"{field.run_time:%Y%m%dT%H%MZ}", {})
+                if field.valid_time not in files:
+                    files[field.valid_time] = (field.lead_minutes, field.valid_time, (path, number))
+                    periods[(path, number)] = _step_seconds(field.step_range)
+        if set(runs) - set(self._runs):
+            print(f"Met Office runs available: {', '.join(sorted(runs))}")
+        self._files = scanned
+        self._periods = periods
+        self._runs = {run: (None, sorted(files.values())) for run, files in runs.items()}
+        self._scanned = time.monotonic()
+
+    def _key(self, message):
+        return super()._key(message[0]) + (message[1],)
+
+    def _read(self, message):
+        from grib_stream import decode_message, file_messages
+        path, number = message
+        for i, data in enumerate(file_messages(path)):
+            if i == number:
+                field = decode_message(data)
+                return field.lons, field.lats, field.grid
+        raise LookupError(f"{path} no longer holds message {number}")
+
+    def _period(self, message):
+        return self._periods.get(message, self.PERIOD)
+
+    def _path(self, message):
+        return message[0]
+
+
+def _json_values(values):
+    """2-D float array -> nested lists with None for NaN"""
+    rounded = np.round(values.astype("f8"), 4).astype(object)
+    rounded[np.isnan(values)] = None
+    return rounded.tolist()
+
+
+def _parse_time(text):
+    """ISO 8601 time -> naive UTC datetime, like the run and valid times. A time with an offset (or Z) is converted"""
+    parsed = datetime.fromisoformat(text[:-1] + "+00:00" if text.endswith(("Z", "z")) else text)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_request(params):
+    """Request parameters (JSON body or query string) -> (lats, lons, times, run), raises ValueError if they're invalid"""
+    if "points" in params:
+        points = np.asarray(params["points"], dtype="f8").reshape(-1, 2)
+        lats, lons = points[:, 0], points[:, 1]
+    else:
+        lats = np.atleast_1d(np.asarray(params["lats"], dtype="f8"))
+        lons = np.atleast_1d(np.asarray(params["lons"], dtype="f8"))
+    if lats.shape != lons.shape:
+        raise ValueError("lats and lons must be the same length")
+    if len(lats) > MAX_POINTS:
+        raise ValueError(f"At most {MAX_POINTS} points per request")
+    times = params.get("times")
+    if times is not None:
+        times = [_parse_time(t) for t in ([times] if isinstance(times, str) else times)]
+    return lats, lons, times, params.get("run")
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so a client can stream many requests over one connection
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            return self._send_json(200, {"status": "ok"})
+        if url.path == "/runs":
+            # ?source=met_office for the Met Office runs
+            try:
+                store = self.server.source(parse_qs(url.query).get("source", [None])[0])
+            except LookupError as e:
+                return self._send_json(404, {"error": str(e)})
+            return self._send_json(200, {run: len(files) for run, files in sorted(store.runs().items())})
+        if url.path == "/metrics":
+            return self._send_json(200, telemetry.snapshot())
+        if url.path == "/query":
+            # ?lat=51.5&lon=-0.1&lat=53.4&lon=-2.2&time=2024-02-03T06:00:00
+            query = parse_qs(url.query)
+            params = {"lats": query.get("lat", []), "lons": query.get("lon", [])}
+            if "time" in query:
+                params["times"] = query["time"]
+            if "run" in query:
+                params["run"] = query["run"][0]
+            if "source" in query:
+                params["source"] = query["source"][0]
+            return self._query(params)
+        self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/query":
+            return self._send_json(404, {"error": "Not found"})
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            return self._send_json(400, {"error": "Body must be JSON"})
+        self._query(params)
+
+    def _query(self, params):
+        with telemetry.timer("service.query"):
+            try:
+                lats, lons, times, run = parse_request(params)
+            except (KeyError, TypeError, ValueError) as e:
+                return self._send_json(400, {"error": f"Bad request: {e}"})
+            try:
+                result = self.server.source(params.get("source")).query(lats, lons, times, run)
+            except LookupError as e:
+                return self._send_json(404, {"error": str(e)})
+            except Exception as e:
+                # e.g. a file that can't be decoded, removed or truncated underneath the service
+                telemetry.count("service.errors")
+                return self._send_json(500, {"error": f"Query failed: {e}"})
+            telemetry.count("service.points", len(lats))
+            result["values"] = _json_values(result["values"])
+            self._send_json(200, result)
+
+
+class RainService(ThreadingHTTPServer):
+    """
+    HTTP front end for a RunStore, each request is answered on its own thread. met_store is an optional
+    GribRunStore, queried with "source": "met_office".
+    """
+    daemon_threads = True
+
+    def __init__(self, store, host="127.0.0.1", port=8080, met_store=None):
+        super().__init__((host, port), _QueryHandler)
+        self.store = store
+        self.met_store = met_store
+
+    def source(self, name):
+        """The store a request's source names, "asdi" (the default) or "met_office" """
+        if name in (None, "asdi"):
+            return self.store
+        if name == "met_office" and self.met_store is not None:
+            return self.met_store
+        raise LookupError(f"Source {name} not served")
+
+
+def main(argv=None, prog=None):
+
+    parser = argparse.ArgumentParser(prog=prog, description="Serve batched rainfall point queries against the downloaded ASDI and Met Office runs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--asdi-folder", default=ASDI_FOLDER, help="Folder holding the downloaded run folders")
+    parser.add_argument("--cache-mb", type=int, default=DEFAULT_CACHE_BYTES // 1024 ** 2, help="Memory for decoded grids")
+    parser.add_argument("--rescan", type=float, default=RESCAN_INTERVAL, help="Seconds between checks for new runs")
+    parser.add_argument("--disk-cache", action="store_true", help="Read grids through the memory-mapped grid cache")
+    parser.add_argument("--met-office", action="store_true", help="Also serve the Met Office GRIB2 downloads, as source met_office")
+    parser.add_argument("--met-folder", default=MET_OFFICE_FOLDER, help="Folder holding the Met Office downloads")
+    parser.add_argument("--keep-runs", type=int, help="Evict all but the newest runs in the background (see retention.py)")
+    parser.add_argument("--max-gb", type=float, help="Evict the least recently queried runs in the background beyond this size")
+    args = parser.parse_args(argv)
+
+    disk_cache = None
+    if args.disk_cache:
+        from grid_cache import GridCache
+        disk_cache = GridCache()
+
+    store = RunStore(args.asdi_folder, cache_bytes=args.cache_mb * 1024 ** 2, rescan_interval=args.rescan, disk_cache=disk_cache)
+    met_store = None
+    if args.met_office:
+        met_store = GribRunStore(args.met_folder, cache_bytes=args.cache_mb * 1024 ** 2, rescan_interval=args.rescan)
+    server = RainService(store, args.host, args.port, met_store)
+
+    retention = None
+    if args.keep_runs is not None or args.max_gb is not None:
+        from retention import RetentionManager, RetentionPolicy
+        max_bytes = int(args.max_gb * 1024 ** 3) if args.max_gb is not None else None
+        retention = RetentionManager(RetentionPolicy(args.keep_runs, None, max_bytes), asdi_folder=args.asdi_folder,
+                                     met_folder=args.met_folder if met_store is not None else None)
+        retention.add_listener(store.forget)
+        if met_store is not None:
+            retention.add_listener(met_store.forget)
+        retention.start()
+
+    print(f"Serving rainfall queries on http://{args.host}:{args.port}/query")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    if retention is not None:
+        retention.stop()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
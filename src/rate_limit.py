@@ -0,0 +1,139 @@
+# rate_limit.py
+
+# Token bucket rate limiter and jittered exponential backoff shared by every API worker
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+
+from telemetry import telemetry
+
+# Status codes worth retrying, anything else is returned to the caller straight away
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def backoff_time(attempt, base=1.0, cap=60.0):
+    """
+    Seconds to wait before retry number `attempt` (1, 2, ...): exponential growth with "full jitter",
+    a random wait between 0 and min(cap, base * 2 ** (attempt - 1)), so workers that failed together
+    don't all retry together.
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def retry_after_seconds(response):
+    """Seconds asked for by a Retry-After header (either a number of seconds or an HTTP date), or None"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all worker threads, so together they stay inside the API quota.
+
+    The rate adapts (additive increase, multiplicative decrease): every throttled response halves it, down to
+    min_rate, and every successful request nudges it back up towards max_rate. A Retry-After from the server
+    pauses every worker, not just the one that got the 429.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate) if min_rate else self.max_rate / 16
+        self.burst = float(burst) if burst else max(1.0, self.max_rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            telemetry.observe("ratelimit.wait", waited)
+
+    def pause(self, seconds):
+        """Stops every worker from sending for the given number of seconds"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def throttled(self, retry_after=None):
+        """Call on a 429 response"""
+        telemetry.count("ratelimit.throttled")
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+        if retry_after:
+            self.pause(retry_after)
+
+    def succeeded(self):
+        """Call on a successful response"""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def request_with_retry(session, url, limiter, retries=3, backoff_base=1.0, backoff_cap=60.0, name="request", **kwargs):
+    """
+    GETs url through the shared limiter, retrying connection errors and 429/5xx responses up to `retries`
+    times with jittered exponential backoff (or the server's Retry-After when it sends one).
+
+    Returns the final response, whatever its status, and re-raises the last exception if every attempt failed
+    to connect.
+    """
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = session.get(url, **kwargs)
+        except Exception as exc:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            wait = backoff_time(attempt, backoff_base, backoff_cap)
+            print(f"EXCEPTION: {name} failed ({exc}), retry {attempt} of {retries} in {wait:.1f}s")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES:
+                limiter.succeeded()
+                return response
+            if attempt >= retries:
+                return response
+
+            attempt += 1
+            retry_after = retry_after_seconds(response)
+            if response.status_code == 429:
+                limiter.throttled(retry_after)
+            wait = retry_after if retry_after is not None else backoff_time(attempt, backoff_base, backoff_cap)
+            print(f"ERROR: {name} returned {response.status_code}, retry {attempt} of {retries} in {wait:.1f}s")
+            response.close()
+
+        telemetry.count(f"{name}.retries")
+        time.sleep(wait)
@@ -1,36 +1,288 @@
 
-"""Quick file to read an NC file. Initally created to determine the naming convention of the ASDI files"""
+
+"""Quick file to read an NC file. Initally created to determine the naming convention of the ASDI files
+
+Also extracts rainfall at points, either from a downloaded file in data/asdi or straight from the ASDI bucket.
+Remote files are opened lazily through s3fs and h5netcdf, so only the HDF5 chunks holding the requested points are fetched.
+Point lookups are vectorized: a GridIndex is built once per set of projection coordinates and shared by every file on that grid.
+"""
+
+from functools import lru_cache
+import hashlib
 
 import netCDF4 as nc
 import numpy as np
-import pyproj
 
-# Load the NetCDF file
-dataset = nc.Dataset("data/asdi/20240202T0000Z-20240203T0100Z-PT0025H00M-rainfall_accumulation-PT01H.nc")
+ASDI_BUCKET = "met-office-atmospheric-model-data"
+RAINFALL_VARIABLE = "thickness_of_rainfall_amount"
+REMOTE_BLOCK_SIZE = 256 * 1024  # Bytes per ranged read, roughly one compressed chunk
+GRID_INDEX_CACHE_SIZE = 8
+
+# The Lambert Azimuthal Equal Area projection the ASDI grids are on
+LAEA_PROJ = "+proj=laea +lat_0=49.0 +lon_0=-2.0 +datum=WGS84"
+
+
+@lru_cache(maxsize=None)
+def get_transformer():
+    """lat/lon -> LAEA transformer, built once per process"""
+    # pyproj is slow to import and only point lookups and regions need it
+    import pyproj
+    return pyproj.Transformer.from_crs("EPSG:4326", LAEA_PROJ, always_xy=True)
+
+
+class GridIndex:
+    """
+    Nearest grid cell lookup for one set of projection coordinates.
+    Coordinates are sorted once, so looking up N points is one vectorized projection and two binary searches.
+    A point more than half a cell beyond the grid's edge (e.g. outside a file cropped by compact.py --bbox)
+    is outside it, see locate.
+    """
+
+    def __init__(self, x, y):
+        self.x = np.asarray(np.ma.getdata(x), dtype="f8")
+        self.y = np.asarray(np.ma.getdata(y), dtype="f8")
+        self.shape = (len(y), len(x))
+        self._x_order, self._x_sorted = self._prepare(x)
+        self._y_order, self._y_sorted = self._prepare(y)
+        self._x_edges = self._edges(self._x_sorted)
+        self._y_edges = self._edges(self._y_sorted)
+        self._latlons = None
+
+    @staticmethod
+    def _prepare(coords):
+        coords = np.asarray(np.ma.getdata(coords), dtype="f8")
+        order = np.argsort(coords, kind="stable")
+        return order, coords[order]
+
+    @staticmethod
+    def _edges(sorted_coords):
+        """Outer edges of the first and last cells along one axis, half a cell beyond their centres"""
+        half = float(np.median(np.diff(sorted_coords))) / 2 if len(sorted_coords) > 1 else np.inf
+        return sorted_coords[0] - half, sorted_coords[-1] + half
+
+    @staticmethod
+    def _nearest(order, sorted_coords, targets):
+        # Binary search then pick the closer neighbour, ties go to the lower coordinate like argmin did
+        pos = np.clip(np.searchsorted(sorted_coords, targets), 1, len(sorted_coords) - 1)
+        left = sorted_coords[pos - 1]
+        right = sorted_coords[pos]
+        pos = pos - ((targets - left) <= (right - targets))
+        return order[pos]
+
+    def project(self, lons, lats):
+        """lon/lat -> (x, y) in the grid's coordinates"""
+        return get_transformer().transform(lons, lats)
+
+    def unproject(self, x, y):
+        """(x, y) in the grid's coordinates -> (lons, lats)"""
+        return get_transformer().transform(x, y, direction="INVERSE")
+
+    def locate(self, lats, lons):
+        """
+        Returns ((y_idx, x_idx), outside): the grid cells nearest to each lat/lon, and a boolean array that is True
+        for points outside the grid. Those still get the nearest edge cell, so the indices can always be gathered
+        with, but their values should be masked.
+        """
+        x_target, y_target = self.project(np.asarray(lons, dtype="f8"), np.asarray(lats, dtype="f8"))
+        x_target, y_target = np.atleast_1d(x_target), np.atleast_1d(y_target)
+        y_idx = self._nearest(self._y_order, self._y_sorted, y_target)
+        x_idx = self._nearest(self._x_order, self._x_sorted, x_target)
+        inside = ((x_target >= self._x_edges[0]) & (x_target <= self._x_edges[1]) &
+                  (y_target >= self._y_edges[0]) & (y_target <= self._y_edges[1]))
+        return (y_idx, x_idx), ~inside
+
+    def lookup(self, lats, lons):
+        """Returns the (y_idx, x_idx) arrays of the grid cells nearest to each lat/lon, the edge cell for points outside it"""
+        return self.locate(lats, lons)[0]
+
+    def cell_latlons(self):
+        """(lats, lons) of every cell centre, each shaped like the grid. Computed on first use then kept"""
+        if self._latlons is None:
+            xx, yy = np.meshgrid(self.x, self.y)
+            lons, lats = self.unproject(xx, yy)
+            self._latlons = (lats, lons)
+        return self._latlons
+
+    def bbox_mask(self, lat_min, lon_min, lat_max, lon_max):
+        """Boolean grid mask of the cells whose centres fall inside a lat/lon bounding box"""
+        lats, lons = self.cell_latlons()
+        return (lats >= lat_min) & (lats <= lat_max) & (lons >= lon_min) & (lons <= lon_max)
+
+
+class LatLonGridIndex(GridIndex):
+    """GridIndex for a regular latitude/longitude grid (e.g. Met Office GRIB2 downloads), x being longitude and y latitude"""
+
+    def project(self, lons, lats):
+        return np.asarray(lons, dtype="f8"), np.asarray(lats, dtype="f8")
+
+    def unproject(self, x, y):
+        return np.asarray(x, dtype="f8"), np.asarray(y, dtype="f8")
+
+
+_grid_indexes = {}
+
+
+def data_variable(dataset, preferred=RAINFALL_VARIABLE):
+    """Name of the gridded field in a file: preferred if the file has it, otherwise the first variable on the projection grid"""
+    if preferred in dataset.variables:
+        return preferred
+    for name, variable in dataset.variables.items():
+        if "projection_x_coordinate" in variable.dimensions and "projection_y_coordinate" in variable.dimensions:
+            return name
+    raise KeyError("No variable on the projection grid")
+
+
+def get_grid_index(dataset):
+    """
+    GridIndex for the dataset's projection coordinates, cached so every file on the same grid shares one index.
+    The cache key is a digest of the coordinate values, so the index is never reused for a different grid.
+    """
+    x = dataset.variables["projection_x_coordinate"][:]
+    y = dataset.variables["projection_y_coordinate"][:]
+    return get_grid_index_for_coords(x, y)
+
+
+def get_grid_index_for_coords(x, y, latlon=False):
+    """
+    As get_grid_index, for coordinate arrays that have already been read (e.g. from a GridCache).
+    With latlon, x and y are longitudes and latitudes rather than LAEA projection coordinates.
+    """
+    x = np.ma.getdata(x)
+    y = np.ma.getdata(y)
+    kind = b"latlon" if latlon else b"laea"
+    key = hashlib.sha1(kind + np.ascontiguousarray(x).tobytes() + b"|" + np.ascontiguousarray(y).tobytes()).hexdigest()
+
+    index = _grid_indexes.pop(key, None)
+    if index is None:
+        index = LatLonGridIndex(x, y) if latlon else GridIndex(x, y)
+    _grid_indexes[key] = index  # Most recently used goes last
+    while len(_grid_indexes) > GRID_INDEX_CACHE_SIZE:
+        _grid_indexes.pop(next(iter(_grid_indexes)))
+    return index
+
+
+def _decode(variable, values):
+    """
+    Apply the CF fill value and scaling that netCDF4 applies automatically but h5netcdf doesn't,
+    so remote reads return the same masked values as reading a downloaded file.
+    """
+    if isinstance(variable, nc.Variable):
+        return values  # Already decoded by netCDF4
+    attrs = variable.ncattrs()
+    values = np.ma.asarray(values)
+    if "_FillValue" in attrs:
+        values = np.ma.masked_equal(values, variable.getncattr("_FillValue"))
+    if "scale_factor" in attrs:
+        values = values * variable.getncattr("scale_factor")
+    if "add_offset" in attrs:
+        values = values + variable.getncattr("add_offset")
+    return values
+
+
+def extract_points(dataset, lats, lons, variable=RAINFALL_VARIABLE, full_grid=True, cells=None):
+    """
+    Extract the variable at the grid cells nearest to each lat/lon, returns a masked array with one value per point.
+    Works on netCDF4 datasets and on h5netcdf legacy-API datasets (see extract_points_remote).
+
+    full_grid=True decodes the whole grid once and gathers every point from it, which is fastest for local files
+    and many points. full_grid=False reads each distinct cell on its own, so a remote dataset only fetches the
+    chunks holding the points. Points outside the grid are masked. cells can pass in (y_idx, x_idx) from an earlier
+    GridIndex.locate, masking the points outside the grid is then left to the caller.
+    """
+    outside = None
+    if cells is None:
+        cells, outside = get_grid_index(dataset).locate(lats, lons)
+    values = _extract_cells(dataset.variables[variable], cells, full_grid)
+    if outside is not None:
+        values[outside] = np.ma.masked
+    return values
+
+
+def _extract_cells(var, cells, full_grid):
+    y_idx, x_idx = cells
+    if full_grid:
+        grid = np.ma.asarray(_decode(var, var[:]))
+        return grid[y_idx, x_idx]
+
+    # Read each distinct cell once and scatter it back to every point in it
+    flat = np.ravel_multi_index((y_idx, x_idx), (var.shape[-2], var.shape[-1]))
+    unique_cells, inverse = np.unique(flat, return_inverse=True)
+    unique_values = np.ma.masked_all(len(unique_cells), dtype="f8")  # Decoded values, even from a packed int16 variable
+    for i, cell in enumerate(unique_cells):
+        y_cell, x_cell = divmod(int(cell), var.shape[-1])
+        unique_values[i] = _decode(var, var[y_cell, x_cell])
+    return unique_values[inverse]
+
+
+def extract_points_files(paths, lats, lons, variable=RAINFALL_VARIABLE, cache=None):
+    """
+    Extract the variable at each lat/lon from a list of downloaded files (e.g. each lead time of a run).
+    Returns a masked array of shape (points x times), one column per file.
+    Pass a grid_cache.GridCache to read decoded grids from its memory-mapped cache instead of decompressing each file.
+    """
+    values = np.ma.masked_all((len(lats), len(paths)), dtype="f4")
+    index = None
+    cells = None
+    outside = None
+    for i, path in enumerate(paths):
+        if cache is not None:
+            file_index = get_grid_index_for_coords(*cache.coords(path))
+        else:
+            dataset = nc.Dataset(path)
+            file_index = get_grid_index(dataset)
+        if file_index is not index:
+            # Only re-project the points when the grid changes
+            index = file_index
+            cells, outside = index.locate(lats, lons)
+
+        if cache is not None:
+            values[:, i] = np.ma.masked_invalid(cache.get(path, variable)[cells])
+        else:
+            with dataset:
+                values[:, i] = extract_points(dataset, lats, lons, variable, cells=cells)
+        values[outside, i] = np.ma.masked
+    return values
+
+
+def get_s3fs(aws_access=None, aws_secret=None, aws_region=None):
+    """s3fs filesystem for the ASDI bucket, anonymous unless credentials are given (the bucket is public)"""
+    import s3fs
+    if aws_access:
+        return s3fs.S3FileSystem(key=aws_access, secret=aws_secret, client_kwargs={"region_name": aws_region})
+    return s3fs.S3FileSystem(anon=True)
+
+
+def extract_points_remote(keys, lats, lons, variable=RAINFALL_VARIABLE, fs=None, bucket_name=ASDI_BUCKET):
+    """
+    Extract the variable at each lat/lon from ASDI keys without downloading them, e.g.
+    keys = ["uk-deterministic-2km/20240202T0000Z/20240203T0100Z-PT0025H00M-rainfall_accumulation-PT01H.nc"]
+
+    Returns a masked array of shape (points x keys), matching extract_points_files on the downloaded files.
+    """
+    import h5netcdf.legacyapi
 
-# Read the coordinate variables
-x = dataset.variables["projection_x_coordinate"][:]
-y = dataset.variables["projection_y_coordinate"][:]
+    if fs is None:
+        fs = get_s3fs()
 
-# Define the projection from Lambert Azimuthal Equal Area to lat/lon
-proj = pyproj.Proj("+proj=laea +lat_0=49.0 +lon_0=-2.0 +datum=WGS84")
+    values = np.ma.masked_all((len(lats), len(keys)), dtype="f4")
+    for i, key in enumerate(keys):
+        # blockcache keeps each fetched block, so HDF5 metadata and shared chunks are only requested once
+        with fs.open(f"{bucket_name}/{key}", "rb", block_size=REMOTE_BLOCK_SIZE, cache_type="blockcache") as f:
+            with h5netcdf.legacyapi.Dataset(f, "r") as dataset:
+                values[:, i] = extract_points(dataset, lats, lons, variable, full_grid=False)
+    return values
 
-# Function to find the nearest index
-def find_nearest(array, value):
-    return np.abs(array - value).argmin()
 
-# Convert lat/lon to projected coordinates
-lat, lon = 52.5, -1.5  # Replace with your desired location
-x_target, y_target = proj(lon, lat)
+if __name__ == "__main__":
 
-# Find nearest grid point
-x_idx = find_nearest(x, x_target)
-y_idx = find_nearest(y, y_target)
+    # Load the NetCDF file
+    dataset = nc.Dataset("data/asdi/20240202T0000Z-20240203T0100Z-PT0025H00M-rainfall_accumulation-PT01H.nc")
 
-# Extract the rainfall forecast
-rainfall = dataset.variables["thickness_of_rainfall_amount"][y_idx, x_idx]
+    # Extract the rainfall forecast
+    lat, lon = 52.5, -1.5  # Replace with your desired location
+    rainfall = extract_points(dataset, [lat], [lon])[0]
 
-print(f"Rainfall forecast at ({lat}, {lon}): {rainfall} mm")
+    print(f"Rainfall forecast at ({lat}, {lon}): {rainfall} mm")
 
-# Close the dataset
-dataset.close()
\ No newline at end of file
+    # Close the dataset
+    dataset.close()
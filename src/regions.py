@@ -0,0 +1,200 @@
+# regions.py
+
+# Regions (postcode areas, polygons, bounding boxes) rasterized once onto the LAEA grid as sparse cell weights
+
+import argparse
+import json
+
+import netCDF4 as nc
+import numpy as np
+from scipy import sparse
+
+from read_nc import RAINFALL_VARIABLE, get_grid_index
+
+REGION_STATS = ("mean", "max", "sum")
+DEFAULT_SUPERSAMPLE = 4  # Sample points per cell along each axis when working out how much of a cell a polygon covers
+
+
+def _polygons(geometry):
+    """The polygons of a GeoJSON Polygon or MultiPolygon geometry, each a list of rings of (lon, lat)"""
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    raise ValueError(f"Unsupported geometry type {geometry['type']}, expected Polygon or MultiPolygon")
+
+
+def _inside(px, py, rings):
+    """Even-odd point in polygon test, vectorized over the points, holes included by listing them as extra rings"""
+    inside = np.zeros(px.shape, dtype=bool)
+    for ring_x, ring_y in rings:
+        x_prev, y_prev = ring_x[-1], ring_y[-1]
+        for x, y in zip(ring_x, ring_y):
+            if y != y_prev:
+                crosses = (y > py) != (y_prev > py)
+                x_cross = x + (py - y) * (x_prev - x) / (y_prev - y)
+                inside ^= crosses & (px < x_cross)
+            x_prev, y_prev = x, y
+    return inside
+
+
+def _cell_spacing(coords):
+    return float(np.median(np.abs(np.diff(coords)))) if len(coords) > 1 else 1.0
+
+
+def polygon_weights(index, geometry, supersample=DEFAULT_SUPERSAMPLE):
+    """
+    Fraction of each grid cell covered by a lat/lon GeoJSON Polygon or MultiPolygon, as (flat cell indices, weights).
+    The polygon is projected onto the grid once and only the cells inside its bounding box are tested, each at
+    supersample x supersample points. A polygon smaller than a cell that misses every sample point gets the cell
+    holding its first vertex with weight 1, so every region on the grid has at least one cell.
+    """
+    dx = _cell_spacing(index.x)
+    dy = _cell_spacing(index.y)
+    offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+
+    weights = {}
+    for polygon in _polygons(geometry):
+        rings = []
+        for ring in polygon:
+            ring = np.asarray(ring, dtype="f8")
+            rings.append(index.project(ring[:, 0], ring[:, 1]))
+        x_min, x_max = rings[0][0].min(), rings[0][0].max()
+        y_min, y_max = rings[0][1].min(), rings[0][1].max()
+
+        cols = np.nonzero((index.x + dx / 2 >= x_min) & (index.x - dx / 2 <= x_max))[0]
+        rows = np.nonzero((index.y + dy / 2 >= y_min) & (index.y - dy / 2 <= y_max))[0]
+        if not len(cols) or not len(rows):
+            continue
+
+        px = (index.x[cols][:, None] + offsets * dx).ravel()
+        py = (index.y[rows][:, None] + offsets * dy).ravel()
+        px, py = np.meshgrid(px, py)
+        covered = _inside(px, py, rings).reshape(len(rows), supersample, len(cols), supersample).mean(axis=(1, 3))
+
+        row_idx, col_idx = np.nonzero(covered)
+        for cell, weight in zip(np.ravel_multi_index((rows[row_idx], cols[col_idx]), index.shape), covered[row_idx, col_idx]):
+            # Parts of a MultiPolygon can share a cell, but never cover more than all of it
+            weights[int(cell)] = min(1.0, weights.get(int(cell), 0.0) + float(weight))
+
+    if not weights:
+        lon, lat = _polygons(geometry)[0][0][0]
+        (y_idx, x_idx), outside = index.locate([lat], [lon])
+        if not outside[0]:
+            weights[int(np.ravel_multi_index((y_idx[0], x_idx[0]), index.shape))] = 1.0
+
+    cells = np.fromiter(weights.keys(), dtype="i8", count=len(weights))
+    order = np.argsort(cells)
+    return cells[order], np.fromiter(weights.values(), dtype="f8", count=len(weights))[order]
+
+
+class RegionIndex:
+    """
+    Sparse (regions x cells) weight matrix for one grid, built once so the mean, max and sum of every region for a
+    whole file is a sparse matrix-vector product rather than a test of every cell against every region.
+    Weights are the fraction of each cell inside the region: sums and means are area weighted, max takes every cell
+    the region touches.
+    """
+
+    def __init__(self, names, weights, shape):
+        self.names = list(names)
+        self.weights = sparse.csr_matrix(weights, dtype="f8")
+        self.weights.eliminate_zeros()
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_regions(cls, index, regions, supersample=DEFAULT_SUPERSAMPLE):
+        """
+        Builds the index for a read_nc.GridIndex from {name: region}, a region being either a lat/lon bounding box
+        (lat_min, lon_min, lat_max, lon_max), taking the cells whose centres fall inside it, or a GeoJSON geometry.
+        """
+        rows, cols, data = [], [], []
+        for i, region in enumerate(regions.values()):
+            if isinstance(region, dict):
+                cells, weights = polygon_weights(index, region, supersample)
+            else:
+                cells = np.flatnonzero(index.bbox_mask(*region))
+                weights = np.ones(len(cells), dtype="f8")
+            rows.append(np.full(len(cells), i, dtype="i8"))
+            cols.append(cells)
+            data.append(weights)
+
+        n_cells = index.shape[0] * index.shape[1]
+        if regions:
+            weights = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                        shape=(len(regions), n_cells))
+        else:
+            weights = sparse.csr_matrix((0, n_cells), dtype="f8")
+        return cls(regions.keys(), weights, index.shape)
+
+    @classmethod
+    def from_geojson(cls, index, path, name_property="name", supersample=DEFAULT_SUPERSAMPLE):
+        """Builds the index from a GeoJSON FeatureCollection, naming each region by a feature property"""
+        with open(path, "r") as f:
+            features = json.load(f)["features"]
+        regions = {str(feature["properties"][name_property]): feature["geometry"] for feature in features}
+        return cls.from_regions(index, regions, supersample)
+
+    def save(self, path):
+        """Saves the weights to a .npz file, so the rasterizing is done once per grid rather than once per run"""
+        np.savez_compressed(path, names=np.array(self.names), shape=np.array(self.shape), data=self.weights.data,
+                            indices=self.weights.indices, indptr=self.weights.indptr)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            shape = tuple(int(n) for n in saved["shape"])
+            weights = sparse.csr_matrix((saved["data"], saved["indices"], saved["indptr"]),
+                                        shape=(len(saved["names"]), shape[0] * shape[1]))
+            return cls([str(name) for name in saved["names"]], weights, shape)
+
+    def stats(self, grid):
+        """
+        Mean, max and sum (REGION_STATS order) of a grid, masked array or NaN for missing, for every region.
+        Returns a float32 array of shape (regions x len(REGION_STATS)), NaN for regions with no valid cells.
+        """
+        values = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(grid, dtype="f8")), np.nan).ravel()
+        if values.size != self.weights.shape[1]:
+            raise ValueError(f"Grid of shape {np.shape(grid)} doesn't match the region index grid {self.shape}")
+        valid = ~np.isnan(values)
+
+        totals = self.weights @ np.where(valid, values, 0.0)
+        covered = self.weights @ valid.astype("f8")
+
+        stats = np.full((len(self.names), len(REGION_STATS)), np.nan, dtype="f4")
+        has_values = covered > 0
+        stats[has_values, 0] = totals[has_values] / covered[has_values]
+        stats[has_values, 2] = totals[has_values]
+
+        # Max over each region's cells: gather them in CSR order and reduce row by row
+        gathered = np.where(valid, values, -np.inf)[self.weights.indices]
+        starts = self.weights.indptr[:-1]
+        nonempty = np.diff(self.weights.indptr) > 0
+        if gathered.size:
+            maxes = np.maximum.reduceat(gathered, starts[nonempty])
+            stats[np.flatnonzero(nonempty), 1] = np.where(np.isfinite(maxes), maxes, np.nan)
+        stats[~has_values, 1] = np.nan
+        return stats
+
+
+def main(argv=None, prog=None):
+
+    parser = argparse.ArgumentParser(prog=prog, description="Rainfall statistics for GeoJSON regions from a downloaded file.")
+    parser.add_argument("geojson", help="FeatureCollection of Polygon/MultiPolygon regions")
+    parser.add_argument("file", help="Downloaded .nc file, which also sets the grid")
+    parser.add_argument("--name-property", default="name", help="Feature property holding the region name")
+    parser.add_argument("--save", help="Save the region index to this .npz file for reuse")
+    args = parser.parse_args(argv)
+
+    with nc.Dataset(args.file) as dataset:
+        region_index = RegionIndex.from_geojson(get_grid_index(dataset), args.geojson, args.name_property)
+        grid = dataset.variables[RAINFALL_VARIABLE][:]
+    if args.save:
+        region_index.save(args.save)
+
+    for name, (mean, maximum, total) in zip(region_index.names, region_index.stats(grid)):
+        print(f"{name}: mean {mean:.3f}, max {maximum:.3f}, sum {total:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+# retention.py
+
+# Size-budgeted retention for the downloaded data: keeps the last N runs, files up to N days old and/or a total
+# byte budget across data/asdi and data/met_forecasts, evicting in the background and telling caches about it
+
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+import os
+import re
+import shutil
+import threading
+import time
+
+from telemetry import telemetry
+
+ASDI_FOLDER = "data/asdi"
+MET_OFFICE_FOLDER = "data/met_forecasts"
+DEFAULT_GRACE = 60 * 60  # Seconds since the last write before a run or file can be evicted, so downloads in progress are left alone
+DEFAULT_INTERVAL = 15 * 60  # Seconds between background passes
+
+# keep_runs: newest runs to keep (ASDI run folders, and Met Office download days), None for no limit
+# max_age_days: evict runs older than this, None for no limit
+# max_bytes: total budget over both folders, least recently used runs are evicted until it fits, None for no limit
+RetentionPolicy = namedtuple("RetentionPolicy", ["keep_runs", "max_age_days", "max_bytes"], defaults=[None, None, None])
+
+# One evictable unit: a whole ASDI run folder, or one Met Office .grib2 file (or its .decoded marker). run_time is the run (ASDI) or the
+# download day (Met Office), last_used the latest access or modification time of its files, last_write the latest
+# modification time, files every file path in it
+RetentionUnit = namedtuple("RetentionUnit", ["kind", "path", "run_time", "size", "last_used", "last_write", "files"])
+
+_MET_OFFICE_FILE = re.compile(r"_(\d{8})\.grib2(\.decoded)?$")  # Downloads, and markers for decoded ones
+
+
+def _asdi_units(asdi_folder):
+    units = []
+    if not asdi_folder or not os.path.isdir(asdi_folder):
+        return units
+    for entry in os.scandir(asdi_folder):
+        if not entry.is_dir():
+            continue
+        try:
+            run_time = datetime.strptime(entry.name, "%Y%m%dT%H%MZ")
+        except ValueError:
+            continue  # e.g. the catalog or anything else kept alongside the runs
+        files, size, last_used, last_write = [], 0, 0.0, entry.stat().st_mtime
+        for dirpath, _, file_names in os.walk(entry.path):
+            for file_name in file_names:
+                path = os.path.join(dirpath, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append(path)
+                size += stat.st_size
+                last_used = max(last_used, stat.st_atime, stat.st_mtime)
+                last_write = max(last_write, stat.st_mtime)
+        units.append(RetentionUnit("asdi", entry.path, run_time, size, max(last_used, last_write), last_write, files))
+    return units
+
+
+def _met_office_units(met_folder):
+    units = []
+    if not met_folder or not os.path.isdir(met_folder):
+        return units
+    for dirpath, _, file_names in os.walk(met_folder):
+        for file_name in file_names:
+            match = _MET_OFFICE_FILE.search(file_name)
+            if match is None:
+                continue  # Part files, watch_state.json
+            path = os.path.join(dirpath, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            run_time = datetime.strptime(match.group(1), "%Y%m%d")
+            units.append(RetentionUnit("met_office", path, run_time, stat.st_size, max(stat.st_atime, stat.st_mtime),
+                                       stat.st_mtime, [path]))
+    return units
+
+
+def select_evictions(units, policy, now=None, grace=DEFAULT_GRACE):
+    """
+    The units policy evicts, in eviction order: runs beyond keep_runs (oldest first, counted per kind), then runs
+    older than max_age_days, then the least recently used until the rest fit in max_bytes. Units written in the
+    last grace seconds are never evicted.
+    """
+    now = now if now is not None else time.time()
+    evictable = [unit for unit in units if now - unit.last_write >= grace]
+    evicted = []
+
+    if policy.keep_runs is not None:
+        for kind in sorted({unit.kind for unit in units}):
+            runs = sorted({unit.run_time for unit in units if unit.kind == kind}, reverse=True)
+            kept = set(runs[:policy.keep_runs])
+            evicted += sorted((unit for unit in evictable if unit.kind == kind and unit.run_time not in kept),
+                              key=lambda unit: unit.run_time)
+
+    if policy.max_age_days is not None:
+        cutoff = datetime.fromtimestamp(now) - timedelta(days=policy.max_age_days)
+        evicted += sorted((unit for unit in evictable if unit.run_time < cutoff and unit not in evicted),
+                          key=lambda unit: unit.run_time)
+
+    if policy.max_bytes is not None:
+        total = sum(unit.size for unit in units) - sum(unit.size for unit in evicted)
+        for unit in sorted((unit for unit in evictable if unit not in evicted), key=lambda unit: (unit.last_used, unit.run_time)):
+            if total <= policy.max_bytes:
+                break
+            evicted.append(unit)
+            total -= unit.size
+    return evicted
+
+
+def grid_cache_listener(cache):
+    """Listener dropping evicted files from a grid_cache.GridCache"""
+    def invalidate(paths):
+        for path in paths:
+            cache.invalidate(path)
+    return invalidate
+
+
+class RetentionManager:
+    """
+    Applies a RetentionPolicy to the ASDI and Met Office download folders, once with enforce() or every interval
+    seconds on a background thread with start(). Pass None for a folder to leave it alone.
+
+    Listeners are called with the list of file paths removed by each eviction, so caches and indexes built on
+    those files can drop them, e.g. a rain_service.RunStore's forget or grid_cache_listener(GridCache()).
+    ASDI runs are removed as whole folders, manifest included, so a later --sync downloads them again.
+    """
+
+    def __init__(self, policy, asdi_folder=ASDI_FOLDER, met_folder=MET_OFFICE_FOLDER, grace=DEFAULT_GRACE, dry_run=False):
+        self.policy = policy
+        self.asdi_folder = asdi_folder
+        self.met_folder = met_folder
+        self.grace = grace
+        self.dry_run = dry_run
+        self._listeners = []
+        self._lock = threading.Lock()  # One pass at a time
+        self._stop = None
+        self._thread = None
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def units(self):
+        """Every evictable unit with its size and last use, scanned from disk"""
+        return _asdi_units(self.asdi_folder) + _met_office_units(self.met_folder)
+
+    def enforce(self):
+        """One pass: evicts what the policy selects, returns the units evicted"""
+        with self._lock, telemetry.timer("retention.pass"):
+            units = self.units()
+            evicted = select_evictions(units, self.policy, grace=self.grace)
+            for unit in evicted:
+                print(f"{'Would evict' if self.dry_run else 'Evicting'} {unit.path} ({unit.size/(1024*1024):.1f} MB, "
+                      f"run {unit.run_time:%Y-%m-%d %H:%M})")
+                if not self.dry_run:
+                    self._evict(unit)
+            if evicted:
+                total = sum(unit.size for unit in units)
+                freed = sum(unit.size for unit in evicted)
+                print(f"{'Would free' if self.dry_run else 'Freed'} {freed/(1024*1024):.1f} MB of {total/(1024*1024):.1f} MB")
+            return evicted
+
+    def _evict(self, unit):
+        if unit.kind == "asdi":
+            shutil.rmtree(unit.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(unit.path)
+            except FileNotFoundError:
+                pass
+        telemetry.count("retention.evicted")
+        telemetry.count("retention.evicted_bytes", unit.size)
+
+        for listener in self._listeners:
+            try:
+                listener(unit.files)
+            except Exception as e:
+                print(f"Retention listener failed for {unit.path}: {e}")
+
+    def start(self, interval=DEFAULT_INTERVAL):
+        """Runs enforce every interval seconds on a daemon thread until stop() is called"""
+        self._stop = threading.Event()
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.enforce()
+                except Exception as e:
+                    # A failed pass (e.g. a folder removed underneath it) shouldn't end retention
+                    print(f"Retention pass failed: {e}")
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._thread.join()
+
+
+def main(argv=None, prog=None):
+
+    parser = argparse.ArgumentParser(prog=prog, description="Evict old downloads from data/asdi and data/met_forecasts.")
+    parser.add_argument("--keep-runs", type=int, help="Newest runs (and Met Office download days) to keep")
+    parser.add_argument("--max-age-days", type=float, help="Evict runs older than this")
+    parser.add_argument("--max-gb", type=float, help="Total size to keep both folders within, least recently used evicted first")
+    parser.add_argument("--grace", type=float, default=DEFAULT_GRACE, help="Seconds since the last write before anything can be evicted")
+    parser.add_argument("--grid-cache", action="store_true", help="Also drop evicted files from the decoded grid cache")
+    parser.add_argument("--watch", type=float, metavar="SECONDS", help="Keep running, enforcing the policy every SECONDS")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would be evicted")
+    args = parser.parse_args(argv)
+
+    if args.keep_runs is None and args.max_age_days is None and args.max_gb is None:
+        parser.error("Give at least one of --keep-runs, --max-age-days or --max-gb")
+
+    policy = RetentionPolicy(args.keep_runs, args.max_age_days, int(args.max_gb * 1024 ** 3) if args.max_gb is not None else None)
+    manager = RetentionManager(policy, grace=args.grace, dry_run=args.dry_run)
+    if args.grid_cache:
+        from grid_cache import GridCache
+        manager.add_listener(grid_cache_listener(GridCache()))
+
+    if not args.watch:
+        manager.enforce()
+        return
+    manager.start(args.watch)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        manager.stop()
+
+
+if __name__ == "__main__":
+    main()
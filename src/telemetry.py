@@ -0,0 +1,154 @@
+# telemetry.py
+
+# Lightweight counters and latency histograms shared by the fetchers
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket catches everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile, capped at the slowest observation"""
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Telemetry:
+    """
+    Thread-safe counters and latency histograms for each ingest stage (listing, metadata calls, TTFB,
+    bytes transferred, retries, disk writes).
+    Metric names are dotted, e.g. "asdi.list", and are exported with underscores in Prometheus text.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def count(self, name, value=1):
+        """Adds value to a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """Records one latency in a histogram"""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = _Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Times the with-block into the name histogram, failed blocks are also counted in name.errors"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.count(name + ".errors")
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def snapshot(self):
+        """All metrics as a JSON-serialisable dict"""
+        with self._lock:
+            return {
+                "started": self.started,
+                "elapsed_s": round(time.time() - self.started, 3),
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: {
+                        "count": h.count,
+                        "sum_s": round(h.sum, 6),
+                        "max_s": round(h.max, 6),
+                        "p50_s": h.quantile(0.5),
+                        "p90_s": h.quantile(0.9),
+                        "p99_s": h.quantile(0.99),
+                        "buckets": {str(bound): n for bound, n in zip(LATENCY_BUCKETS, h.counts)},
+                    }
+                    for name, h in self.histograms.items()
+                },
+            }
+
+    def to_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric = _prometheus_name(name) + "_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+            for name, h in sorted(self.histograms.items()):
+                metric = _prometheus_name(name) + "_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f"{metric}_sum {h.sum}")
+                lines.append(f"{metric}_count {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Writes a snapshot to path, as Prometheus text if it ends in .prom and JSON otherwise"""
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=4)
+        print(f"Metrics saved to {path}")
+
+    def summary(self):
+        """One line per histogram, for printing at the end of a run"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, h in sorted(snapshot["histograms"].items()):
+            lines.append(f"PM {name}: {h['count']} calls, {h['sum_s']:.3f}s total, p50 {h['p50_s']:.3f}s, max {h['max_s']:.3f}s")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"PM {name}: {value}")
+        return "\n".join(lines)
+
+
+def _prometheus_name(name):
+    return "met_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+# Shared by every fetcher in the process
+telemetry = Telemetry()
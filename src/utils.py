@@ -1,6 +1,9 @@
 # utils.py
 import json
 import os
+import uuid
+
+PARQUET_COMPRESSION = "zstd"
 
 def save_to_json(data, filename):
     """Save data to a JSON file."""
@@ -18,6 +21,38 @@ def read_json(filename):
     with open(filepath, "r") as f:
         return json.load(f)
 
+def save_to_parquet(frame, dataset, partition_cols=("run_date",), append=True):
+    """
+    Save a DataFrame to a Parquet dataset folder in data/, one subfolder per partition (e.g. data/points/run_date=2024-02-02).
+    With append, the rows are added as new files alongside what's there already. Otherwise they replace the
+    partitions they fall in, leaving the others untouched, so re-exporting a run doesn't duplicate it.
+    """
+    folder = os.path.join("data", dataset)
+    os.makedirs(folder, exist_ok=True)
+    frame.to_parquet(
+        folder,
+        engine="pyarrow",
+        compression=PARQUET_COMPRESSION,
+        index=False,
+        partition_cols=list(partition_cols),
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore" if append else "delete_matching",
+    )
+    print(f"Data saved to {folder} ({len(frame)} rows)")
+
+def read_parquet(dataset, columns=None, filters=None):
+    """
+    Read a Parquet dataset folder from data/, only loading the columns asked for and the partitions
+    matching filters, e.g. [("run_date", ">=", "2024-02-01")].
+    """
+    # pandas is only needed here, keep it out of the import of everything else that uses utils
+    import pandas as pd
+
+    folder = os.path.join("data", dataset)
+    if not os.path.exists(folder):
+        raise FileNotFoundError(f"Dataset {folder} not found.")
+    return pd.read_parquet(folder, engine="pyarrow", columns=columns, filters=filters)
+
 def log_message(message):
     """Log a message to the console."""
     print(f"[LOG] {message}")
@@ -1 +1,646 @@
 # Test ASDI data pull
+
+import os
+import sys
+
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+from build_cube import build_cube, extract_points_cube
+from compact import Compaction, compact_file
+from grid_cache import GridCache
+from read_nc import RAINFALL_VARIABLE, extract_points, extract_points_files, get_grid_index
+
+FILE_NAME_FORMAT = "rainfall_accumulation-PT01H.nc"
+
+# Points inside the synthetic grid below, which is centred on the LAEA origin (49N, 2W)
+LATS = [49.0, 49.05, 49.1, 48.9, 49.15]
+LONS = [-2.0, -2.1, -1.8, -1.95, -2.2]
+
+
+def write_asdi_file(path, seed):
+    """A small ASDI-like rainfall file on a 2km LAEA grid, float32 with a few masked cells"""
+    rng = np.random.default_rng(seed)
+    grid = rng.gamma(1.0, 2.0, (30, 40)).astype("f4")
+    mask = np.zeros(grid.shape, dtype=bool)
+    mask[0, :5] = True
+    with nc.Dataset(path, "w") as dataset:
+        dataset.createDimension("projection_y_coordinate", 30)
+        dataset.createDimension("projection_x_coordinate", 40)
+        dataset.createVariable("projection_y_coordinate", "f4", ("projection_y_coordinate",))[:] = np.arange(30) * 2000.0 - 30000
+        dataset.createVariable("projection_x_coordinate", "f4", ("projection_x_coordinate",))[:] = np.arange(40) * 2000.0 - 40000
+        variable = dataset.createVariable(RAINFALL_VARIABLE, "f4", ("projection_y_coordinate", "projection_x_coordinate"),
+                                          fill_value=np.float32(-1))
+        variable[:] = np.ma.array(grid, mask=mask)
+
+
+def s3_client_for(server):
+    """A boto3 client for a stand_ins.S3StandIn"""
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client("s3", aws_access_key_id="test", aws_secret_access_key="test", region_name="eu-west-2",
+                        endpoint_url=server.url, config=Config(s3={"addressing_style": "path"}))
+
+
+def serve_asdi_files(server, monkeypatch, tmp_path):
+    """Has the stand-in serve a real ASDI-like file for every key and fetch_asdi use it, downloading under tmp_path"""
+    import hashlib
+    import fetch_asdi
+
+    path = str(tmp_path / "served.nc")
+    write_asdi_file(path, 0)
+    with open(path, "rb") as f:
+        server.body = f.read()
+    server.etag = '"' + hashlib.md5(server.body).hexdigest() + '"'
+    s3_client = s3_client_for(server)
+    monkeypatch.setattr(fetch_asdi, "get_s3_client", lambda *args, **kwargs: s3_client)
+    monkeypatch.chdir(tmp_path)
+    return s3_client
+
+
+def test_compacted_reads_agree(tmp_path):
+    run_folder = tmp_path / "20240202T0000Z"
+    run_folder.mkdir()
+    paths = [str(run_folder / f"20240202T{hour:02}00Z-PT00{hour:02}H00M-{FILE_NAME_FORMAT}") for hour in (1, 2)]
+    for seed, path in enumerate(paths):
+        write_asdi_file(path, seed)
+    expected = extract_points_files(paths, LATS, LONS)
+
+    settings = Compaction(precision=0.01)
+    for path in paths:
+        compact_file(path, settings)
+    with nc.Dataset(paths[0]) as dataset:
+        assert dataset.variables[RAINFALL_VARIABLE].dtype == np.int16
+
+    netcdf4 = extract_points_files(paths, LATS, LONS)
+    np.testing.assert_allclose(netcdf4, expected, atol=settings.precision)
+
+    import h5netcdf.legacyapi
+    for i, path in enumerate(paths):
+        with h5netcdf.legacyapi.Dataset(path, "r") as dataset:
+            remote = extract_points(dataset, LATS, LONS, full_grid=False)
+            full = extract_points(dataset, LATS, LONS, full_grid=True)
+        np.testing.assert_allclose(remote, netcdf4[:, i], atol=1e-5)
+        np.testing.assert_allclose(full, netcdf4[:, i], atol=1e-5)
+
+    cached = extract_points_files(paths, LATS, LONS, cache=GridCache(str(tmp_path / "cache")))
+    np.testing.assert_allclose(cached, netcdf4, atol=1e-5)
+
+    cube = build_cube(str(run_folder), FILE_NAME_FORMAT)
+    series, lead_times = extract_points_cube(cube, LATS, LONS)
+    assert list(lead_times) == [60, 120]
+    np.testing.assert_allclose(series, netcdf4, atol=1e-5)
+
+
+def test_compacted_masked_cells_stay_masked(tmp_path):
+    path = str(tmp_path / f"20240202T0100Z-PT0001H00M-{FILE_NAME_FORMAT}")
+    write_asdi_file(path, 0)
+    compact_file(path)
+
+    import h5netcdf.legacyapi
+    with h5netcdf.legacyapi.Dataset(path, "r") as dataset:
+        index = get_grid_index(dataset)
+        lons, lats = index.unproject(index.x[[0, 4, 5]], index.y[[0, 0, 0]])
+        values = extract_points(dataset, lats, lons, full_grid=False)
+    assert list(np.ma.getmaskarray(values)) == [True, True, False]
+
+
+def test_query_times_are_converted_to_utc():
+    from datetime import datetime
+    from rain_service import parse_request
+
+    _, _, times, _ = parse_request({"lats": [51.5], "lons": [-0.1],
+                                    "times": ["2024-02-02T05:30:00+02:00", "2024-02-02T03:30:00Z", "2024-02-02T03:30:00"]})
+    assert times == [datetime(2024, 2, 2, 3, 30)] * 3
+
+
+def test_sync_relists_republished_objects(tmp_path):
+    import hashlib
+    from datetime import datetime
+
+    from stand_ins import S3StandIn
+    from asdi_catalog import AsdiCatalog
+    from fetch_asdi import paginator
+
+    bucket, prefix = "met-office-atmospheric-model-data", "uk-deterministic-2km/"
+    keys = [f"{prefix}20240202T0000Z/20240202T{hour:02}00Z-PT00{hour:02}H00M-{FILE_NAME_FORMAT}" for hour in (1, 2)]
+    run = datetime(2024, 2, 2, 0)
+    catalog = AsdiCatalog(str(tmp_path / "catalog.sqlite"))
+
+    with S3StandIn(bucket, keys, 100) as server:
+        s3_client = s3_client_for(server)
+        list_run = lambda relist: paginator(None, None, None, bucket, prefix, run, FILE_NAME_FORMAT, output="contents",
+                                            s3_client=s3_client, catalog=catalog, relist=relist)
+        first = list_run(False)
+        assert [content["ETag"] for content in first] == [server.etag] * 2
+
+        # Republish both objects and withdraw one: an incremental refresh can't see either change
+        server.body = b"republished" * 20
+        server.etag = '"' + hashlib.md5(server.body).hexdigest() + '"'
+        server.keys = keys[:1]
+        assert list_run(False) == first
+
+        relisted = list_run(True)
+        assert [(content["Key"], content["Size"], content["ETag"]) for content in relisted] == [(keys[0], 220, server.etag)]
+    catalog.close()
+
+
+def test_retention_evicts_old_runs_and_tells_listeners(tmp_path):
+    import time
+    from retention import RetentionManager, RetentionPolicy
+
+    old = time.time() - 3 * 86400
+
+    def write(path, size, mtime=old):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(path, (mtime, mtime))
+        os.utime(os.path.dirname(path), (mtime, mtime))  # A run folder's own mtime counts as a write too
+
+    asdi, met = str(tmp_path / "asdi"), str(tmp_path / "met")
+    for run in ("20240201T0000Z", "20240201T0600Z", "20240202T0000Z"):
+        write(os.path.join(asdi, run, f"20240203T0100Z-PT0001H00M-{FILE_NAME_FORMAT}"), 1000)
+    write(os.path.join(asdi, "20240203T0000Z", f"20240203T0100Z-PT0001H00M-{FILE_NAME_FORMAT}"), 1000, time.time())
+    write(os.path.join(asdi, "catalog.sqlite"), 10)
+    write(os.path.join(met, "agl_rain_20240201.grib2"), 500)
+    write(os.path.join(met, "agl_rain_20240202.grib2.decoded"), 0)
+    write(os.path.join(met, "agl_rain_20240202.grib2.part"), 100)
+
+    # Dry run changes nothing
+    manager = RetentionManager(RetentionPolicy(keep_runs=1), asdi, met, dry_run=True)
+    assert [os.path.basename(unit.path) for unit in manager.enforce()] == \
+        ["20240201T0000Z", "20240201T0600Z", "20240202T0000Z", "agl_rain_20240201.grib2"]
+    assert len(os.listdir(asdi)) == 5
+
+    # The run written just now is inside the grace period, so the budget can only be met from the older ones
+    removed = []
+    manager = RetentionManager(RetentionPolicy(max_bytes=2000), asdi, met)
+    manager.add_listener(removed.extend)
+    manager.enforce()
+    assert sorted(os.listdir(asdi)) == ["20240202T0000Z", "20240203T0000Z", "catalog.sqlite"]
+    assert sorted(os.listdir(met)) == ["agl_rain_20240202.grib2.decoded", "agl_rain_20240202.grib2.part"]
+    assert sorted(os.path.basename(os.path.dirname(path)) for path in removed if path.startswith(asdi)) == \
+        ["20240201T0000Z", "20240201T0600Z"]
+
+
+def _serve(store, **kwargs):
+    import threading
+    from rain_service import RainService
+
+    server = RainService(store, port=0, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _post(server, body):
+    import json
+    import urllib.error
+    import urllib.request
+
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_address[1]}/query", data=json.dumps(body).encode())
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_service_answers_500_for_an_unreadable_file(tmp_path):
+    from rain_service import RunStore
+
+    run_folder = tmp_path / "20240202T0000Z"
+    run_folder.mkdir()
+    write_asdi_file(str(run_folder / f"20240202T0100Z-PT0001H00M-{FILE_NAME_FORMAT}"), 0)
+    (run_folder / f"20240202T0200Z-PT0002H00M-{FILE_NAME_FORMAT}").write_bytes(b"not netCDF")
+
+    server = _serve(RunStore(str(tmp_path)))
+    try:
+        status, body = _post(server, {"lats": LATS, "lons": LONS, "times": ["2024-02-02T00:30:00"]})
+        assert status == 200 and body["valid_times"] == ["2024-02-02T01:00:00"]
+        status, body = _post(server, {"lats": LATS, "lons": LONS})
+        assert status == 500 and body["error"].startswith("Query failed")
+        status, _ = _post(server, {"lats": LATS, "lons": LONS, "source": "met_office"})
+        assert status == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def write_run(run_folder, hours, seed=0):
+    """Hourly ASDI-like files for a run starting at the run folder's time, returns their paths in lead-time order"""
+    from datetime import datetime, timedelta
+
+    os.makedirs(run_folder, exist_ok=True)
+    run = datetime.strptime(os.path.basename(run_folder), "%Y%m%dT%H%MZ")
+    paths = []
+    for hour in hours:
+        path = os.path.join(run_folder, f"{run + timedelta(hours=hour):%Y%m%dT%H%MZ}-PT{hour:04}H00M-{FILE_NAME_FORMAT}")
+        write_asdi_file(path, seed + hour)
+        paths.append(path)
+    return paths
+
+
+def test_accumulations_match_brute_force_sums(tmp_path):
+    from datetime import datetime
+    from accumulate import accumulate_run
+
+    # 26 hours: a full day (hours ending 01:00 to 00:00) then two hours of the next, so the last day is partial
+    run_folder = str(tmp_path / "20240202T0000Z")
+    paths = write_run(run_folder, range(1, 27))
+    with nc.Dataset(paths[5], "a") as dataset:
+        dataset.variables[RAINFALL_VARIABLE][10, 10] = np.ma.masked  # Missing for one hour only
+    hourly = []
+    for path in paths:
+        with nc.Dataset(path) as dataset:
+            hourly.append(np.ma.filled(dataset.variables[RAINFALL_VARIABLE][:].astype("f8"), np.nan))
+    hourly = np.array(hourly)
+
+    def brute_force(start, stop):
+        hours = hourly[start:stop]
+        # NaN wherever any hour is missing, as accumulate reports a total it can't complete
+        return np.where(np.isnan(hours).any(axis=0), np.nan, np.nansum(hours, axis=0))
+
+    results = list(accumulate_run(run_folder, windows=(3,)))
+    rolling = [result for result in results if result.name == "PT03H"]
+    daily = [result for result in results if result.name == "P1D"]
+
+    assert [result.end.hour for result in rolling[:2]] == [3, 4] and len(rolling) == 24
+    for i, result in enumerate(rolling):
+        assert result.hours == 3
+        np.testing.assert_allclose(result.grid, brute_force(i, i + 3), atol=1e-4)
+    assert np.isnan(rolling[3].grid[10, 10]) and np.isnan(rolling[5].grid[10, 10]) and not np.isnan(rolling[6].grid[10, 10])
+
+    assert [(result.start, result.hours) for result in daily] == [(datetime(2024, 2, 2), 24), (datetime(2024, 2, 3), 2)]
+    np.testing.assert_allclose(daily[0].grid, brute_force(0, 24), atol=1e-3)
+    np.testing.assert_allclose(daily[1].grid, brute_force(24, 26), atol=1e-4)
+    assert np.isnan(daily[0].grid[10, 10]) and not np.isnan(daily[1].grid[10, 10])
+    assert np.isnan(daily[1].grid[0, 0])  # Masked in every hour
+
+
+def test_region_stats_match_a_brute_force_mask():
+    from read_nc import LatLonGridIndex
+    from regions import RegionIndex, polygon_weights
+
+    # 1 degree cells centred on whole degrees, lons 0 to 9 and lats 0 to 7
+    lons, lats = np.arange(10.0), np.arange(8.0)
+    index = LatLonGridIndex(lons, lats)
+    rng = np.random.default_rng(3)
+    grid = rng.gamma(1.0, 2.0, (8, 10)).astype("f4")
+    grid[4, 4] = 1000  # In the notch of the L below, outside it though inside its bounding box
+    grid[1, 1] = np.nan
+
+    # An L along cell edges, so every cell is wholly in or out and the weights are all 1
+    l_shape = {"type": "Polygon", "coordinates": [[[-0.5, -0.5], [5.5, -0.5], [5.5, 2.5], [2.5, 2.5], [2.5, 5.5], [-0.5, 5.5],
+                                                   [-0.5, -0.5]]]}
+    region_index = RegionIndex.from_regions(index, {"l": l_shape, "away": (50.0, 50.0, 51.0, 51.0)})
+    stats = region_index.stats(grid)
+
+    lon_grid, lat_grid = np.meshgrid(lons, lats)
+    mask = ((lon_grid <= 5) & (lat_grid <= 2)) | ((lon_grid <= 2) & (lat_grid <= 5))
+    cells, weights = polygon_weights(index, l_shape)
+    assert list(cells) == list(np.flatnonzero(mask)) and (weights == 1).all()
+    inside = grid[mask & ~np.isnan(grid)].astype("f8")
+    np.testing.assert_allclose(stats[0], [inside.mean(), inside.max(), inside.sum()], rtol=1e-6)
+    assert stats[0, 1] < 1000
+    assert np.isnan(stats[1]).all()  # Covers no cells
+
+
+BUCKET, PREFIX = "met-office-atmospheric-model-data", "uk-deterministic-2km/"
+PARAMETERS = [FILE_NAME_FORMAT, "rainfall_rate.nc"]
+
+
+def run_keys(run, hours=(1, 2), parameters=PARAMETERS):
+    """ASDI keys of a run's files, e.g. run_keys("20240202T0000Z")"""
+    from datetime import datetime, timedelta
+
+    start = datetime.strptime(run, "%Y%m%dT%H%MZ")
+    return [f"{PREFIX}{run}/{start + timedelta(hours=hour):%Y%m%dT%H%MZ}-PT{hour:04}H00M-{parameter}"
+            for parameter in parameters for hour in hours]
+
+
+def test_parameters_download_together_with_a_cube_each(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import datetime
+
+    from asdi_manifest import SyncManifest
+    from fetch_asdi import _download_keys, download_files, get_transfer_config, paginator
+    from stand_ins import S3StandIn
+
+    run = datetime(2024, 2, 2, 0)
+    with S3StandIn(BUCKET, run_keys("20240202T0000Z"), 100) as server:
+        s3_client = serve_asdi_files(server, monkeypatch, tmp_path)
+
+        # One listing for both parameters, each reported done once all its files are in
+        contents = paginator(None, None, None, BUCKET, PREFIX, run, PARAMETERS, output="contents", s3_client=s3_client)
+        drop_folder = str(tmp_path / "direct")
+        os.makedirs(drop_folder)
+        done = []
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            n_ok, total_bytes = _download_keys(executor, s3_client, get_transfer_config(4), None, None, None, BUCKET, contents,
+                                               PARAMETERS, drop_folder, SyncManifest(drop_folder),
+                                               lambda parameter, n: done.append((parameter, n)))
+        assert (n_ok, total_bytes) == (4, 4 * len(server.body))
+        assert sorted(done) == sorted((parameter, 2) for parameter in PARAMETERS)
+        assert sorted(os.listdir(drop_folder)) == sorted([key.split("/")[2] for key in server.keys] + ["manifest.json"])
+
+        download_files(run, None, None, None, BUCKET, PREFIX, PARAMETERS, workers=4, cube=True)
+        assert server.downloads == 8
+
+    run_folder = tmp_path / "data" / "asdi" / "20240202T0000Z"
+    for parameter in PARAMETERS:
+        paths = [str(run_folder / key.split("/")[2]) for key in run_keys("20240202T0000Z", parameters=[parameter])]
+        cube = str(run_folder / (parameter[:-len(".nc")] + ".cube.nc"))
+        series, lead_times = extract_points_cube(cube, LATS, LONS)
+        assert list(lead_times) == [60, 120]
+        np.testing.assert_allclose(series, extract_points_files(paths, LATS, LONS), atol=1e-5)
+
+
+def test_backfill_downloads_each_run_with_a_bounded_queue(tmp_path, monkeypatch, capsys):
+    import queue
+    import types
+    from datetime import datetime
+
+    import fetch_asdi
+    from fetch_asdi import backfill, forecast_runs
+    from stand_ins import S3StandIn
+
+    assert list(forecast_runs(datetime(2024, 2, 1, 6), datetime(2024, 2, 2, 6), [18, 0, 6, 12])) == \
+        [datetime(2024, 2, 1, hour) for hour in (6, 12, 18)] + [datetime(2024, 2, 2, hour) for hour in (0, 6)]
+
+    # Records the size of the listed runs queue after every put
+    sizes, maxsizes = [], []
+
+    class RecordingQueue(queue.Queue):
+        def __init__(self, maxsize=0):
+            super().__init__(maxsize)
+            maxsizes.append(maxsize)
+
+        def put(self, item, *args, **kwargs):
+            super().put(item, *args, **kwargs)
+            sizes.append(self.qsize())
+
+    monkeypatch.setattr(fetch_asdi, "queue", types.SimpleNamespace(Queue=RecordingQueue))
+
+    runs = ["20240202T0000Z", "20240202T0600Z", "20240203T0000Z"]
+    with S3StandIn(BUCKET, sum((run_keys(run, parameters=[FILE_NAME_FORMAT]) for run in runs), []), 100) as server:
+        serve_asdi_files(server, monkeypatch, tmp_path)
+        backfill(datetime(2024, 2, 2, 0), datetime(2024, 2, 3, 0), [0, 6, 12], None, None, None, BUCKET, PREFIX,
+                 FILE_NAME_FORMAT, workers=2, prefetch=1)
+        assert server.downloads == 6
+
+    assert maxsizes == [1] and max(sizes) <= 1
+    assert len(sizes) == 5  # Four runs listed then the end marker
+    assert "No files found for run 20240202T1200Z" in capsys.readouterr().out
+    for run in runs:
+        assert len(os.listdir(tmp_path / "data" / "asdi" / run)) == 3  # Two files and the manifest
+
+
+def test_second_sync_downloads_nothing(tmp_path, monkeypatch):
+    import json
+    from datetime import datetime
+
+    from asdi_manifest import MANIFEST_FILE_NAME
+    from fetch_asdi import download_files
+    from stand_ins import S3StandIn
+
+    run = datetime(2024, 2, 2, 0)
+    run_folder = tmp_path / "data" / "asdi" / "20240202T0000Z"
+    with S3StandIn(BUCKET, run_keys("20240202T0000Z"), 100) as server:
+        serve_asdi_files(server, monkeypatch, tmp_path)
+        sync = lambda **kwargs: download_files(run, None, None, None, BUCKET, PREFIX, PARAMETERS, workers=2, sync=True, **kwargs)
+
+        sync()
+        assert server.downloads == 4
+        sync()
+        assert server.downloads == 4
+
+        # A file deleted locally is fetched again, and only that one
+        os.remove(run_folder / run_keys("20240202T0000Z")[0].split("/")[2])
+        sync()
+        assert server.downloads == 5
+
+        # Compacted files no longer match the size listed in S3, the manifest's local_size keeps them current
+        for name in os.listdir(run_folder):
+            os.remove(run_folder / name)
+        sync(compact=Compaction(precision=0.01))
+        assert server.downloads == 9
+        with open(run_folder / MANIFEST_FILE_NAME) as f:
+            entries = json.load(f).values()
+        assert all(entry["local_size"] != entry["size"] for entry in entries)
+        sync(compact=Compaction(precision=0.01))
+        assert server.downloads == 9
+
+
+def test_bulk_extract_matches_per_file_reads(tmp_path):
+    from bulk_read import bulk_extract
+    from regions import RegionIndex
+
+    run_folder = str(tmp_path / "20240202T0000Z")
+    paths = write_run(run_folder, range(1, 6))
+    regions = {"box": (48.95, -2.1, 49.1, -1.9)}
+    result = bulk_extract([run_folder], LATS, LONS, regions, workers=2)
+
+    assert result["files"] == paths and np.isfinite(result["regions"]["box"]).all()
+    np.testing.assert_allclose(result["points"], extract_points_files(paths, LATS, LONS), atol=1e-6)
+    with nc.Dataset(paths[0]) as dataset:
+        region_index = RegionIndex.from_regions(get_grid_index(dataset), regions)
+    for i, path in enumerate(paths):
+        with nc.Dataset(path) as dataset:
+            expected = region_index.stats(dataset.variables[RAINFALL_VARIABLE][:])
+        np.testing.assert_allclose(result["regions"]["box"][i], expected[0], rtol=1e-6)
+
+
+def test_parquet_append_and_replace(tmp_path, monkeypatch):
+    from bulk_read import points_frame
+    from utils import read_parquet, save_to_parquet
+
+    monkeypatch.chdir(tmp_path)
+    frames = {}
+    for run in ("20240202T0000Z", "20240203T0000Z"):
+        paths = write_run(str(tmp_path / run), (1, 2))
+        frames[run] = points_frame({"files": paths, "points": extract_points_files(paths, LATS, LONS)}, LATS, LONS)
+
+    for _ in range(2):
+        for frame in frames.values():
+            save_to_parquet(frame, "points")
+    saved = read_parquet("points")
+    assert len(saved) == 2 * sum(len(frame) for frame in frames.values())
+    assert sorted(os.listdir(tmp_path / "data" / "points")) == ["run_date=2024-02-02", "run_date=2024-02-03"]
+    assert set(saved["run_date"].astype(str)) == {"2024-02-02", "2024-02-03"}
+
+    # Replacing one run's partition leaves the other's duplicated rows alone
+    save_to_parquet(frames["20240202T0000Z"], "points", append=False)
+    counts = read_parquet("points")["run_date"].astype(str).value_counts()
+    assert counts["2024-02-02"] == len(frames["20240202T0000Z"]) and counts["2024-02-03"] == 2 * len(frames["20240203T0000Z"])
+
+    replaced = read_parquet("points", columns=["location", "value"], filters=[("run_date", "=", "2024-02-02")])
+    np.testing.assert_allclose(replaced["value"], frames["20240202T0000Z"]["value"])
+
+
+def test_points_outside_a_cropped_grid_are_masked(tmp_path):
+    import shutil
+    from rain_service import RunStore
+
+    run_folder = tmp_path / "20240202T0000Z"
+    paths = write_run(str(run_folder), (1, 2))
+    original = str(tmp_path / "original.nc")
+    shutil.copy(paths[0], original)
+    with nc.Dataset(original) as dataset:
+        index = get_grid_index(dataset)
+    lons, lats = index.unproject(np.array([-9000.0, 9000.0]), np.array([-9000.0, 9000.0]))
+
+    settings = Compaction(bbox=(lats.min(), lons.min(), lats.max(), lons.max()))
+    for path in paths:
+        compact_file(path, settings)
+    with nc.Dataset(paths[0]) as dataset:
+        cropped = get_grid_index(dataset)
+    assert cropped.shape < index.shape
+
+    # The centre, less than half a cell beyond the east edge, just over half a cell beyond it, and well outside
+    east = cropped.x.max()
+    point_lons, point_lats = index.unproject(np.array([0.0, east + 900, east + 1100, east + 20000]), np.zeros(4))
+    outside = [False, False, True, True]
+
+    values = extract_points_files(paths, point_lats, point_lons)
+    assert list(np.ma.getmaskarray(values)[:, 0]) == outside
+    # Inside the crop, the same cells as the full grid
+    np.testing.assert_allclose(values[:2, 0], extract_points_files([original], point_lats[:2], point_lons[:2])[:, 0],
+                               atol=settings.precision)
+
+    cached = extract_points_files(paths, point_lats, point_lons, cache=GridCache(str(tmp_path / "cache")))
+    assert (np.ma.getmaskarray(cached) == np.ma.getmaskarray(values)).all()
+    np.testing.assert_allclose(cached[:2], values[:2], atol=1e-5)
+
+    import h5netcdf.legacyapi
+    with h5netcdf.legacyapi.Dataset(paths[0], "r") as dataset:
+        assert list(np.ma.getmaskarray(extract_points(dataset, point_lats, point_lons, full_grid=False))) == outside
+
+    series, _ = extract_points_cube(build_cube(str(run_folder), FILE_NAME_FORMAT), point_lats, point_lons)
+    assert (np.ma.getmaskarray(series) == np.ma.getmaskarray(values)).all()
+
+    result = RunStore(str(tmp_path)).query(point_lats, point_lons)
+    assert np.isnan(result["values"][2:]).all()
+    np.testing.assert_allclose(result["values"][:2], values[:2], atol=1e-5)
+
+
+def test_queried_runs_are_evicted_last(tmp_path, monkeypatch):
+    import time
+    import rain_service
+    from retention import RetentionManager, RetentionPolicy
+
+    old = time.time() - 3 * 86400
+
+    def age():
+        for run in runs:
+            for path in paths[run] + [str(tmp_path / run)]:
+                os.utime(path, (old, old))
+
+    runs = ("20240201T0000Z", "20240202T0000Z")
+    paths = {run: write_run(str(tmp_path / run), (1, 2)) for run in runs}
+    age()
+    store = rain_service.RunStore(str(tmp_path))
+    store.query(LATS, LONS, run=runs[0])
+
+    # Answered from memory this time, so only the service marks the older run's files as used
+    age()
+    monkeypatch.setattr(rain_service, "USE_INTERVAL", 0)
+    store.query(LATS, LONS, run=runs[0])
+    assert all(os.path.getatime(path) > old + 86400 and os.path.getmtime(path) == old for path in paths[runs[0]])
+
+    budget = max(sum(os.path.getsize(path) for path in run_paths) for run_paths in paths.values())
+    manager = RetentionManager(RetentionPolicy(max_bytes=budget), str(tmp_path), None)
+    assert [os.path.basename(unit.path) for unit in manager.enforce()] == [runs[1]]
+
+
+def test_cli_dispatches_to_each_command(tmp_path, capsys):
+    from cli import main
+
+    main([], prog="met")
+    assert capsys.readouterr().out.startswith("usage: met <command> [options]")
+
+    with pytest.raises(SystemExit) as exit_info:
+        main(["fetch-everything"], prog="met")
+    assert exit_info.value.code == 2
+    assert capsys.readouterr().out.startswith("Unknown command 'fetch-everything'")
+
+    with pytest.raises(SystemExit) as exit_info:
+        main(["accumulate", "--help"], prog="met")
+    assert exit_info.value.code == 0
+    assert capsys.readouterr().out.startswith("usage: met accumulate")
+
+    run_folder = str(tmp_path / "20240202T0000Z")
+    write_run(run_folder, range(1, 4))
+    main(["accumulate", run_folder, "--windows", "3", "--no-daily"], prog="met")
+    assert capsys.readouterr().out.startswith("PT03H 2024-02-02 00:00 to 2024-02-02 03:00 (3h)")
+
+
+def test_require_names_every_missing_setting(monkeypatch):
+    from config import require
+
+    monkeypatch.setenv("AWS_ACCESS", "key")
+    monkeypatch.delenv("AWS_SECRET", raising=False)
+    monkeypatch.delenv("AWS_REGION", raising=False)
+    assert require("AWS_ACCESS") == "key"
+    with pytest.raises(ValueError, match="Missing AWS_SECRET, AWS_REGION. Please set them"):
+        require("AWS_ACCESS", "AWS_SECRET", "AWS_REGION")
+    monkeypatch.setenv("AWS_SECRET", "secret")
+    monkeypatch.setenv("AWS_REGION", "eu-west-2")
+    assert require("AWS_ACCESS", "AWS_SECRET", "AWS_REGION") == ["key", "secret", "eu-west-2"]
+
+
+def test_telemetry_exports_prometheus_and_json(tmp_path):
+    import json
+    from telemetry import LATENCY_BUCKETS, Telemetry
+
+    metrics = Telemetry()
+    metrics.count("asdi.download")
+    metrics.count("asdi.download", 2)
+    for seconds in (0.003, 0.02, 0.02, 7.0):
+        metrics.observe("asdi.list", seconds)
+
+    lines = metrics.to_prometheus().splitlines()
+    assert lines[:2] == ["# TYPE met_asdi_download_total counter", "met_asdi_download_total 3"]
+    assert lines[2] == "# TYPE met_asdi_list_seconds histogram"
+    buckets = dict(line.split(" ") for line in lines if line.startswith("met_asdi_list_seconds_bucket"))
+    assert len(buckets) == len(LATENCY_BUCKETS)
+    assert buckets['met_asdi_list_seconds_bucket{le="0.005"}'] == "1"
+    assert buckets['met_asdi_list_seconds_bucket{le="0.025"}'] == "3"
+    assert buckets['met_asdi_list_seconds_bucket{le="5.0"}'] == "3"
+    assert buckets['met_asdi_list_seconds_bucket{le="10.0"}'] == "4"
+    assert buckets['met_asdi_list_seconds_bucket{le="+Inf"}'] == "4"
+    assert "met_asdi_list_seconds_count 4" in lines
+    assert float(next(line for line in lines if line.startswith("met_asdi_list_seconds_sum")).split(" ")[1]) == pytest.approx(7.043)
+
+    prom_path = str(tmp_path / "metrics.prom")
+    metrics.export(prom_path)
+    with open(prom_path) as f:
+        assert f.read() == metrics.to_prometheus()
+
+    json_path = str(tmp_path / "metrics.json")
+    metrics.export(json_path)
+    with open(json_path) as f:
+        exported = json.load(f)
+    snapshot = metrics.snapshot()
+    assert exported["counters"] == snapshot["counters"] == {"asdi.download": 3}
+    assert exported["histograms"] == snapshot["histograms"]
+    assert exported["histograms"]["asdi.list"]["buckets"]["inf"] == 0
+    assert exported["histograms"]["asdi.list"]["p50_s"] == 0.025
+
+
+def test_catalog_rejects_a_malformed_run_time(tmp_path, capsys):
+    from asdi_catalog import main
+
+    with pytest.raises(SystemExit) as exit_info:
+        main(["--catalog", str(tmp_path / "catalog.sqlite"), "--run-start", "2024-02-01"])
+    assert exit_info.value.code == 2
+    assert "invalid run time '2024-02-01', expected 'YYYY-MM-DD HH:MM:SS'" in capsys.readouterr().err
+
+    main(["--catalog", str(tmp_path / "catalog.sqlite"), "--run-start", "2024-02-01 00:00:00", "--run-end", "2024-02-02 00:00:00"])
+    assert capsys.readouterr().out == "0 files\n"
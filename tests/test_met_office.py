@@ -1 +1,466 @@
 # Test met office script
+
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+import pytest
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+from grib_stream import GribIngest, GribSplitter
+from stand_ins import DataHubStandIn, _DataHubHandler
+
+
+def fake_message(payload):
+    """A GRIB2-framed message: indicator section with the total length, payload, then the end section"""
+    length = 16 + len(payload) + 4
+    return b"GRIB" + b"\0\0" + bytes([0, 2]) + struct.pack(">Q", length) + payload + b"7777"
+
+
+def grib_message(values, lat_first=54.0, lat_last=50.0, lon_first=355.0, lon_last=4.0, forecast_hours=3, level=None):
+    """A real GRIB2 precipitation message on a regular lat/lon grid, values being (lats x lons)"""
+    eccodes = pytest.importorskip("eccodes")
+    handle = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+    n_lats, n_lons = values.shape
+    for key, value in [("Ni", n_lons), ("Nj", n_lats),
+                       ("latitudeOfFirstGridPointInDegrees", lat_first), ("latitudeOfLastGridPointInDegrees", lat_last),
+                       ("longitudeOfFirstGridPointInDegrees", lon_first), ("longitudeOfLastGridPointInDegrees", lon_last),
+                       ("iDirectionIncrementInDegrees", 1.0), ("jDirectionIncrementInDegrees", 1.0),
+                       ("discipline", 0), ("parameterCategory", 1), ("parameterNumber", 8),
+                       ("dataDate", 20240202), ("dataTime", 800), ("forecastTime", forecast_hours)]:
+        eccodes.codes_set(handle, key, value)
+    if level is not None:
+        eccodes.codes_set(handle, "typeOfFirstFixedSurface", 103)  # Height above ground
+        eccodes.codes_set(handle, "level", level)
+    eccodes.codes_set_values(handle, values.astype("f8").ravel())
+    message = eccodes.codes_get_message(handle)
+    eccodes.codes_release(handle)
+    return message
+
+
+def test_splitter_joins_messages_cut_across_chunks():
+    messages = [fake_message(b"first" * 7), fake_message(b"second message" * 3)]
+    stream = b"junk" + messages[0] + messages[1]
+    for chunk_size in (1, 3, 7, 20, len(stream)):
+        splitter = GribSplitter()
+        received = []
+        for start in range(0, len(stream), chunk_size):
+            received += splitter.feed(stream[start:start + chunk_size])
+        splitter.finish()
+        assert received == messages
+
+
+def test_splitter_rejects_a_truncated_stream():
+    splitter = GribSplitter()
+    assert splitter.feed(fake_message(b"payload")[:-5]) == []
+    with pytest.raises(ValueError):
+        splitter.finish()
+
+
+def test_decode_across_the_prime_meridian():
+    values = np.arange(50, dtype="f4").reshape(5, 10)
+    message = grib_message(values)
+
+    # A point at 52N 1W is in row 2 (54, 53, 52, ...) and column 4 (-5, -4, ..., -1, ...)
+    ingest = GribIngest(lats=[52.0, 50.0], lons=[-1.0, 4.0])
+    for start in range(0, len(message), 17):
+        ingest.feed("a.grib2", message[start:start + 17])
+    ingest.close("a.grib2")
+
+    (key, field), = ingest.fields.items()
+    np.testing.assert_allclose(field.lons, np.arange(-5, 5))
+    np.testing.assert_allclose(field.lats, [54, 53, 52, 51, 50])
+    assert field.lead_minutes == 180
+    np.testing.assert_allclose(ingest.points[key], [values[2, 4], values[4, 9]])
+
+
+def test_ingest_drain_and_bound():
+    values = np.ones((5, 10), dtype="f4")
+    ingest = GribIngest(lats=[52.0], lons=[-1.0], max_results=2)
+    for hours in (1, 2, 3):
+        ingest.feed("a.grib2", grib_message(values, forecast_hours=hours))
+    ingest.feed("b.grib2", grib_message(values))
+
+    # Only the two newest fields are held
+    assert sorted((file, valid.hour) for file, *_, valid in ingest.fields) == [("a.grib2", 11), ("b.grib2", 11)]
+    fields, points, region_stats = ingest.drain("a.grib2")
+    assert [key[0] for key in fields] == ["a.grib2"] and len(points) == 1 and region_stats == {}
+    fields, _, _ = ingest.drain()
+    assert [key[0] for key in fields] == ["b.grib2"]
+    assert ingest.fields == {} and ingest.points == {}
+
+
+def test_ingest_keeps_levels_apart():
+    ingest = GribIngest(lats=[52.0], lons=[-1.0])
+    for level, value in ((1, 1.0), (10, 2.0)):
+        ingest.feed("a.grib2", grib_message(np.full((5, 10), value, dtype="f4"), level=level))
+    ingest.close("a.grib2")
+
+    assert sorted((key[2], key[3]) for key in ingest.fields) == [(1, "3"), (10, "3")]
+    assert sorted(float(values[0]) for values in ingest.points.values()) == [1.0, 2.0]
+
+
+def test_service_answers_from_grib_downloads(tmp_path):
+    from rain_service import GribRunStore
+
+    folder = tmp_path / "met_forecasts"
+    folder.mkdir()
+    for hours in (3, 4):
+        values = np.arange(50, dtype="f4").reshape(5, 10) + hours
+        (folder / f"agl_rainfall-accumulation_{hours:02}_20240202.grib2").write_bytes(grib_message(values, forecast_hours=hours))
+    (folder / "agl_rainfall-accumulation_05_20240202.grib2.part").write_bytes(b"GRIB")
+
+    store = GribRunStore(str(folder))
+    assert {run: [valid.hour for _, valid, _ in files] for run, files in store.runs().items()} == {"20240202T0800Z": [11, 12]}
+
+    from datetime import datetime
+    result = store.query([52.0, 50.0], [-1.0, 4.0], [datetime(2024, 2, 2, 11, 30), datetime(2024, 2, 2, 14)])
+    assert result["valid_times"] == ["2024-02-02T12:00:00", None]
+    np.testing.assert_allclose(result["values"][:, 0], [24 + 4, 49 + 4])
+    assert np.isnan(result["values"][:, 1]).all()
+
+
+@pytest.fixture
+def importer(tmp_path, monkeypatch):
+    monkeypatch.setenv("MET_OFFICE_API_KEY", "test")
+    monkeypatch.chdir(tmp_path)
+    from fetch_met_office import MetFileImporter
+    client = MetFileImporter()
+    client.perfMode = False
+    client.backoffBase = 0.01
+    return client
+
+
+def test_decoded_files_leave_a_marker(importer):
+    with DataHubStandIn(importer.order, "08", n_files=2, file_size=10) as server:
+        server.body = grib_message(np.ones((5, 10), dtype="f4"))
+        importer.BASE_URL = server.url
+        importer.ingest = GribIngest(lats=[52.0], lons=[-1.0])
+        importer.keepGrib = False
+
+        landed = []
+        downloaded = importer.download_files({"08": server.file_ids}, on_file=landed.append)
+        assert sorted(landed) == sorted(downloaded) and len(landed) == 2
+        assert all(path.endswith(".grib2.decoded") and os.path.exists(path) for path in landed)
+        assert not [name for name in os.listdir(importer.baseFolder) if name.endswith((".grib2", ".part"))]
+        assert len(importer.ingest.points) == 2
+
+        # fillgaps counts the marker as downloaded
+        importer.fillgaps = True
+        requests = server.requests
+        assert sorted(importer.download_files({"08": server.file_ids})) == sorted(landed)
+        assert server.requests == requests
+
+
+class _TruncatingHandler(_DataHubHandler):
+    """Sends the full Content-Length but only half the body, then drops the connection, server.truncate times"""
+
+    def _send_bytes(self, body, etag, head=False):
+        if self.server.truncate <= 0 or self.headers.get("Range"):
+            return super()._send_bytes(body, etag, head)
+        self.server.truncate -= 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2])
+        self.close_connection = True
+
+
+def _file_url(server, file_id):
+    return f"{server.url}/orders/{server.order}/latest/{file_id}/data".replace("+", "%2B")
+
+
+def test_fetch_resumes_a_part_file(importer, tmp_path):
+    with DataHubStandIn(importer.order, "08", n_files=1, file_size=300_000) as server:
+        file_path = str(tmp_path / "a.grib2")
+        with open(file_path + ".part", "wb") as f:
+            f.write(server.body[:123_457])
+
+        size = importer.fetch_to_file(_file_url(server, server.file_ids[0]), {}, file_path)
+        assert size == len(server.body)
+        with open(file_path, "rb") as f:
+            assert f.read() == server.body
+        assert not os.path.exists(file_path + ".part")
+        assert server.requests == 1
+
+
+def test_fetch_retries_a_truncated_body(importer, tmp_path):
+    with DataHubStandIn(importer.order, "08", n_files=1, file_size=300_000) as server:
+        server.RequestHandlerClass = _TruncatingHandler
+        url = _file_url(server, server.file_ids[0])
+        importer.chunkSize = 16 * 1024  # Small enough for part of the body to reach the part file
+
+        # Without retries the truncated download is left as a part file, never renamed into place
+        server.truncate = 1
+        importer.retryCount = 0
+        file_path = str(tmp_path / "a.grib2")
+        with pytest.raises(Exception):
+            importer.fetch_to_file(url, {}, file_path)
+        assert not os.path.exists(file_path)
+        assert 0 < os.path.getsize(file_path + ".part") < len(server.body)
+
+        # With retries it resumes from the end of the part file and completes
+        server.truncate = 1
+        importer.retryCount = 2
+        file_path = str(tmp_path / "b.grib2")
+        requests = server.requests
+        importer.fetch_to_file(url, {}, file_path)
+        assert server.requests == requests + 2
+        with open(file_path, "rb") as f:
+            assert f.read() == server.body
+        assert not os.path.exists(file_path + ".part")
+
+
+def test_fetch_renames_a_complete_part_file(importer, tmp_path):
+    with DataHubStandIn(importer.order, "08", n_files=1, file_size=50_000) as server:
+        file_path = str(tmp_path / "a.grib2")
+        with open(file_path + ".part", "wb") as f:
+            f.write(server.body)
+
+        # The server answers the range past the end with a 416 giving the full size, which matches
+        assert importer.fetch_to_file(_file_url(server, server.file_ids[0]), {}, file_path) == len(server.body)
+        with open(file_path, "rb") as f:
+            assert f.read() == server.body
+        assert not os.path.exists(file_path + ".part")
+
+
+def test_second_poll_is_not_modified(importer):
+    with DataHubStandIn(importer.order, "08", 2, 1000) as server:
+        importer.BASE_URL = server.url
+        assert importer.get_model_runs() == {"mo-uk-latlon": "08:2024-02-03T08:00:00Z"}
+        assert server.not_modified == 0
+        # The run list is reused from the first poll, not downloaded again
+        assert importer.get_model_runs() == {"mo-uk-latlon": "08:2024-02-03T08:00:00Z"}
+        assert server.not_modified == 1 and server.downloads == 0
+
+
+def test_poll_delay_shortens_inside_the_run_window(importer):
+    from datetime import datetime, timezone
+
+    importer.pollInterval, importer.pollIntervalNearRun = 900, 60
+    at = lambda hour, minute=0, day=3: datetime(2024, 2, day, hour, minute, tzinfo=timezone.utc)
+    assert importer.next_poll_delay(at(6), None) == 900
+    assert importer.next_poll_delay(at(7, 40), None) == 300  # Cut short to the window opening at 07:45
+    assert importer.next_poll_delay(at(7, 50), None) == 60
+    assert importer.next_poll_delay(at(10), None) == 60  # Still due, three hours after the run
+    assert importer.next_poll_delay(at(10), at(8)) == 900  # Already downloaded
+    assert importer.next_poll_delay(at(12), None) == 900
+
+
+def test_watch_downloads_a_run_once_and_stops(importer, tmp_path):
+    import threading
+    import time
+
+    importer.pollInterval = importer.pollIntervalNearRun = 0.05
+    with DataHubStandIn(importer.order, "08", 2, 1000) as server:
+        importer.BASE_URL = server.url
+        landed = []
+        stop = threading.Event()
+        watcher = threading.Thread(target=importer.watch, kwargs={"on_file": landed.append, "stop": stop})
+        watcher.start()
+        deadline = time.monotonic() + 10
+        while server.not_modified < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stop.set()
+        watcher.join(5)
+
+    assert not watcher.is_alive()
+    assert server.not_modified >= 2 and server.downloads == 2 and len(landed) == 2
+    with open(tmp_path / "data" / "met_forecasts" / "watch_state.json") as f:
+        assert json.load(f) == {"mo-uk-latlon": "2024-02-03T08:00:00+00:00"}
+
+
+def test_files_are_split_by_run(importer):
+    importer.RUN_LIST = ["08", "20"]
+    order = {"orderDetails": {"files": [{"fileId": file_id} for file_id in
+                                        ["agl_rain_00_+08", "agl_rain_01_+08", "agl_rain_00_+20", "agl_rain_00_+12", "no_run"]]}}
+    assert importer.get_files_by_run(order) == {"08": ["agl_rain_00_+08", "agl_rain_01_+08"], "20": ["agl_rain_00_+20"]}
+    assert importer.get_files_by_run(order, ["12"]) == {"12": ["agl_rain_00_+12"]}
+    importer.numFilesPerOrder = 1
+    assert importer.get_files_by_run(order) == {"08": ["agl_rain_00_+08"], "20": ["agl_rain_00_+20"]}
+
+
+def test_fetch_all_puts_each_order_in_its_own_folder(importer, tmp_path):
+    with DataHubStandIn(importer.order, "08", 2, 1000) as server:
+        server.orders.append("second-order")
+        importer.BASE_URL = server.url
+        importer.ORDER_LIST = [importer.order, "second-order"]
+        downloaded = importer.fetch_all()
+
+    base = tmp_path / "data" / "met_forecasts"
+    assert len(downloaded) == 4 and server.downloads == 4
+    for order in importer.ORDER_LIST:
+        assert sorted(name.rsplit("_", 1)[0] for name in os.listdir(base / order)) == server.file_ids
+        assert sorted(path for path in downloaded if os.path.dirname(path) == os.path.join("data", "met_forecasts", order)) \
+            == sorted(os.path.join("data", "met_forecasts", order, name) for name in os.listdir(base / order))
+
+
+class _FailingHandler(_DataHubHandler):
+    """Answers every request with server.status"""
+
+    def do_GET(self):
+        self._delay()
+        self._send(self.server.status, b"", "text/plain")
+
+
+def test_fetch_has_one_retry_budget(importer, tmp_path):
+    importer.retryCount = 2
+    file_path = str(tmp_path / "a.grib2")
+    with DataHubStandIn(importer.order, "08", n_files=1, file_size=1000) as server:
+        server.RequestHandlerClass = _FailingHandler
+        importer.BASE_URL = server.url
+
+        server.status = 503
+        with pytest.raises(IOError, match="status 503"):
+            importer.fetch_to_file(_file_url(server, server.file_ids[0]), {}, file_path)
+        assert server.requests == 3  # Not retried inside api_get as well
+
+        server.status = 404
+        with pytest.raises(requests.HTTPError):
+            importer.fetch_to_file(_file_url(server, server.file_ids[0]), {}, file_path)
+        assert server.requests == 4
+
+
+def test_metadata_failures_report_their_status(importer, capsys):
+    with DataHubStandIn(importer.order, "08", n_files=1, file_size=1000) as server:
+        server.RequestHandlerClass = _FailingHandler
+        server.status = 403
+        importer.BASE_URL = server.url
+        with pytest.raises(SystemExit):
+            importer.get_model_runs()
+    assert "get_model_runs failed with status 403\n" in capsys.readouterr().out
+    assert server.requests == 1
+
+
+class _FakeClock:
+    """Stands in for the time module in rate_limit, so sleeps are recorded and pass instantly"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class _FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeSession:
+    """Returns (or raises) the canned results in order, one per GET"""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    import rate_limit
+    fake = _FakeClock()
+    monkeypatch.setattr(rate_limit, "time", fake)
+    return fake
+
+
+def test_retry_after_seconds_and_http_date():
+    from email.utils import format_datetime
+    from datetime import datetime, timedelta, timezone
+    from rate_limit import retry_after_seconds
+
+    assert retry_after_seconds(_FakeResponse(429, {"Retry-After": "7"})) == 7.0
+    soon = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= retry_after_seconds(_FakeResponse(429, {"Retry-After": soon})) <= 30
+    past = format_datetime(datetime.now(timezone.utc) - timedelta(hours=1), usegmt=True)
+    assert retry_after_seconds(_FakeResponse(429, {"Retry-After": past})) == 0.0
+    assert retry_after_seconds(_FakeResponse(429, {"Retry-After": "soon"})) is None
+    assert retry_after_seconds(_FakeResponse(429)) is None
+
+
+def test_429_halves_the_rate_and_honours_retry_after(clock):
+    from rate_limit import RateLimiter, request_with_retry
+
+    limiter = RateLimiter(8.0, burst=1)
+    session = _FakeSession([_FakeResponse(429, {"Retry-After": "3"}), _FakeResponse(200)])
+    response = request_with_retry(session, "url", limiter, retries=3)
+
+    assert response.status_code == 200 and session.calls == 2
+    assert limiter.rate == pytest.approx(8.0 / 2 + 8.0 / 20)  # Halved by the 429, nudged back up by the 200
+    assert clock.sleeps[0] == 3.0  # The Retry-After rather than a backoff
+    assert sum(clock.sleeps) >= 3.0
+
+    # The pause holds every worker, not just the one that got the 429
+    limiter.throttled(retry_after=5)
+    start = clock.now
+    limiter.acquire()
+    assert clock.now - start >= 5
+
+
+def test_429_with_an_http_date(clock):
+    from email.utils import format_datetime
+    from datetime import datetime, timedelta, timezone
+    from rate_limit import RateLimiter, request_with_retry
+
+    when = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=20), usegmt=True)
+    session = _FakeSession([_FakeResponse(429, {"Retry-After": when}), _FakeResponse(200)])
+    assert request_with_retry(session, "url", RateLimiter(4.0), retries=1).status_code == 200
+    assert 15 <= clock.sleeps[0] <= 20
+
+
+def test_rate_never_drops_below_min_rate():
+    from rate_limit import RateLimiter
+
+    limiter = RateLimiter(16.0, min_rate=2.0)
+    for _ in range(10):
+        limiter.throttled()
+    assert limiter.rate == 2.0
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.rate == 16.0
+
+
+def test_retries_are_capped(clock):
+    from rate_limit import RateLimiter, request_with_retry
+
+    responses = [_FakeResponse(503) for _ in range(4)]
+    session = _FakeSession(responses)
+    response = request_with_retry(session, "url", RateLimiter(100.0), retries=3, backoff_base=1.0, backoff_cap=2.0)
+    assert response is responses[-1] and response.status_code == 503
+    assert session.calls == 4
+    assert all(r.closed for r in responses[:-1]) and not responses[-1].closed
+    assert all(0 <= wait <= 2.0 for wait in clock.sleeps)
+
+    # A status that isn't worth retrying comes straight back
+    session = _FakeSession([_FakeResponse(404)])
+    assert request_with_retry(session, "url", RateLimiter(100.0), retries=3).status_code == 404
+    assert session.calls == 1
+
+    # Connection errors are retried, then the last one is raised
+    session = _FakeSession([requests.ConnectionError("down")] * 3)
+    with pytest.raises(requests.ConnectionError):
+        request_with_retry(session, "url", RateLimiter(100.0), retries=2)
+    assert session.calls == 3